@@ -1,43 +1,52 @@
-import re
 import bson
 import hashlib
 import binascii
 import datetime
 import sys
+import itertools
 import logging
 import bson
+import threading
+import Queue
+import time
 
 from colorama import Fore
 
 import argparse
 import pymongo
 import signatureset
+import signature
+import timestamp
 
                         
-conn=pymongo.Connection()
+conn=pymongo.Connection(_connect=False) #Connects on first use, so idsgrep runs without MongoDB when alarms are not saved
+
+ALARM_QUEUE_SIZE=10000 #Max number of alarms waiting to be saved before AlarmWriter.save blocks
+ALARM_BATCH_SIZE=500 #Max number of alarms saved in one bulk operation
+ALARM_FLUSH_INTERVAL=1.0 #Max seconds an alarm waits in AlarmWriter before it is saved
+SCORE_BATCH_SIZE=1000 #Number of aggregates rescored together
+                        
                         
+default_timestamps=timestamp.AutoParser() #Used by the alarms that are not given a timestamp parser
+
+class AlarmWriterError(Exception):pass
                         
 class Alarm():
-    def __init__(self,matches,victim,time=None):
+    def __init__(self,matches,victim,time=None,victim_match=None,timestamps=None):
         self.matches=matches
         self.victim=victim
+        self.victim_match=victim_match #MatchObject of the victim in the same line as matches, used by colors
         self.data=matches[0].data.strip()
-        self.time=self.find_timestamp()
+        self.offset=len(matches[0].data)-len(matches[0].data.lstrip()) #The match offsets are in the line before strip
+        self.time=time or self.find_timestamp(timestamps or default_timestamps)
         
     def __repr__(self):
           return self.data
                   
-    def find_timestamp(self):
-        try:# Unix timestamp, Example 1335823199
-            return datetime.datetime.utcfromtimestamp(float(self.data[:10]))
-        except (ValueError,TypeError),e:
-            pass
-        
-        try:# Standard time format, Example 2012-04-01 09:47:01
-            return datetime.datetime.strptime(self.data[:19],"%Y-%m-%d %H:%M:%S")
-        except ValueError:
-            pass   
-        
+    def find_timestamp(self,timestamps):
+        time=timestamps.parse(self.data)
+        if time:
+            return time
         logging.debug("Can't interpret log timestamp, using now()")
         return datetime.datetime.now()
         
@@ -45,59 +54,202 @@ class Alarm():
         return [m.data[m.start:m.stop] for m in self.matches]
         
     def colors(self,color=True):
+        """Returns data with the matches colored red and the victim colored green"""
         if not color:
             return self.data
-        else:                
-            regexp= '(' + '|'.join(self.get_matches()) + ')'
-            data=re.sub(regexp, Fore.RED + r'\1' + Fore.RESET, self.data)              
-            data=re.sub('(%s)' % self.victim, Fore.GREEN + r'\1' + Fore.RESET, data)
-            #data=re.sub('(%s)' % attacker, Fore.RED + r'\1' + Fore.RESET, data)             
-            return data    
+        spans=[(m.start,m.stop,0) for m in self.matches]
+        if self.victim_match:
+            spans.append((self.victim_match.start,self.victim_match.stop,1))
+        spans.sort()
+        data=self.data
+        parts=[]
+        pos=0
+        for start,stop,victim in spans:
+            #Where matches overlap the first one is colored, and the next one from where it ends
+            start=max(start-self.offset,pos)
+            stop=min(stop-self.offset,len(data))
+            if stop<=start:
+                continue
+            parts.append(data[pos:start])
+            parts.append(Fore.GREEN if victim else Fore.RED)
+            parts.append(data[start:stop])
+            parts.append(Fore.RESET)
+            pos=stop
+        parts.append(data[pos:])
+        return "".join(parts)
 
-    def save(self,db,collection):
-        #Save current alarm
-        conn[db][collection].save({
+    def doc(self):
+        return {
             "_id":bson.Binary(hashlib.sha224(self.data).digest()),
             "time":self.time,
             "victim":self.victim,
             "sigs":[m.sig["_id"] for m in self.matches],
             "score":pow(sum(m.sig["score"]**2 for m in self.matches),0.5),
             "data":self.data,
-        })
+        }
+        
+    def save(self,db,collection):
+        #Save current alarm
+        conn[db][collection].save(self.doc())
     
     
+class AlarmWriter(object):
+    '''
+        Saves alarms from a background thread so the search does not wait for MongoDB.
+        
+        The alarms are queued and saved with unordered bulk upserts of up to batch_size alarms, or 
+        of the alarms that have waited flush_interval seconds. When queue_size alarms are waiting 
+        save blocks until the writer has caught up. close saves the remaining alarms and logs the 
+        number of flushes and their latency.
+        
+        A batch with an alarm that can't be encoded, like a line that is not UTF-8, is saved one 
+        alarm at a time so only that alarm is lost. If the writer thread stops anyway save and close 
+        raises AlarmWriterError instead of waiting for it.
+    '''
+    STOP=object()
+    
+    def __init__(self,collection,batch_size=ALARM_BATCH_SIZE,flush_interval=ALARM_FLUSH_INTERVAL,queue_size=ALARM_QUEUE_SIZE):
+        self.collection=collection
+        self.batch_size=batch_size
+        self.flush_interval=flush_interval
+        self.queue=Queue.Queue(queue_size)
+        self.saved=0
+        self.failed=0
+        self.flushes=0
+        self.flush_time=0.0
+        self.max_flush_time=0.0
+        self.error=None
+        self.thread=threading.Thread(target=self._run)
+        self.thread.daemon=True
+        self.thread.start()
+        
+    def save(self,alarm):
+        self._put(alarm.doc())
+        
+    def _put(self,item):
+        '''Waits for room in the queue, as long as the writer thread is running'''
+        while True:
+            if not self.thread.is_alive():
+                raise AlarmWriterError("The alarm writer has stopped: %s" % self.error)
+            try:
+                self.queue.put(item,timeout=0.5)
+                return
+            except Queue.Full:
+                pass
+        
+    def close(self):
+        self._put(self.STOP)
+        self.thread.join()
+        stats=self.stats()
+        logging.info("Saved %(saved)i alarms in %(flushes)i flushes, %(failed)i failed. Flush latency avg %(avg_flush_time).3fs max %(max_flush_time).3fs" % stats)
+        return stats
+        
+    def stats(self):
+        return {
+            "saved":self.saved,
+            "failed":self.failed,
+            "flushes":self.flushes,
+            "avg_flush_time":self.flush_time/self.flushes if self.flushes else 0.0,
+            "max_flush_time":self.max_flush_time,
+        }
+        
+    def _run(self):
+        try:
+            self._save_queued()
+        except Exception,e:
+            logging.exception("The alarm writer has stopped")
+            self.error=e
+            
+    def _save_queued(self):
+        docs={}
+        deadline=None
+        while True:
+            try:
+                if deadline is None:
+                    doc=self.queue.get()
+                else:
+                    doc=self.queue.get(timeout=max(deadline-time.time(),0))
+            except Queue.Empty:
+                doc=None
+            if doc is self.STOP:
+                self._flush(docs)
+                return
+            if doc is not None:
+                if not docs:
+                    deadline=time.time()+self.flush_interval
+                docs[doc["_id"]]=doc #The same line is only saved once, like with Alarm.save
+            if docs and (doc is None or len(docs)>=self.batch_size):
+                self._flush(docs)
+                docs={}
+                deadline=None
+                
+    def _flush(self,docs):
+        if not docs:
+            return
+        start_time=time.time()
+        try:
+            bulk=self.collection.initialize_unordered_bulk_op()
+            for id,doc in docs.iteritems():
+                bulk.find({"_id":id}).upsert().replace_one(doc)
+            bulk.execute()
+            self.saved+=len(docs)
+        except pymongo.errors.PyMongoError,e:
+            logging.error("Failed to save %i alarms: %s" % (len(docs),e))
+            self.failed+=len(docs)
+        except bson.errors.BSONError,e:
+            logging.warning("Failed to encode %i alarms, saving them one by one: %s" % (len(docs),e))
+            for doc in docs.itervalues():
+                try:
+                    self.collection.save(doc)
+                    self.saved+=1
+                except (pymongo.errors.PyMongoError,bson.errors.BSONError),e:
+                    logging.error("Failed to save alarm %r: %s" % (doc["data"],e))
+                    self.failed+=1
+        flush_time=time.time()-start_time
+        self.flushes+=1
+        self.flush_time+=flush_time
+        self.max_flush_time=max(self.max_flush_time,flush_time)
+    
+
 
 class AlarmDb(object):
-    def __init__(self,db):
+    def __init__(self,db,sigset=None):
         self.db=db
-        self.sigset=signatureset.BlackSignatureSet()
-        self.aggs=[AlarmAggHour(db,self.sigset),AlarmAggDay(db,self.sigset)]
+        self.sigset=sigset or signatureset.SignatureSetMongoDb(None,"sigdb","black")
+        self.scores=ScoreCache(self.sigset)
+        self.aggs=[AlarmAggHour(db,self.sigset,self.scores),AlarmAggDay(db,self.sigset,self.scores)]
     
     def update_aggs(self,last_update):
         '''
             Read all alarms since last time the function was runned.
-                1. increment aggregates.
-                2. Recalculate the score for all aggregates from that has been changed. 
+                1. Count the alarms per aggregate bucket, victim and signature in memory.
+                2. Increment the aggregates with one bulk upsert per aggregate collection.
+                3. Recalculate the score for the aggregates that has been changed. 
         '''
         if not last_update:
-            last_update = conn[self.db]["meta"].find_one( {"last_agg_update":{"$exists":True}})
+            #Older versions saved a new meta document each time, use the latest
+            last_update=list(conn[self.db]["meta"].find({"last_agg_update":{"$exists":True}}).sort("last_agg_update",pymongo.DESCENDING).limit(1))
             if not last_update:
                 last_update=datetime.datetime.min
             else:
-                last_update=last_update["last_agg_update"]
+                last_update=last_update[0]["last_agg_update"]
         now = datetime.datetime.now()
                        
-        logging.debug("Updating aggregate collections")
-        cursor= conn[self.db]["alarms"].find({"time": {"$gte":last_update}})        
+        logging.debug("Counting alarms since %s" % last_update)
+        counts=[{} for agg in self.aggs]
+        alarms=0
+        cursor= conn[self.db]["alarms"].find({"time": {"$gte":last_update}},["time","victim","sigs"])        
         for doc in cursor:
-            for agg in self.aggs:
-                agg.update(doc)
+            alarms+=1
+            for agg,agg_counts in zip(self.aggs,counts):
+                agg.count(doc,agg_counts)
         
-        logging.debug("Recalculating aggregate score")
-        for agg in self.aggs:
-            agg.recalc_score(last_update)
+        for agg,agg_counts in zip(self.aggs,counts):
+            logging.debug("Updating %i buckets in %s from %i alarms" % (len(agg_counts),agg.collection,alarms))
+            agg.update_counts(agg_counts)
+            agg.recalc_score_buckets(agg_counts)
 
-        conn[self.db]["meta"].save({"last_agg_update":now})
+        conn[self.db]["meta"].update({"_id":"last_agg_update"},{"$set":{"last_agg_update":now}},upsert=True)
  
 class AlarmAgg(object):       
     def update(self,doc):
@@ -109,39 +261,117 @@ class AlarmAgg(object):
             { "$inc": dict( ("sigs." + binascii.hexlify(id),1) for id in doc["sigs"])},
             True,
         )  
-    
+        
+    def count(self,doc,counts):
+        '''Adds an alarm to counts, a dict of (timebucket,victim):{hexlified sig id:count}. Same counting as update.'''
+        sigs=counts.setdefault((self.bucket(doc["time"]),doc["victim"]),{})
+        for id in set(doc["sigs"]):
+            key=binascii.hexlify(id)
+            sigs[key]=sigs.get(key,0)+1
+            
+    def update_counts(self,counts):
+        '''Increments the aggregates with the counts made by count, in one unordered bulk operation'''
+        if not counts:
+            return
+        bulk=conn[self.db][self.collection].initialize_unordered_bulk_op()
+        for (timebucket,victim),sigs in counts.iteritems():
+            bulk.find({"timebucket":timebucket,"victim":victim}).upsert().update(
+                {"$inc":dict(("sigs." + key,count) for key,count in sigs.iteritems())})
+        bulk.execute()
     
     def recalc_score(self,start):
         last_update=self.bucket(start)
-        cursor= conn[self.db][self.collection].find({"timebucket": {"$gte":last_update}})        
-        for doc in cursor:
-            self.recalc_score_doc(doc)
-    
+        self.rescore(conn[self.db][self.collection].find({"timebucket": {"$gte":last_update}}))
+            
+    def recalc_score_buckets(self,counts):
+        '''Recalculate the score of the aggregates in counts, the other aggregates are unchanged'''
+        if not counts:
+            return
+        timebuckets=list(set(timebucket for timebucket,victim in counts))
+        cursor=conn[self.db][self.collection].find({"timebucket":{"$in":timebuckets}})
+        self.rescore(doc for doc in cursor if (doc["timebucket"],doc["victim"]) in counts)
+        
+    def rescore(self,docs):
+        '''
+            Sets the score of the aggregate docs with bulk updates. The scores of the signatures in 
+            SCORE_BATCH_SIZE docs are fetched together, so a signature is only fetched once.
+        '''
+        docs=iter(docs)
+        while True:
+            batch=list(itertools.islice(docs,SCORE_BATCH_SIZE))
+            if not batch:
+                break
+            self.scores.prefetch(key for doc in batch for key in doc["sigs"])
+            bulk=conn[self.db][self.collection].initialize_unordered_bulk_op()
+            for doc in batch:
+                bulk.find({"_id":doc["_id"]}).update({"$set":{"score":self.calc_score(doc)}})
+            bulk.execute()
 
-    def recalc_score_doc(self,doc):
+    def calc_score(self,doc):
         scores=[]
         for sig,count in doc["sigs"].items():
-            sig=self.sigset.get_sig(bson.Binary(binascii.unhexlify(sig)))
-            scores.append(sig["score"]*4/(1+3/count))    
-        score=pow(sum(score**2 for score in scores),0.5)
-        doc["score"]=score
+            scores.append(self.scores.score(sig)*4/(1+3/count))    
+        return pow(sum(score**2 for score in scores),0.5)
+
+    def recalc_score_doc(self,doc):
+        doc["score"]=self.calc_score(doc)
         conn[self.db][self.collection].save(doc)
 
 
+class ScoreCache(object):
+    '''
+        Scores of signatures by the hexlified _id used as key in the aggregates.
+        
+        prefetch fetches the scores that are not cached with one bulk lookup in the signature set. 
+        It also asks for the signatures updated since the last prefetch and replaces their cached 
+        score, so the cache does not need to be emptied between runs.
+    '''
+    def __init__(self,sigset):
+        self.sigset=sigset
+        self.scores={}
+        self.checked=None #When the cached scores was last checked for updates
+        
+    def prefetch(self,keys):
+        now=datetime.datetime.now()
+        if self.checked and self.scores:
+            for id,(score,update_time) in self.sigset.get_scores_updated(self.checked).iteritems():
+                key=binascii.hexlify(id)
+                if key in self.scores:
+                    self.scores[key]=score
+        self.checked=now
+        missing=set(key for key in keys if key not in self.scores)
+        if missing:
+            found=self.sigset.get_scores(bson.Binary(binascii.unhexlify(key)) for key in missing)
+            for id,(score,update_time) in found.iteritems():
+                self.scores[binascii.hexlify(id)]=score
+                
+    def score(self,key):
+        try:
+            return self.scores[key]
+        except KeyError:
+            self.prefetch([key])
+            try:
+                return self.scores[key]
+            except KeyError:
+                raise signature.NoSig(key)
+
+
 class AlarmAggHour(AlarmAgg):
-    def __init__(self,db,sigset):
+    def __init__(self,db,sigset,scores=None):
         self.db=db
         self.collection="alarms_agg_hour"
         self.sigset=sigset
+        self.scores=scores or ScoreCache(sigset)
         
     def bucket(self,timestamp):
         return timestamp.replace(minute=0, second=0, microsecond=0)
 
 class AlarmAggDay(AlarmAgg):
-    def __init__(self,db,sigset):
+    def __init__(self,db,sigset,scores=None):
         self.db=db
         self.collection="alarms_agg_day"
         self.sigset=sigset
+        self.scores=scores or ScoreCache(sigset)
     
     def bucket(self,timestamp):
         return timestamp.replace(hour=0,minute=0, second=0, microsecond=0)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Benchmark of the matching engines on synthetic signature sets and logdata.
+
+    The data is generated from a seed, so the same options gives the same data on every run and
+    on every commit. Each engine is run in its own process and the results, throughput, startup
+    time and peak memory, are saved as JSON that can be compared with an earlier run:
+
+        python benchmark.py --output before.json
+        git checkout other-commit
+        python benchmark.py --output after.json --compare before.json
+"""
+
+import sys
+import os
+import time
+import datetime
+import random
+import json
+import gzip
+import subprocess
+import tempfile
+import shutil
+import logging
+import platform
+import argparse
+
+import signatureset
+import matchingengine
+
+ENGINES=["grep","aho","token"]
+SIG_TYPES=["IP","CIDR","IPRange","Domain","FixedString"]
+DEFAULT_MIX="IP=40,CIDR=20,IPRange=10,Domain=25,FixedString=5"
+
+LOG_LINE="%(time)s fw1 %(action)s tcp src=%(src)s:%(port)i dst=198.18.0.1:443 host=%(host)s url=%(url)s len=%(len)i\n"
+
+def int2ip(value):
+    return "%i.%i.%i.%i" % (value>>24,(value>>16)&255,(value>>8)&255,value&255)
+
+def random_ip(rng):
+    #The signatures are in 1-197.x.x.x, the logdata that should not match uses 198.18.0.0/15
+    return rng.randint(1<<24,(198<<24)-1)
+
+def gen_sig(sigtype,rng):
+    '''Returns a signature of sigtype and a string in the logdata that it matches'''
+    if sigtype=="IP":
+        ip=int2ip(random_ip(rng))
+        return ip,ip
+    if sigtype=="CIDR":
+        prefixlen=rng.randint(16,30)
+        size=1<<(32-prefixlen)
+        start=random_ip(rng)&~(size-1)
+        return "%s/%i" % (int2ip(start),prefixlen),int2ip(start+rng.randint(0,size-1))
+    if sigtype=="IPRange":
+        start=random_ip(rng)
+        stop=start+rng.randint(1,1000)
+        return "%s-%s" % (int2ip(start),int2ip(stop)),int2ip(rng.randint(start,stop))
+    if sigtype=="Domain":
+        domain="%s%i.evil-%i.com" % (rng.choice(["cdn","mail","update","x"]),rng.randint(0,99999),rng.randint(0,99999))
+        return domain,"www." + domain
+    return "/evil-%i/%s.php" % (rng.randint(0,999999),rng.choice(["gate","admin","load"])),None
+
+def parse_mix(mix):
+    weights=[]
+    for part in mix.split(","):
+        sigtype,weight=part.split("=")
+        if sigtype not in SIG_TYPES:
+            raise ValueError("Unknown signature type %s" % sigtype)
+        weights.append((sigtype,float(weight)))
+    return weights
+
+def gen_sigs(count,mix=DEFAULT_MIX,seed=1):
+    '''Returns count unique (signature,signature type,example) with the types weighted by mix'''
+    rng=random.Random(seed)
+    weights=parse_mix(mix)
+    total=sum(weight for sigtype,weight in weights)
+    sigs={}
+    for sigtype,weight in weights:
+        wanted=int(round(count*weight/total))
+        while wanted:
+            sig,example=gen_sig(sigtype,rng)
+            if sig not in sigs:
+                sigs[sig]=(sig,sigtype,example)
+                wanted-=1
+    return sorted(sigs.values())
+
+def gen_log(fp,sigs,lines,hit_rate,seed=1):
+    '''Writes lines of firewall like logdata to fp. Each line matches a signature in sigs with probability hit_rate. Returns the number of lines that matches.'''
+    rng=random.Random(seed)
+    start=datetime.datetime(2012,4,1)
+    hits=0
+    for n in xrange(lines):
+        fields={
+            "time":(start+datetime.timedelta(seconds=n/50)).strftime("%Y-%m-%d %H:%M:%S"),
+            "action":rng.choice(["allow","deny"]),
+            "src":int2ip((198<<24)+(18<<16)+rng.randint(0,(2<<16)-1)),
+            "port":rng.randint(1024,65535),
+            "host":"srv%i.example.net" % rng.randint(0,9999),
+            "url":"/index.html?id=%i" % rng.randint(0,99999),
+            "len":rng.randint(40,1500),
+        }
+        if rng.random()<hit_rate:
+            hits+=1
+            sig,sigtype,example=rng.choice(sigs)
+            if sigtype in ("IP","CIDR","IPRange"):
+                fields["src"]=example
+            elif sigtype=="Domain":
+                fields["host"]=example
+            else:
+                fields["url"]=sig
+        fp.write(LOG_LINE % fields)
+    return hits
+
+def prepare(workdir,sigcount,lines,hit_rate,gz,mix,seed):
+    '''
+        Creates the signature file and the logfile in workdir, unless they exists from an earlier run with the same options.
+        Returns their paths and the number of lines in the logfile that matches a signature.
+    '''
+    name="%i-%s-%i" % (sigcount,mix.replace(",","_").replace("=",""),seed)
+    sigfile=os.path.join(workdir,"sigs-%s.txt" % name)
+    if not os.path.exists(sigfile):
+        sigs=gen_sigs(sigcount,mix,seed)
+        with open(sigfile + ".tmp","w") as f:
+            for sig,sigtype,example in sigs:
+                f.write(sig + "\n")
+        os.rename(sigfile + ".tmp",sigfile)
+    else:
+        sigs=None
+    logfile=os.path.join(workdir,"log-%s-%i-%s%s" % (name,lines,hit_rate,".gz" if gz else ".txt"))
+    if not os.path.exists(logfile):
+        sigs=sigs or gen_sigs(sigcount,mix,seed)
+        f=gzip.open(logfile + ".tmp","wb") if gz else open(logfile + ".tmp","w")
+        with f:
+            hits=gen_log(f,sigs,lines,hit_rate,seed)
+        with open(logfile + ".hits","w") as f:
+            f.write(str(hits))
+        os.rename(logfile + ".tmp",logfile)
+    with open(logfile + ".hits") as f:
+        hits=int(f.read())
+    return sigfile,logfile,hits
+
+def run_engine(engine,sigfile,logfile,tmpdir):
+    '''Runs in the benchmark child process. Returns the startup and search times and the number of alarms.'''
+    start_time=time.time()
+    sigs=signatureset.SignatureSetFile(sigfile)
+    if engine=="grep":
+        search=matchingengine.FGrepMatchingEngine(sigs,tmpdir=tmpdir)
+    elif engine=="aho":
+        search=matchingengine.MatchingEngine(sigs)
+    else:
+        search=matchingengine.TokenMatchingEngine(sigs)
+    startup=time.time()-start_time
+    start_time=time.time()
+    alarms=0
+    for matches in search.findall_files([logfile]):
+        alarms+=1
+    return {"startup":startup,"search":time.time()-start_time,"alarms":alarms}
+
+def measure(engine,sigfile,logfile,lines):
+    '''Runs engine in a new process and returns its results with the peak memory usage'''
+    tmpdir=tempfile.mkdtemp()
+    try:
+        p=subprocess.Popen([sys.executable,os.path.abspath(__file__),"--child",engine,sigfile,logfile,tmpdir],stdout=subprocess.PIPE)
+        output=p.stdout.read()
+        pid,status,rusage=os.wait4(p.pid,0)
+    finally:
+        shutil.rmtree(tmpdir)
+    if status!=0:
+        raise RuntimeError("Benchmark of %s on %s failed" % (engine,logfile))
+    result=json.loads(output)
+    result["peak_rss_mb"]=rusage.ru_maxrss/1024.0 #ru_maxrss is in KB on Linux
+    result["lines_per_s"]=lines/result["search"] if result["search"] else None
+    result["mb_per_s"]=os.path.getsize(logfile)/1048576.0/result["search"] if result["search"] else None
+    return result
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git","rev-parse","--short","HEAD"],cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+def compare(results,old):
+    '''Prints the change from the old results for the rows that are in both'''
+    key=lambda r:(r["engine"],r["sigs"],r["format"],r["lines"],r["hit_rate"])
+    old_rows=dict((key(r),r) for r in old["results"])
+    print "Compared with %s (%s):" % (old.get("commit"),old.get("time"))
+    for r in results["results"]:
+        o=old_rows.get(key(r))
+        if not o:
+            continue
+        print "%-6s %8i sigs %-5s lines/s %+6.1f%%  startup %+6.1f%%  peak rss %+6.1f%%" % (r["engine"],r["sigs"],r["format"],
+            change(o["lines_per_s"],r["lines_per_s"]),change(o["startup"],r["startup"]),change(o["peak_rss_mb"],r["peak_rss_mb"]))
+
+def change(old,new):
+    if not old or new is None:
+        return 0.0
+    return (new-old)*100.0/old
+
+def parse_args(argv=None):
+    parser=argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes',default="1000,100000,1000000",help='Comma separated numbers of signatures')
+    parser.add_argument('--mix',default=DEFAULT_MIX,help='Weight of each signature type')
+    parser.add_argument('--lines',type=int,default=100000,help='Number of lines of logdata')
+    parser.add_argument('--hit-rate',type=float,default=0.01,help='Share of the lines that matches a signature')
+    parser.add_argument('--formats',default="plain,gz",help='Comma separated logdata formats, plain and/or gz')
+    parser.add_argument('--engines',default="grep,aho",help='Comma separated engines, %s' % ",".join(ENGINES))
+    parser.add_argument('--seed',type=int,default=1)
+    parser.add_argument('--workdir',metavar="DIR",default=os.path.join(tempfile.gettempdir(),"idsgrep-benchmark"),help='Folder for the generated data, it is reused by later runs')
+    parser.add_argument('--output',metavar="FILE",default=None,help='Save the results as JSON')
+    parser.add_argument('--compare',metavar="FILE",default=None,help='Results from an earlier run to compare with')
+    return parser.parse_args(argv)
+
+def main():
+    if sys.argv[1:2]==["--child"]:
+        logging.root.setLevel(logging.ERROR) #The engines warns about every signature they can't use
+        engine,sigfile,logfile,tmpdir=sys.argv[2:6]
+        print json.dumps(run_engine(engine,sigfile,logfile,tmpdir))
+        return
+    args=parse_args()
+    if not os.path.exists(args.workdir):
+        os.makedirs(args.workdir)
+    results={
+        "commit":git_commit(),
+        "time":datetime.datetime.now().isoformat(),
+        "python":platform.python_version(),
+        "platform":platform.platform(),
+        "options":vars(args),
+        "results":[],
+    }
+    for sigcount in [int(size) for size in args.sizes.split(",")]:
+        for format in args.formats.split(","):
+            sigfile,logfile,hits=prepare(args.workdir,sigcount,args.lines,args.hit_rate,format=="gz",args.mix,args.seed)
+            for engine in args.engines.split(","):
+                result=measure(engine,sigfile,logfile,args.lines)
+                result.update(engine=engine,sigs=sigcount,format=format,lines=args.lines,hit_rate=args.hit_rate,hits=hits)
+                results["results"].append(result)
+                print "%-6s %8i sigs %-5s startup %7.2fs search %7.2fs %9.0f lines/s %6.1f MB/s peak rss %7.1f MB alarms %i/%i" % (engine,sigcount,format,
+                    result["startup"],result["search"],result["lines_per_s"] or 0,result["mb_per_s"] or 0,result["peak_rss_mb"],result["alarms"],hits)
+                sys.stdout.flush()
+    if args.output:
+        with open(args.output,"w") as f:
+            json.dump(results,f,indent=1,sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results,json.load(f))
+
+if __name__=="__main__":
+    main()
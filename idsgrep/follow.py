@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import json
+import glob
+import shutil
+import logging
+
+"""
+    Follows growing log files, like tail -F, for idsgrep --follow.
+
+    Only complete lines are returned. The inode and the offset of the next line of each file is saved
+    in a checkpoint file, so a restarted idsgrep continues where it stopped. A file that is rotated,
+    renamed and replaced by a new file, is read to the end before the new file is read from the start.
+    That also works between runs, the rotated file is found by its inode next to the file.
+"""
+
+FOLLOW_INTERVAL=0.2 #Seconds to sleep when there are no new lines
+CHECKPOINT_INTERVAL=5.0 #Seconds between saves of the checkpoint
+POLL_LINES=1000 #Max number of lines read from a file before the next file is read
+
+class FollowedFile(object):
+    def __init__(self,path,source=None):
+        self.path=path
+        self.source=source or path #The followed path, a rotated file has the path of the file it was rotated from
+        self.f=None
+        self.inode=None
+        self.offset=0 #Offset of the next complete line
+
+    def open(self,offset=None):
+        '''Opens the file at offset, or at the end if offset is None. Returns False if the file does not exist.'''
+        try:
+            f=open(self.path,"rb")
+        except IOError:
+            return False
+        size=os.fstat(f.fileno()).st_size
+        if offset is None or offset>size: #offset is past the end if the file was truncated
+            offset=size if offset is None else 0
+        if self.f:
+            self.f.close()
+        self.f=f
+        self.inode=os.fstat(f.fileno()).st_ino
+        self.offset=offset
+        return True
+
+    def read(self,max_lines=POLL_LINES):
+        '''Returns the complete lines that are added since the last read'''
+        lines=[]
+        if not self.f:
+            return lines
+        self.f.seek(self.offset) #Also clears the end of file flag
+        while len(lines)<max_lines:
+            line=self.f.readline()
+            if not line.endswith("\n"): #Nothing more, or a line that is still being written
+                break
+            self.offset+=len(line)
+            lines.append(line)
+        return lines
+
+    def read_rest(self):
+        '''Returns the rest of a rotated file, the last line is returned even if it is incomplete'''
+        lines=[]
+        while True:
+            batch=self.read()
+            if not batch:
+                break
+            lines.extend(batch)
+        rest=self.f.read()
+        if rest:
+            self.offset+=len(rest)
+            lines.append(rest + "\n")
+        return lines
+
+    def check(self):
+        '''Called at the end of the file. Returns the rest of the file if it has been rotated and the lines of the new file.'''
+        try:
+            stat=os.stat(self.path)
+        except OSError: #Removed, or the new file is not created yet
+            return []
+        if not self.f:
+            self.open(0)
+            return self.read()
+        if stat.st_ino!=self.inode:
+            lines=self.read_rest()
+            logging.info("%s is rotated, reading the new file" % self.path)
+            self.open(0)
+            return lines+self.read()
+        if stat.st_size<self.offset:
+            logging.info("%s is truncated, reading from the start" % self.path)
+            self.offset=0
+            return self.read()
+        return []
+
+    def close(self):
+        if self.f:
+            self.f.close()
+            self.f=None
+
+
+class Follower(object):
+    def __init__(self,paths,checkpoint=None,interval=FOLLOW_INTERVAL,checkpoint_interval=CHECKPOINT_INTERVAL):
+        self.checkpoint=checkpoint
+        self.interval=interval
+        self.checkpoint_interval=checkpoint_interval
+        self.files=[FollowedFile(os.path.abspath(path)) for path in paths]
+        self.rotated=[] #Files rotated while idsgrep was not running, they are read to the end first
+        self.running=True
+        saved=self.load_checkpoint()
+        for followed in self.files:
+            self.restore(followed,saved.get(followed.path))
+        self.last_save=time.time()
+
+    def load_checkpoint(self):
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return {}
+        try:
+            with open(self.checkpoint) as f:
+                return json.load(f)
+        except (IOError,ValueError),e:
+            logging.warning("Can't read checkpoint %s: %s" % (self.checkpoint,e))
+            return {}
+
+    def save_checkpoint(self):
+        if not self.checkpoint:
+            return
+        state=dict((followed.path,{"inode":followed.inode,"offset":followed.offset}) for followed in self.files if followed.f)
+        try:
+            with open(self.checkpoint + ".update","w") as f:
+                json.dump(state,f)
+            shutil.move(self.checkpoint + ".update",self.checkpoint)
+        except (IOError,OSError),e:
+            logging.warning("Can't save checkpoint %s: %s" % (self.checkpoint,e))
+        self.last_save=time.time()
+
+    def restore(self,followed,state):
+        '''Opens a file at its checkpoint. Without a checkpoint an existing file is followed from its end, like tail -F.'''
+        if not state:
+            if not followed.open():
+                logging.info("%s does not exist yet" % followed.path)
+            return
+        try:
+            inode=os.stat(followed.path).st_ino
+        except OSError:
+            inode=None
+        if inode==state["inode"]:
+            followed.open(state["offset"])
+            return
+        old=find_rotated(followed.path,state["inode"])
+        if old:
+            logging.info("%s was rotated to %s, reading it from the checkpoint first" % (followed.path,old))
+            rotated=FollowedFile(old,followed.path)
+            rotated.open(state["offset"])
+            self.rotated.append(rotated)
+        else:
+            logging.warning("%s was rotated and the old file is not found, lines can be missing" % followed.path)
+        followed.open(0)
+
+    def poll(self):
+        '''Returns the new complete lines of all files, without waiting'''
+        return [line for source,line in self.poll_sources()]
+
+    def poll_sources(self):
+        '''Same as poll, but returns (path,line) where path is the followed file the line is from'''
+        lines=[]
+        while self.rotated:
+            rotated=self.rotated.pop(0)
+            lines.extend((rotated.source,line) for line in rotated.read_rest())
+            rotated.close()
+        for followed in self.files:
+            new=followed.read()
+            if not new:
+                new=followed.check()
+            lines.extend((followed.source,line) for line in new)
+        return lines
+
+    def lines(self,sources=False):
+        '''
+            Yields new lines until stop is called, or (path,line) if sources is True. The checkpoint is only
+            saved when all lines that are read are consumed, so no line is lost if idsgrep is stopped.
+        '''
+        consumed=True
+        try:
+            while self.running:
+                if time.time()-self.last_save>=self.checkpoint_interval:
+                    self.save_checkpoint()
+                lines=self.poll_sources()
+                if not lines:
+                    time.sleep(self.interval)
+                    continue
+                consumed=False
+                for source,line in lines:
+                    yield (source,line) if sources else line
+                consumed=True
+        finally:
+            #If stopped in the middle of the lines, the lines after the last checkpoint are read again by the next run
+            if consumed:
+                self.save_checkpoint()
+
+    def stop(self):
+        self.running=False
+
+    def close(self):
+        for followed in self.files:
+            followed.close()
+
+
+def find_rotated(path,inode):
+    '''Returns the rotated file next to path with inode, like path.1 or path-20120401. Compressed files are skipped.'''
+    for candidate in sorted(glob.glob(path + ".*")+glob.glob(path + "-*")):
+        if candidate.endswith(".gz"):
+            continue
+        try:
+            if os.stat(candidate).st_ino==inode:
+                return candidate
+        except OSError:
+            pass
+    return None
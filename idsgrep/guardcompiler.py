@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import logging
+
+"""
+    Compiles the fixed strings of a signature set into the guards searched for by the matching engines.
+
+    The fixed string of a CIDR or IPRange signature is the common prefix of its first and last address,
+    so a wide range gets a short guard like 10. that matches almost every line. Such guards are widened
+    into the prefixes of whole octets that together covers the range, 10.0. to 10.255. for 10.0.0.0/8,
+    as long as the total number of added guards is within the budget. A widened guard is mapped back to
+    the fixed string it replaces, so the rest of the engine never sees it.
+"""
+
+GUARD_BUDGET=100000 #Max number of guards added by widening
+MIN_FX=5 #Min length of the guards used by idsgrep, see --min-fx
+
+def int2prefix(block,octets):
+    '''Returns the dotted prefix of the first octets of an IPv4-address, block is their integer value'''
+    prefix=".".join(str((block>>(8*(octets-1-n)))&255) for n in range(octets))
+    if octets<4:
+        prefix+="."
+    return prefix
+
+def widen_range(start,stop,min_fx,limit):
+    '''
+        Returns prefixes of whole octets, like 10.0., that together covers the addresses start-stop and
+        are at least min_fx characters long, or None if more than limit prefixes are needed.
+    '''
+    prefixes=[]
+    todo=[(1,start,stop)]
+    while todo:
+        octets,start,stop=todo.pop()
+        shift=32-8*octets
+        for block in xrange(start>>shift,(stop>>shift)+1):
+            prefix=int2prefix(block,octets)
+            if len(prefix)>=min_fx:
+                prefixes.append(prefix)
+                if len(prefixes)>limit:
+                    return None
+            elif octets==4:
+                return None
+            else:
+                todo.append((octets+1,max(start,block<<shift),min(stop,((block+1)<<shift)-1)))
+    return prefixes
+
+
+class GuardCompiler(object):
+    '''
+        widen is called with the CIDR and IPRange signatures on every run, it decides which fixed strings
+        that are replaced. compile returns the guards of all fixed strings and is only needed when the
+        guards are not cached, the guards are the same as long as key() is the same.
+    '''
+    def __init__(self,min_fx,budget=GUARD_BUDGET):
+        self.min_fx=min_fx
+        self.budget=budget
+        self.weak=()
+        self.widened={} #Guard: the fixed string it replaces
+        self.replaced={} #Fixed string: its guards
+        self.unselective={} #Fixed string: signatures that are not searched for
+
+    def key(self):
+        '''Identifies the options and the weak fixed strings the guards are compiled with'''
+        return hashlib.sha1(repr((self.min_fx,self.budget,sorted(self.weak)))).hexdigest()[:10]
+
+    def widen(self,range_sigs,weak=()):
+        '''
+            Widens the fixed strings of range_sigs that are shorter than min_fx or in weak, the fixed
+            strings that needs the fewest guards first. Returns self.widened.
+        '''
+        self.weak=frozenset(weak)
+        ranges={}
+        for sig in range_sigs:
+            ranges.setdefault(sig["fixedstring"],[]).append(sig)
+        costs=[]
+        for fixedstring,sigs in ranges.iteritems():
+            if len(fixedstring)>=self.min_fx and fixedstring not in self.weak:
+                continue
+            prefixes=set()
+            for sig in sigs:
+                found=widen_range(sig["start"],sig["stop"],self.min_fx,self.budget)
+                if found is None:
+                    prefixes=None
+                    break
+                prefixes.update(found)
+            if prefixes is None or len(prefixes)>self.budget:
+                continue
+            costs.append((len(prefixes),fixedstring,prefixes))
+        used=0
+        for cost,fixedstring,prefixes in sorted(costs):
+            if used+cost>self.budget:
+                break
+            used+=cost
+            self.replaced[fixedstring]=prefixes
+            for prefix in prefixes:
+                if prefix not in ranges: #A prefix that is the fixed string of another signature keeps its name
+                    self.widened[prefix]=fixedstring
+        logging.debug("Widened %i fixed strings into %i guards" % (len(self.replaced),used))
+        return self.widened
+
+    def compile(self,fixedstrings,get_sigs=None):
+        '''
+            Yields the guards of fixedstrings. A fixed string shorter than min_fx that was not widened
+            is left out and reported, get_sigs(fixedstring) returns its signatures for the report.
+        '''
+        added=set() #Fixed strings can be widened into the same prefixes
+        for fixedstring in fixedstrings:
+            if fixedstring in self.replaced:
+                for prefix in self.replaced[fixedstring]:
+                    if prefix not in added:
+                        added.add(prefix)
+                        yield prefix
+            elif len(fixedstring)>=self.min_fx:
+                yield fixedstring
+            else:
+                sigs=get_sigs(fixedstring) if get_sigs else []
+                self.unselective[fixedstring]=sigs
+                logging.warning("Ignoring fixed string %s, it is shorter than %i characters and can't be widened. Signatures not searched for: %s" % (
+                    fixedstring,self.min_fx,", ".join(sig["sig"] for sig in sigs) or fixedstring))
+        if self.unselective:
+            logging.warning("%i fixed strings could not be made selective, see the warnings above" % len(self.unselective))
@@ -8,7 +8,12 @@ logging.basicConfig(format="%(asctime)s - %(levelname)8s - %(message)s")
 
 import sys
 import datetime
+import time
+import os
+import signal
+import hashlib
 import csv
+import itertools
 import ConfigParser
 
 import argparse
@@ -16,6 +21,12 @@ import argparse
 import matchingengine
 import signatureset
 import alarm
+import timestamp
+import stats
+import quarantine
+import guardcompiler
+import follow
+import pipeline
 
 USAGE=\
 """
@@ -76,14 +87,37 @@ def parse_args(argv=None):
     
     parser.add_argument ('--black-db',metavar="HOST", default=None,help='Blacklist MongoDB database')
     parser.add_argument ('--asset-db',metavar="HOST",default=None,help='Assetlist MongoDB database')
+    parser.add_argument ('--prefetch',default=False, action="store_true", help='Load all active signatures from MongoDB at startup instead of when they are needed') 
+    parser.add_argument ('--snapshot',default=False, action="store_true", help='Keep the active signatures from MongoDB in a snapshot in tmpdir, only changed signatures are fetched at startup') 
     parser.add_argument ('-b','--black-file',metavar="FILE",default="",help='Blacklist file')
     parser.add_argument ('-a','--asset-file',metavar="FILE",default="",help='Assetlist file')  
     parser.add_argument ('-s','--save-to-mongodb',default=False, action="store_true", help='Store alarms in mongoDB') 
     parser.add_argument ('-q','--quiet',default=False, action="store_true", help='') 
-    parser.add_argument ('--min-fx',metavar="NUM",default=5, help='') 
+    parser.add_argument ('--min-fx',metavar="NUM",type=int,default=guardcompiler.MIN_FX, help='Minimum length of the fixed string guards. Shorter CIDR and IPRange guards are widened, other signatures with shorter guards are ignored') 
+    parser.add_argument ('--guard-budget',metavar="NUM",type=int,default=guardcompiler.GUARD_BUDGET, help='Max number of guards added by widening short CIDR and IPRange guards') 
     parser.add_argument ('--no-color',default=False, action="store_true", help='') 
     parser.add_argument ('--splunk',default=False, action="store_true", help='') 
     parser.add_argument ('--tmpdir',metavar="DIR",default="/tmp/", help='Folder for temporary files') 
+    parser.add_argument ('--engine',default="grep",choices=["auto","grep","token"], help='Matching engine. token looks up the IP-addresses and domains of each line in an index instead of running grep, it ignores FixedString signatures, --jobs, --min-fx, --guard-budget, --quarantine and --verify-cache. auto uses token if there are no FixedString signatures') 
+    parser.add_argument ('-j','--jobs',metavar="N",type=int,default=1, help='Number of files to search in parallel') 
+    parser.add_argument ('--unordered',default=False, action="store_true", help='With --jobs, print alarms as they are found instead of in file order') 
+    parser.add_argument ('--pipeline',default=False, action="store_true", help='Read, verify, find victims and print in separate threads with bounded queues between them. Not used with --follow and --jobs') 
+    parser.add_argument ('--verify-workers',metavar="N",type=int,default=1, help='With --pipeline, number of verify threads') 
+    parser.add_argument ('--verify-processes',metavar="N",type=int,default=0, help='Verify the candidates in N processes, so verification can use more than one core. Not used with --follow, --reload and --jobs') 
+    parser.add_argument ('--pipeline-queue',metavar="NUM",type=int,default=pipeline.PIPELINE_QUEUE_SIZE, help='With --pipeline, max number of batches waiting in front of each stage') 
+    parser.add_argument ('--verify-cache',metavar="NUM",type=int,default=0, help='Number of IP-addresses to cache the IP range index lookups of. Only the CIDR and IPRange signatures are cached, the other signatures are verified as without it. --stats shows the hit rate. 0 disables the cache') 
+    parser.add_argument ('--asset-cache',metavar="NUM",type=int,default=10000, help='Number of logdata tokens to cache asset lookups for') 
+    parser.add_argument ('--timestamp',metavar="[FILE:]FORMAT",action="append",default=[], help='Timestamp format of the logdata: auto, iso, unix, syslog, json, none or a strptime format like %%d/%%b/%%Y:%%H:%%M:%%S. Default auto. FILE:FORMAT sets the format of one of the files, repeat it for each file') 
+    parser.add_argument ('--stats',default=False, action="store_true", help='Print candidates, confirmed and rejected matches per guard and signature type and the time spent in each stage to stderr') 
+    parser.add_argument ('--stats-top',metavar="NUM",type=int,default=20, help='Number of guards in the --stats report') 
+    parser.add_argument ('--stats-json',metavar="FILE",default=None, help='Save the --stats counters as JSON') 
+    parser.add_argument ('--quarantine',default=False, action="store_true", help='Stop using fixed string guards that overmatches, their signatures are looked up for each IP-address and domain in the lines instead') 
+    parser.add_argument ('--quarantine-threshold',metavar="SHARE",type=float,default=quarantine.THRESHOLD, help='Share of the candidates of a guard that must be rejected to quarantine it') 
+    parser.add_argument ('--quarantine-window',metavar="NUM",type=int,default=quarantine.WINDOW, help='Number of candidates of a guard that the share is calculated on') 
+    parser.add_argument ('-f','--follow',default=False, action="store_true", help='Keep reading lines as they are added to the files, like tail -F') 
+    parser.add_argument ('--checkpoint',metavar="FILE",default=None, help='With --follow, where the position in the files is saved. Defaults to a file in --tmpdir named after the files') 
+    parser.add_argument ('--reload',default=False, action="store_true", help='Reload the blacklist when it changes or on SIGHUP, without stopping the search') 
+    parser.add_argument ('--reload-interval',metavar="SECONDS",type=float,default=matchingengine.RELOAD_INTERVAL, help='How often --reload checks if the blacklist has changed') 
     parser.add_argument ('--logfile',metavar="FILE",default="", help='Logfile')
     parser.add_argument('-v', nargs='?', action=VAction, dest='verbose',default=2)
     parser.add_argument ('files', nargs="*",default=None, help='')   
@@ -124,47 +158,139 @@ class TibIDS(object):
     def __init__(self,args):
         self.args=args
         
-        if args.black_file:        
-            self.black=signatureset.SignatureSetFile(self.args.black_file)
-        elif args.black_db:
-            self.black=signatureset.SignatureSetMongoDb(self.args.black_db,"sigdb","black")
-        else:
+        self.strsig=None
+        if not args.black_file and not args.black_db:
             if args.files:
-                strsig=self.args.files.pop(0)
-                self.black=signatureset.SignatureSetText(strsig)
+                self.strsig=self.args.files.pop(0)
             else:
                 print "Missing signatures."
                 print "Try `idsgrep --help' for more information."
                 sys.exit(1)
+        self.black=self.load_black()
                   
         if self.args.asset_file:
-            self.asset=signatureset.SignatureSetFile(self.args.asset_file)
+            self.asset=signatureset.SignatureSetFile(self.args.asset_file,cachedir=self.args.tmpdir)
         elif self.args.asset_db:
-            self.asset=signatureset.SignatureSetMongoDb(self.args.asset_db,"sigdb","asset")
+            self.asset=signatureset.SignatureSetMongoDb(self.args.asset_db,"sigdb","asset",prefetch=self.args.prefetch,cachedir=self.args.tmpdir if self.args.snapshot else None)
         else:
             self.asset=None
   
-        self.black_search=matchingengine.FGrepMatchingEngine(self.black,min_fx=int(self.args.min_fx))        
+        self.timestamps,self.file_timestamps=timestamp.get_parsers(self.args.timestamp,self.args.files)
+        
+        if self.args.reload:
+            self.black_search=matchingengine.ReloadingMatchingEngine(self.black,self.load_black,self.make_black_search,interval=self.args.reload_interval)
+            signal.signal(signal.SIGHUP,lambda signum,frame:self.black_search.reload())
+        else:
+            self.black_search=self.make_black_search(self.black)
         if self.asset:
-            self.asset_search=matchingengine.MatchingEngine(self.asset)
+            if "FixedString" in self.asset.get_sig_types():
+                self.asset_search=matchingengine.MatchingEngine(self.asset)
+            else:
+                self.asset_search=matchingengine.TokenMatchingEngine(self.asset,cache_size=self.args.asset_cache)
+        
+        self.stats=None
+        if self.args.stats or self.args.stats_json:
+            self.stats=self.black_search.stats=stats.Stats()
+        
+        self.pool=None
+        if self.args.verify_processes>0:
+            if self.args.follow or self.args.reload or self.args.jobs>1:
+                logging.warning("--verify-processes is not used with --follow, --reload or --jobs")
+            else:
+                #Before any other thread is started, the processes are forked
+                self.pool=matchingengine.VerifyPool(self.black_search,self.args.verify_processes)
                 
-        if self.args.splunk:
-            self.start_splunk()
-        else:
-            self.start()
+        try:
+            if self.args.splunk:
+                self.start_splunk()
+            else:
+                self.start()
+        finally:
+            if self.pool:
+                self.pool.close()
+            if self.stats:
+                self.report_stats()
     
+    def load_black(self):
+        if self.args.black_file:        
+            return signatureset.SignatureSetFile(self.args.black_file,cachedir=self.args.tmpdir)
+        elif self.args.black_db:
+            return signatureset.SignatureSetMongoDb(self.args.black_db,"sigdb","black",prefetch=self.args.prefetch,cachedir=self.args.tmpdir if self.args.snapshot else None)
+        else:
+            return signatureset.SignatureSetText(self.strsig)
+            
+    def make_black_search(self,black):
+        guards=None
+        if self.args.quarantine:
+            guards=quarantine.Quarantine(self.args.quarantine_threshold,self.args.quarantine_window)
+        
+        engine=self.args.engine
+        if engine=="auto":
+            #The cost of the token engine does not grow with the number of signatures, but it can not find FixedString signatures
+            if "FixedString" in black.get_sig_types():
+                engine="grep"
+            else:
+                engine="token"
+        if engine=="token":
+            ignored=[option for option,used in [("--jobs",self.args.jobs>1),("--min-fx",self.args.min_fx!=guardcompiler.MIN_FX),("--guard-budget",self.args.guard_budget!=guardcompiler.GUARD_BUDGET),
+                ("--quarantine",self.args.quarantine),("--verify-cache",self.args.verify_cache>0)] if used]
+            if ignored:
+                logging.warning("The token engine ignores %s" % ", ".join(ignored))
+            return matchingengine.TokenMatchingEngine(black)
+        elif self.args.follow or self.args.reload: #grep can't tell where in the files a line is, the lines are searched one by one instead
+            return matchingengine.MatchingEngine(black,min_fx=self.args.min_fx,quarantine=guards,budget=self.args.guard_budget,verify_cache=self.args.verify_cache)
+        else:
+            return matchingengine.FGrepMatchingEngine(black,min_fx=self.args.min_fx,tmpdir=self.args.tmpdir,quarantine=guards,budget=self.args.guard_budget,verify_cache=self.args.verify_cache)        
+            
     def search(self):
-        for matches in self.black_search.findall_files(self.args.files):
-            victim=self.find_victim(matches[0].data)
-            yield alarm.Alarm(matches,victim)
+        if self.args.follow:
+            for path,matches in self.follow():
+                yield self.make_alarm(matches,self.file_timestamps.get(path))
+            return
+        for files,timestamps in self.group_files():
+            if self.pool:
+                found=self.pool.findall_batches(self.black_search.scan_batches(files))
+            else:
+                found=self.black_search.findall_files(files,jobs=self.args.jobs,ordered=not self.args.unordered)
+            for matches in found:
+                yield self.make_alarm(matches,timestamps)
+            
+    def group_files(self):
+        '''
+            Returns (files,timestamp parser) for the files in a row that has the same timestamp format. 
+            The engines don't tell which file a line is from, so each group is searched on its own. 
+        '''
+        if not self.file_timestamps:
+            return [(self.args.files,self.timestamps)]
+        get_parser=lambda path:self.file_timestamps.get(os.path.abspath(path),self.timestamps)
+        return [(list(files),timestamps) for timestamps,files in itertools.groupby(self.args.files,get_parser)]
+            
+    def make_alarm(self,matches,timestamps=None):
+        victim=self.find_victim_match(matches[0].data)
+        return alarm.Alarm(matches,victim.match() if victim else None,victim_match=victim,timestamps=timestamps or self.timestamps)
+            
+    def follow(self):
+        if not self.args.files:
+            raise ValueError("--follow needs files to follow")
+        checkpoint=self.args.checkpoint
+        if not checkpoint:
+            paths=sorted(os.path.abspath(path) for path in self.args.files)
+            checkpoint=os.path.join(self.args.tmpdir,"follow-%s.json" % hashlib.sha1("\n".join(paths)).hexdigest()[:16])
+        self.follower=follow.Follower(self.args.files,checkpoint)
+        for path,line in self.follower.lines(sources=True):
+            matches=self.black_search.findall(line)
+            if matches:
+                yield path,matches
             
     def find_victim(self,data):
-        #TODO find the most important victim, not the first
+        victim=self.find_victim_match(data)
+        if victim:
+            return victim.match()
+            
+    def find_victim_match(self,data):
         if not self.asset:
             return None
-        victims=self.asset_search.findall(data)
-        for v in victims:
-            return v.data[v.start:v.stop]      
+        return matchingengine.most_important(self.asset_search.findall(data))
             
     def start_splunk(self):       
         fieldnames=csv.DictReader(sys.stdin).fieldnames
@@ -173,18 +299,78 @@ class TibIDS(object):
         fieldnames.append("victim")
         print ",".join(fieldnames)
         for alarm in self.search():
+            start_time=time.time()
             for match in alarm.matches:                
                 print alarm.data + "," + ",".join([match.sig["sig"],str(match.sig["score"]),alarm.victim])                           
+            if self.stats:
+                self.stats.times["output"]+=time.time()-start_time
       
     def start(self):
-        for alarm in self.search():           
+        writer=None
+        if self.args.save_to_mongodb:
+            writer=alarm.AlarmWriter(alarm.conn["alarms"]["alarms"])
+        try:
+            if self.args.pipeline and (self.args.follow or self.args.jobs>1):
+                logging.warning("--pipeline is not used with --follow or --jobs")
+            elif self.args.pipeline:
+                self.start_pipeline(writer)
+                return
+            for a in self.search():           
+                self.output([a],writer)
+        finally:
+            if writer:
+                writer.close()
+                
+    def start_pipeline(self,writer):
+        """Same as start, with each step in its own stage of a pipeline.Pipeline"""
+        size=self.args.pipeline_queue
+        verify_batch=self.pool.verify_batch if self.pool else self.black_search.verify_batch
+        #The batches are passed on with the timestamp parser of their files
+        def scan_batches():
+            for files,timestamps in self.group_files():
+                for batch in self.black_search.scan_batches(files):
+                    yield timestamps,batch
+        def verify((timestamps,batch)):
+            return timestamps,verify_batch(batch)
+        def find_victims((timestamps,found)):
+            return [self.make_alarm(matches,timestamps) for n,matches in found]
+        stages=[
+            #One verify thread per process
+            pipeline.Stage("verify",verify,workers=self.pool.processes if self.pool else self.args.verify_workers,queue_size=size),
+            pipeline.Stage("victim",find_victims,queue_size=size),
+            pipeline.Stage("output",lambda alarms:self.output(alarms,writer),queue_size=size),
+        ]
+        search=pipeline.Pipeline(scan_batches(),stages)
+        try:
+            search.run()
+        finally:
+            if self.stats:
+                self.stats.stages=search.to_dict()
+            
+    def output(self,alarms,writer=None):
+        start_time=time.time()
+        for a in alarms:
             if not self.args.quiet:
                 if self.args.no_color:
-                    print alarm.data
+                    print a.data
                 else:
-                    print alarm.colors()
-            if self.args.save_to_mongodb:
-                alarm.save("alarms","alarms")                               
+                    print a.colors()
+            if writer:
+                writer.save(a)
+        if self.args.follow:
+            sys.stdout.flush()
+        if self.stats:
+            self.stats.times["output"]+=time.time()-start_time
+                
+    def report_stats(self):
+        if self.black_search.verify_cache is not None:
+            self.stats.add_cache("verify",self.black_search.verify_cache.stats())
+        if self.asset and getattr(self.asset_search,"cache",None) is not None:
+            self.stats.add_cache("asset",self.asset_search.cache.stats())
+        if self.args.stats:
+            sys.stderr.write(self.stats.report(self.args.stats_top) + "\n")
+        if self.args.stats_json:
+            self.stats.save(self.args.stats_json)
                 
      
 if __name__=="__main__":
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Bounded least recently used cache. Used where the same keys repeats a lot, for example
+    the tokens of a noisy IP-address that shows up in thousands of log lines.
+"""
+
+MISSING=object()
+
+class LRUCache(object):
+    '''
+        Dict like cache with at most maxsize entries. When the cache is full the least recently
+        used entry is removed.
+
+        The entries are kept in a circular doubly linked list of [prev,next,key,value] lists, so
+        both get and put is O(1). hits and misses counts the lookups done with get.
+    '''
+    def __init__(self,maxsize=10000):
+        self.maxsize=maxsize
+        self.hits=0
+        self.misses=0
+        self.clear()
+
+    def clear(self):
+        self.map={}
+        self.root=[]
+        self.root[:]=[self.root,self.root,None,None]
+
+    def __len__(self):
+        return len(self.map)
+
+    def __contains__(self,key):
+        return key in self.map
+
+    def get(self,key,default=None):
+        link=self.map.get(key)
+        if link is None:
+            self.misses+=1
+            return default
+        self.hits+=1
+        prev,next=link[0],link[1]
+        prev[1]=next
+        next[0]=prev
+        root=self.root
+        last=root[0]
+        last[1]=root[0]=link
+        link[0]=last
+        link[1]=root
+        return link[3]
+
+    def put(self,key,value):
+        if self.maxsize<=0:
+            return
+        link=self.map.get(key)
+        if link is not None:
+            link[3]=value
+            self.get(key)
+            self.hits-=1 #Only lookups done by the user are counted
+            return
+        root=self.root
+        if len(self.map)>=self.maxsize:
+            #Unlink the least recently used entry
+            oldest=root[1]
+            del self.map[oldest[2]]
+            root[1]=oldest[1]
+            oldest[1][0]=root
+        last=root[0]
+        link=[last,root,key,value]
+        last[1]=root[0]=self.map[key]=link
+
+    def __getitem__(self,key):
+        value=self.get(key,MISSING)
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    __setitem__=put
+
+    def stats(self):
+        return {"size":len(self.map),"maxsize":self.maxsize,"hits":self.hits,"misses":self.misses}
@@ -13,147 +13,863 @@ import atexit
 import os
 import signal
 import shutil
+import threading
+import Queue
+import itertools
+import collections
+import multiprocessing
+import time
 
 import ahocorasick
 
 import signature
+import sigindex
+import lrucache
+import stats
+import quarantine
+import guardcompiler
 
 logging.basicConfig(level=logging.DEBUG)
 
 MIN_FIXED_STRING_LENGHT=3
+#grep marks matches with MATCH_START and MATCH_STOP. GREP_COLORS is set explicitly 
+#so that the users own color settings can't change the markers.
+GREP_COLORS="ms=01;31:mc=01;31:sl=:cx=:ne"
+MATCH_START="\x1b[01;31m"
+MATCH_STOP="\x1b[m"
+RESULT_QUEUE_SIZE=1000 #Max number of unconsumed results buffered per file in parallel mode
+FIXEDSTRING_FILE_VERSION=3 #Increase when the fixed strings of the signatures changes, so older fixed string files are not used
+FX_BATCH_LINES=200 #Number of grep lines read before the signatures of their fixed strings are fetched
+RELOAD_INTERVAL=60.0 #Seconds between the checks of ReloadingMatchingEngine for a new signature version
+POOL_SIG_CACHE_SIZE=100000 #Number of signatures VerifyPool keeps to turn the results of the processes into matches
+TOKEN_TYPES=("IP","CIDR","IPRange","Domain") #Signature types that TokenMatchingEngine can find
+IP_TOKEN_re=re.compile(r"[0-9.]{1,16}") #The characters at a range match that sigindex.IPRangeIndex.match_at depends on
 
-class MatchingEngine(object):
-    def __init__(self,sigs,min_fx=MIN_FIXED_STRING_LENGHT):
+class BaseMatchingEngine(object):
+    """
+        Verifies fixed string matches against the signatures.
+        
+        CIDR and IPRange signatures are not verified one by one. Their fixed string is only a short
+        prefix like "10." that is shared by many signatures, so the IP-address at the match is 
+        instead looked up in a sigindex.IPRangeIndex.
+        
+        If stats is set to a stats.Stats the engine counts the candidates and matches per guard and
+        signature type in it, see --stats.
+        
+        With a quarantine.Quarantine the guards that overmatches are not verified anymore. Their
+        signatures are instead looked up in the indexes of TokenMatchingEngine, see --quarantine.
+        
+        The engines searches for the guards made by a guardcompiler.GuardCompiler. Short CIDR and
+        IPRange guards are widened into longer ones, that are mapped back with self.widened before
+        verification.
+        
+        With verify_cache the CIDR and IPRange signatures found for an IP-address are kept in a 
+        lrucache.LRUCache of that size, see match_at_cached.
+    """
+    def __init__(self,sigs,verify_cache=0):
         self.sigs=sigs
-        start_time=datetime.datetime.now()
-        self.tree = ahocorasick.KeywordTree()        
-        for fixedstring_sig in sigs.get_fixedstrings():
-            if fixedstring_sig>min_fx:
-                self.tree.add(fixedstring_sig)
-            else:
-                logging.warning("Ignoring signature %s because fixed string representation is less than % i " % (fixedstring_sig,min_fx))
-           
-        self.tree.make()
-        end_time=datetime.datetime.now()
-        logging.debug("Signature download and index build time" + str(end_time - start_time))
+        self.stats=None
+        self.stats_lock=threading.Lock() #The grep readers and verify threads merges their counters into self.stats
+        self.quarantine=None
+        self.quarantined=None #(IPRangeIndex,DomainIndex) with the signatures of the quarantined guards
+        self.quarantined_sigs=[]
+        self.widened={} #Widened guard: the fixed string it replaces, see widen_guards
+        self.shared=frozenset() #Widened guards that are the fixed strings of other signatures too
+        self.verify_cache=lrucache.LRUCache(verify_cache) if verify_cache else None
+        self.verify_lock=threading.Lock() #The verify threads of --jobs and --pipeline shares the cache
         
-    def findall(self,string):
+    def build_range_index(self,range_sigs=None):
+        if range_sigs is None:
+            range_sigs=self.sigs.get_range_sigs()
+        guards=self.quarantine.guards if self.quarantine is not None else ()
+        self.ranges=sigindex.IPRangeIndex(sig for sig in range_sigs if sig["fixedstring"] not in guards)
+        self.exact_sigs={} #Cache of the signatures per fixed string that are not in self.ranges
+        self.range_guards={} #Cache of is_range_guard
+        if self.verify_cache is not None:
+            self.verify_cache.clear()
+        logging.debug("Range index with %i signatures" % len(self.ranges))
+        
+    def widen_guards(self,min_fx,budget,weak=()):
+        """Creates self.compiler and widens the short range guards. Returns the range signatures."""
+        range_sigs=list(self.sigs.get_range_sigs())
+        self.compiler=guardcompiler.GuardCompiler(min_fx,budget)
+        self.widened=self.compiler.widen(range_sigs,weak)
+        #A widened guard can be the fixed string of another signature too, like 1.2.3.150 for 1.2.3.100-1.2.3.199 and the IP 1.2.3.150
+        self.sigs.prefetch_fx(self.widened)
+        self.shared=frozenset(guard for guard in self.widened if self.get_guard_sigs(guard))
+        return range_sigs
+        
+    def get_guard_sigs(self,fixedstring):
+        try:
+            return self.sigs.get_sigs_fx(fixedstring)
+        except signature.NoSig:
+            return []
+        
+    def unwiden(self,fixedstring_matches):
+        """
+            Replaces the widened guards in a list of (fixedstring,start,stop) with the fixed strings of their signatures. 
+            A widened guard that is the fixed string of other signatures as well is kept next to it, so they are verified too.
+        """
+        widened=self.widened
+        if not self.shared:
+            return [(widened.get(fixedstring,fixedstring),start,stop) for fixedstring,start,stop in fixedstring_matches]
+        found=[]
+        for fixedstring,start,stop in fixedstring_matches:
+            found.append((widened.get(fixedstring,fixedstring),start,stop))
+            if fixedstring in self.shared:
+                found.append((fixedstring,start,stop))
+        return found
+        
+    def init_quarantine(self,guards):
+        """Enables quarantine of overmatching guards, starting with the guards tuned by earlier runs"""
+        self.quarantine=guards
+        if guards is None:
+            return
+        if self.stats is None: #The guards are checked with the counters of verify
+            self.stats=stats.Stats()
+        tuned=self.sigs.get_tuned_fixedstrings()
+        if tuned:
+            self.quarantine_guards(tuned,save=False)
+            logging.debug("Starting with %i tuned guards in quarantine" % len(self.quarantine.guards))
+            
+    def quarantine_guards(self,fixedstrings,save=True):
+        """
+            Moves the signatures of the guards to self.quarantined and flags them as tuned in the signature set.
+            A guard with FixedString signatures can only be ignored, they can't be found without it.
+        """
+        with self.quarantine.lock:
+            moved=[]
+            for fixedstring in fixedstrings:
+                if fixedstring in self.quarantine.guards or fixedstring in self.quarantine.ignored:
+                    continue
+                try:
+                    sigs=self.sigs.get_sigs_fx(fixedstring)
+                except signature.NoSig:
+                    sigs=[]
+                if not sigs or any(sig["type"] not in TOKEN_TYPES for sig in sigs):
+                    logging.warning("Guard %s is overmatching, but it can't be quarantined" % fixedstring)
+                    self.quarantine.ignored.add(fixedstring)
+                    continue
+                if save:
+                    logging.warning("Guard %s is overmatching, %i signatures moved to quarantine" % (fixedstring,len(sigs)))
+                self.quarantine.guards.add(fixedstring)
+                moved.extend(sigs)
+            if not moved:
+                return
+            self.quarantined_sigs.extend(moved)
+            self.quarantined=(sigindex.IPRangeIndex(sig for sig in self.quarantined_sigs if sig["type"]!="Domain"),
+                sigindex.DomainIndex(sig for sig in self.quarantined_sigs if sig["type"]=="Domain"))
+            if any(sig["type"] in ("CIDR","IPRange") for sig in moved):
+                self.build_range_index()
+        if save:
+            self.sigs.set_tuned(moved)
+        
+    def get_exact_sigs(self,fixedstring):
+        try:
+            return self.exact_sigs[fixedstring]
+        except KeyError:
+            try:
+                sigs=[sig for sig in self.sigs.get_sigs_fx(fixedstring) if sig["type"] not in ("CIDR","IPRange")]
+            except signature.NoSig: #The fixed string file can be older than the signatures
+                sigs=[]
+            self.exact_sigs[fixedstring]=sigs
+            return sigs
+    
+    def is_range_guard(self,fixedstring):
+        """
+            True if fixedstring or a prefix of it is the guard of a range signature. grep and Aho-Corasick only
+            report the longest guard at a position, so the IP guard 10.1.2.3 hides the guard 10.1.2. of 10.1.2.0/24.
+        """
+        try:
+            return self.range_guards[fixedstring]
+        except KeyError:
+            fixedstrings=self.ranges.fixedstrings
+            found=any(fixedstring[:n] in fixedstrings for n in range(1,len(fixedstring)+1))
+            self.range_guards[fixedstring]=found
+            return found
+            
+    def verify(self,fixedstring_matches,data,stats=None):
+        """
+            Takes a list of (fixedstring,start,stop) found in data and returns a list of verified MatchObjects.
+            With stats every candidate is counted in it and the quarantined guards are skipped.
+        """
+        if stats is not None:
+            start_time=time.time()
+            quarantined=self.quarantine.guards if self.quarantine is not None else ()
         matches=[]
-        for start,stop in self.tree.findall(string):
-            match=string[start:stop]
-            for sig in self.sigs.get_sigs_fx(match):
+        range_found={} #Start of an address: whether the range index had signatures for it
+        for fixedstring,start,stop in fixedstring_matches:
+            if stats is not None:
+                if fixedstring in quarantined:
+                    continue
+                types={} #Signature type: whether the candidate matched a signature of the type
+            confirmed=False
+            if self.is_range_guard(fixedstring):
+                if start not in range_found: #Another guard at the same address has already checked the ranges
+                    if self.verify_cache is None:
+                        found=self.ranges.match_at(start,data)
+                    else:
+                        found=self.match_at_cached(start,data)
+                    matches.extend(found)
+                    range_found[start]=bool(found)
+                    if stats is not None:
+                        types["CIDR/IPRange"]=bool(found)
+                confirmed=range_found[start]
+            for sig in self.get_exact_sigs(fixedstring):
                 try:
-                    match=sig.verify_match(start,stop,string)
-                    matches.append(match)
-                    continue # TODO: If multiple signature different signature has the exact same match this might lead to problems.
+                    matches.append(sig.verify_match(start,stop,data))
+                    confirmed=True
+                    if stats is not None:
+                        types[sig["type"]]=True
                 except signature.NoMatch:
-                    pass
-                    #TODO: add handling for over matching. If a single sig is overmatching to much it should be disabled or tuned 
+                    if stats is not None:
+                        types.setdefault(sig["type"],False)
+            if stats is not None:
+                stats.count(fixedstring,confirmed,types)
+        if stats is None:
+            return matches
+        return self.count_line(fixedstring_matches,data,stats,matches,start_time)
+        
+    def count_line(self,fixedstring_matches,data,stats,matches,start_time):
+        """Adds the matches of the quarantined signatures and counts the line, for verify"""
+        if self.quarantined:
+            ranges,domains=self.quarantined
+            for match in ranges.findall(data)+domains.findall(data):
+                counters=stats.type(match.sig["type"])
+                counters[stats.CANDIDATES]+=1
+                counters[stats.CONFIRMED]+=1
+                matches.append(match)
+        stats.times["verify"]+=time.time()-start_time
+        if fixedstring_matches:
+            stats.lines+=1
+            if self.quarantine is not None and stats.lines%quarantine.CHECK_LINES==0:
+                self.quarantine_guards(self.quarantine.check(stats))
+        if matches:
+            stats.alarms+=1
         return matches
-      
+        
+    def match_at_cached(self,start,data):
+        """
+            Same as self.ranges.match_at, but the signatures found for an IP-address are kept in self.verify_cache, 
+            so an address that is found again is verified with one lookup.
+        """
+        if start>0 and data[start-1] in "0123456789":
+            return []
+        m=IP_TOKEN_re.match(data,start)
+        token=m.group() if m else ""
+        with self.verify_lock:
+            found=self.verify_cache.get(token)
+        if found is None:
+            found=tuple((match.stop,match.sig) for match in self.ranges.match_at(0,token))
+            with self.verify_lock:
+                self.verify_cache.put(token,found)
+        return [signature.MatchObject(start,start+length,data,sig) for length,sig in found]
 
     def findall_file (self,file=None):
-        def _linereader(file):
-            if not file:
-                for line in sys.stdin:
-                    yield line
-            else:
-                if file.endswith(".gz"):
-                    f=gzip.GzipFile(file)
-                else:
-                    f=open(file)                
-                for line in f:
-                    yield line
-        
-        for line in _linereader(file):
+        for line in read_lines(file):
             matches=self.findall(line)
             if matches:
                 yield matches
+
+    def findall_files(self,files="",stdin=None,jobs=1,ordered=True):
+        """
+            Same interface as FGrepMatchingEngine.findall_files. The files are read one by one in 
+            this process, stdin, jobs and ordered are ignored.
+        """
+        if not files:
+            return self.findall_file()
+        return itertools.chain.from_iterable(self.findall_file(file) for file in files)
+        
+    def scan_batches(self,files=""):
+        """
+            Yields the lines of files in batches of FX_BATCH_LINES, for the read stage of pipeline.Pipeline.
+            verify_batch finds the matches in a batch, together they do the same as findall_files.
+        """
+        lines=itertools.chain.from_iterable(read_lines(file) for file in (files or [None]))
+        while True:
+            batch=list(itertools.islice(lines,FX_BATCH_LINES))
+            if not batch:
+                break
+            yield batch
+            
+    def verify_batch(self,batch):
+        """Returns [(line number in batch,matches)] for the lines in a batch from scan_batches that has matches"""
+        return [(n,matches) for n,matches in enumerate(self.findall(line) for line in batch) if matches]
+        
+    def verify_compact(self,batch):
+        """
+            verify_batch for the processes of VerifyPool. Returns [(line number in batch,[(start,stop,signature)])] 
+            for the lines with matches, and the stats of the batch. The process only counts the batch, the 
+            parent merges the stats and does the quarantine checks.
+        """
+        parent_stats=self.stats
+        self.stats=parent_stats and parent_stats.__class__()
+        cache=self.verify_cache
+        if cache is not None:
+            hits,misses=cache.hits,cache.misses
+        try:
+            found=self.verify_batch(batch)
+            if self.stats and cache is not None: #The cache of the process is not seen by the parent
+                self.stats.add_cache("verify",dict(cache.stats(),hits=cache.hits-hits,misses=cache.misses-misses))
+            return [(n,[(m.start,m.stop,m.sig["sig"]) for m in matches]) for n,matches in found],self.stats
+        finally:
+            self.stats=parent_stats
+            
+    def merge_stats(self,stats):
+        """Adds the stats of a batch to self.stats. A batch is too small for the quarantine check in verify, the merged counters are checked instead."""
+        with self.stats_lock:
+            lines=self.stats.lines
+            self.stats.merge(stats)
+            if self.quarantine is not None and self.stats.lines/quarantine.CHECK_LINES>lines/quarantine.CHECK_LINES:
+                self.quarantine_guards(self.quarantine.check(self.stats))
            
 
-class FGrepMatchingEngine(object):
-    def __init__(self,sigs,min_fx=MIN_FIXED_STRING_LENGHT,tmpdir="/tmp/"):   
-        self.tmpdir=tmpdir
+class MatchingEngine(BaseMatchingEngine):
+    def __init__(self,sigs,min_fx=MIN_FIXED_STRING_LENGHT,quarantine=None,budget=guardcompiler.GUARD_BUDGET,verify_cache=0):
+        BaseMatchingEngine.__init__(self,sigs,verify_cache)
+        start_time=datetime.datetime.now()
+        self.init_quarantine(quarantine)
+        range_sigs=self.widen_guards(min_fx,budget)
+        self.tree = ahocorasick.KeywordTree()        
+        fixedstrings=sigs.get_fixedstrings()
+        if self.quarantine is not None: #Tuned by an earlier run, the signatures are found without the guard
+            fixedstrings=[fixedstring for fixedstring in fixedstrings if fixedstring not in self.quarantine.guards]
+        for guard in self.compiler.compile(fixedstrings,self.get_guard_sigs):
+            self.tree.add(guard)
+        self.tree.make()
+        self.build_range_index(range_sigs)
+        end_time=datetime.datetime.now()
+        logging.debug("Signature download and index build time" + str(end_time - start_time))
+        
+    def findall(self,string):
+        stats=self.stats
+        if stats is not None:
+            start_time=time.time()
+        fixedstring_matches=[(string[start:stop],start,stop) for start,stop in self.tree.findall(string)]
+        if self.widened:
+            fixedstring_matches=self.unwiden(fixedstring_matches)
+        if stats is not None:
+            stats.times["grep"]+=time.time()-start_time
+        return self.verify(fixedstring_matches,string,stats)
+      
+
+class IPRangeMatchingEngine(BaseMatchingEngine):
+    """
+        Finds CIDR and IPRange signatures without fixed strings. Every IPv4-address in the
+        logdata is looked up in the range index.
+    """
+    def __init__(self,sigs):
+        BaseMatchingEngine.__init__(self,sigs)
+        start_time=datetime.datetime.now()
+        self.build_range_index()
+        end_time=datetime.datetime.now()
+        logging.debug("Signature download and index build time" + str(end_time - start_time))
+        
+    def findall(self,string):
+        return self.ranges.findall(string)
+
+
+class TokenMatchingEngine(BaseMatchingEngine):
+    """
+        Finds IP, CIDR, IPRange and Domain signatures without fixed string guards.
+        
+        Each line is split into IPv4-address and hostname tokens in one pass. The addresses are looked
+        up in a sigindex.IPRangeIndex and the hostnames in a sigindex.DomainIndex, so the cost depends
+        on the number of tokens in a line and not on the number of signatures. 
+        FixedString signatures can't be found this way and are ignored.
+        
+        With cache_size the signatures found in each token are kept in a lrucache.LRUCache, so a
+        token that repeats in many lines, like the IP-address of a busy server, is only looked up once.
+    """
+    def __init__(self,sigs,cache_size=0):
+        BaseMatchingEngine.__init__(self,sigs)
+        self.cache=lrucache.LRUCache(cache_size) if cache_size else None
+        start_time=datetime.datetime.now()
+        ips=[]
+        domains=[]
+        for sig in sigs.get_sigs():
+            if sig["type"]=="Domain":
+                domains.append(sig)
+            elif sig["type"] in ("IP","CIDR","IPRange"):
+                ips.append(sig)
+            else:
+                logging.warning("Ignoring signature %s, %s signatures is not supported by TokenMatchingEngine" % (sig["sig"],sig["type"]))
+        self.ranges=sigindex.IPRangeIndex(ips)
+        self.domains=sigindex.DomainIndex(domains)
+        end_time=datetime.datetime.now()
+        logging.debug("Signature download and index build time" + str(end_time - start_time))
+        
+    def find_token(self,token):
+        """Returns (start,stop,sig) for each signature found in a hostname token, start and stop are offsets in token"""
+        found=[]
+        for m in sigindex.IPV4_re.finditer(token):
+            value=sigindex.ip2int(m.group())
+            if value is None:
+                continue
+            for sig in self.ranges.find(value):
+                found.append((m.start(),m.end(),sig))
+        found.extend(self.domains.find_token(token))
+        return tuple(found)
+        
+    def findall(self,string):
+        if self.stats is not None:
+            return self.findall_stats(string)
+        return self._findall(string)
+        
+    def _findall(self,string):
+        if self.cache is None:
+            matches=self.ranges.findall(string)+self.domains.findall(string)
+        else:
+            matches=[]
+            cache=self.cache
+            for m in sigindex.HOSTNAME_re.finditer(string):
+                token=m.group()
+                if "." not in token: #Neither an IP-address nor a domain
+                    continue
+                found=cache.get(token)
+                if found is None:
+                    found=self.find_token(token)
+                    cache.put(token,found)
+                offset=m.start()
+                for start,stop,sig in found:
+                    matches.append(signature.MatchObject(offset+start,offset+stop,string,sig))
+        matches.sort(key=lambda m:m.start)
+        return matches
+        
+    def findall_stats(self,string):
+        """There are no guards, only the confirmed matches per signature type and the time is counted"""
+        start_time=time.time()
+        matches=self._findall(string)
+        self.stats.times["verify"]+=time.time()-start_time
+        if matches:
+            self.stats.lines+=1
+            self.stats.alarms+=1
+            for match in matches:
+                counters=self.stats.type(match.sig["type"])
+                counters[stats.CANDIDATES]+=1
+                counters[stats.CONFIRMED]+=1
+        return matches
+        
+        
+class ReloadingMatchingEngine(BaseMatchingEngine):
+    """
+        Searches with the engine made by make_engine(sigs), and replaces it when the signature set changes.
+        
+        A thread checks sigs.get_version() every interval seconds, or at once when reload is called. 
+        When the version has changed and is the same at two checks in a row, so a file that is being 
+        written is not loaded, a new signature set is loaded with load_sigs() and a new engine is 
+        built in the thread. The engine is then swapped in between two lines, the search never waits 
+        for the build, but the old and the new engine are both in memory during it.
+        
+        Only findall is supported, findall_files reads the files line by line in this process.
+    """
+    def __init__(self,sigs,load_sigs,make_engine,interval=RELOAD_INTERVAL):
+        self.load_sigs=load_sigs
+        self.make_engine=make_engine
+        self.interval=interval
+        self.version=sigs.get_version()
         self.sigs=sigs
+        self.engine=make_engine(sigs)
+        self.reloads=0
+        self.running=True
+        self.wakeup=threading.Event()
+        self.thread=threading.Thread(target=self.run)
+        self.thread.daemon=True
+        self.thread.start()
+        
+    @property
+    def stats(self):
+        return self.engine.stats
+        
+    @stats.setter
+    def stats(self,value):
+        self.engine.stats=value
+        
+    @property
+    def verify_cache(self):
+        return self.engine.verify_cache
+        
+    def findall(self,string):
+        return self.engine.findall(string)
+        
+    def reload(self):
+        """Reload the signatures now, even if the version is unchanged. Is called on SIGHUP."""
+        self.wakeup.set()
+        
+    def run(self):
+        seen=self.version
+        while True:
+            self.wakeup.wait(self.interval)
+            if not self.running:
+                return
+            forced=self.wakeup.is_set()
+            self.wakeup.clear()
+            try:
+                version=self.sigs.get_version()
+                settled=version==seen
+                seen=version
+                if not forced and (version is None or version==self.version or not settled):
+                    continue
+                self.swap()
+            except Exception,e:
+                logging.exception("Reload of the signatures failed, the old signatures are used: %s" % e)
+                
+    def close(self):
+        """Stops the reload thread"""
+        self.running=False
+        self.wakeup.set()
+        self.thread.join()
+        
+    def swap(self):
+        start_time=datetime.datetime.now()
+        version=self.sigs.get_version()
+        sigs=self.load_sigs()
+        engine=self.make_engine(sigs)
+        engine.stats=self.engine.stats
+        self.sigs,self.engine,self.version=sigs,engine,version
+        self.reloads+=1
+        logging.info("Reloaded the signatures, version %s, in %s" % (version,datetime.datetime.now()-start_time))
+        
+
+class FGrepMatchingEngine(BaseMatchingEngine):
+    def __init__(self,sigs,min_fx=MIN_FIXED_STRING_LENGHT,tmpdir="/tmp/",quarantine=None,budget=guardcompiler.GUARD_BUDGET,verify_cache=0):   
+        self.tmpdir=tmpdir
+        BaseMatchingEngine.__init__(self,sigs,verify_cache)
         start_time=datetime.datetime.now()                        
-        self.sigfile=os.path.join(self.tmpdir,sigs.get_cache_filename())
+        #Quarantined guards stay in the guard file, grep must still pass on the lines with the quarantined signatures.
+        #They are widened when possible, so grep passes on fewer of them.
+        self.init_quarantine(quarantine)
+        range_sigs=self.widen_guards(min_fx,budget,self.quarantine.guards if self.quarantine is not None else ())
+        self.sigfile=os.path.join(self.tmpdir,sigs.get_cache_filename() + ".fx%i-%s" % (FIXEDSTRING_FILE_VERSION,self.compiler.key()))
         if not os.path.exists(self.sigfile):        
             logging.debug("No up-to-date fixedstring cache availabe, creating fixedstring signature set...")
             with open(self.sigfile + ".update","w+") as f:
-                for fixedstring_sig in sigs.get_fixedstrings():  
-                    if fixedstring_sig>min_fx:
-                         f.write(fixedstring_sig + "\n")
-                    else:
-                        logging.warning("Ignoring signature %s because fixed string representation is less than % i " % (fixedstring_sig,min_fx))
-                index_build_time=datetime.datetime.now()            
+                for guard in self.compiler.compile(sigs.get_fixedstrings(),self.get_guard_sigs):
+                    f.write(guard + "\n")
             shutil.move(self.sigfile + ".update", self.sigfile)
         else:
             logging.debug("Using %s for fixedstring cache" % self.sigfile)
+        self.build_range_index(range_sigs)
         end_time=datetime.datetime.now()
         logging.debug("Signature download and index build time" + str(end_time - start_time))
         
     def _read_results(self,p):
-        sig_re=re.compile("\x1b\[01;31m\x1b\[K(.*?)\x1b\[m\x1b\[K") # Grep output uses color matches, this will extract matches
-        for line in p.stdout:
-            noncolor="" #The line that has the match stripped, strippe 
-            grep_matches=[]
-            offset=0
-            for m in sig_re.finditer(line):
-                match=m.groups()[0]
-                noncolor+=line[offset:m.start()]
-                grep_matches.append((match,len(noncolor),len(noncolor)+len(match)))
-                noncolor+=match
-                offset=m.end()
-            noncolor+=line[offset:]
-
-            matches=[]
-            for match,start,stop in grep_matches:            
-                for sig in self.sigs.get_sigs_fx(match):
-                    try:
-                        match=sig.verify_match(start,stop,noncolor)
-                        matches.append(match)
-                        continue # TODO: If multiple signature different signature has the exact same match this might lead to problems.
-                    except signature.NoMatch:
-                        pass
-                        #TODO: add handling for over matching. If a single sig is overmatching to much it should be disabled or tuned 
-                
+        """
+            Reads the grep output FX_BATCH_LINES lines at a time. The fixed strings in a batch that
+            are not seen before are passed to sigs.prefetch_fx first, so a signature set in a database 
+            can fetch them with one query instead of one per fixed string.
+        """
+        #Each grep process counts in its own stats, they are merged into self.stats when it is done
+        stats=self.stats and self.stats.__class__()
+        try:
+            for batch in self._read_batches(p,stats):
+                for noncolor,grep_matches in batch:
+                    matches=self.verify(grep_matches,noncolor,stats)
+                    if matches:
+                        yield matches
+        finally:
+            if stats:
+                with self.stats_lock:
+                    self.stats.merge(stats)
+                    
+    def _read_batches(self,p,stats=None):
+        lines=iter(p.stdout)
+        while True:
+            start_time=time.time()
+            batch=[decode_grep_line(line) for line in itertools.islice(lines,FX_BATCH_LINES)]
+            if self.widened:
+                batch=[(noncolor,self.unwiden(grep_matches)) for noncolor,grep_matches in batch]
+            if stats:
+                stats.times["grep"]+=time.time()-start_time
+            if not batch:
+                break
+            new=set(fixedstring for noncolor,grep_matches in batch for fixedstring,start,stop in grep_matches if fixedstring not in self.exact_sigs)
+            if new:
+                self.sigs.prefetch_fx(new)
+            yield batch
+            
+    def scan_batches(self,files=""):
+        """
+            Yields the grep output for files in batches of (line,fixedstring matches), for the read 
+            stage of pipeline.Pipeline. The signatures of the fixed strings are prefetched.
+        """
+        self.p=self._grep(files)
+        stats=self.stats and self.stats.__class__()
+        try:
+            for batch in self._read_batches(self.p,stats):
+                yield batch
+        finally:
+            if stats:
+                with self.stats_lock:
+                    self.stats.merge(stats)
+            
+    def verify_batch(self,batch):
+        """Returns [(line number in batch,verified matches)] for the lines in a batch from scan_batches that has matches"""
+        stats=self.stats and self.stats.__class__()
+        found=[]
+        for n,(noncolor,grep_matches) in enumerate(batch):
+            matches=self.verify(grep_matches,noncolor,stats)
             if matches:
-                yield matches
+                found.append((n,matches))
+        if stats:
+            self.merge_stats(stats)
+        return found
         
-    def findall_files (self,files="",stdin=None):
+    def findall_files (self,files="",stdin=None,jobs=1,ordered=True):
         """
             Supply a list of filenames to zgrep.
             If files=None grep will read from stdin.
             If stdin=None no redirection will occur; the grep file handles will be inherited from the parent
             if stdin=subprocess.PIPE self.p.stdin can be used to write data to grep.
             
-            The cleanup and get_child_processes are needed to make sure that zgrep,gzip,grep etc are really killed.
+            If jobs>1 and there is more than one file, each file is searched by its own zgrep
+            process in a pool of jobs workers, see _findall_files_parallel.
         """
-        def cleanup():             
-            pids=get_child_processes(self.p.pid)
-            for pid in pids:
-                os.kill(pid,signal.SIGKILL)
-            
-        def get_child_processes(parent_pid):
-                ps_command = subprocess.Popen("ps -o pid --ppid %d --noheaders" % parent_pid, shell=True, stdout=subprocess.PIPE)
-                ps_output = ps_command.stdout.read()
-                children=[]
-                children.append(parent_pid)
-                for line in ps_output.split("\n"):
-                    if line:
-                        child=int(line)
-                        children.extend(get_child_processes(child))                
-                return children
-        
-        
-        #Search logfiles write alarms to tempfile
-        cmd="zgrep -h --color=always -F -f %s %s" % (self.sigfile," ".join(files))
-        args=shlex.split(cmd)
-        self.p = subprocess.Popen(args,stdout=subprocess.PIPE,stdin=stdin)        
-        atexit.register(cleanup)
+        if jobs>1 and files and len(files)>1:
+            return self._findall_files_parallel(files,jobs,ordered)
+        self.p=self._grep(files,stdin)
         return self._read_results(self.p)
 
+    def _grep(self,files,stdin=None):
+        """
+            Start zgrep on files with the fixedstring signatures.
+            
+            kill_process_tree is registered with atexit to make sure that zgrep,gzip,grep etc are really killed.
+        """
+        args=["zgrep","-h","--color=always","-F","-f",self.sigfile]
+        if files:
+            args.extend(files)
+        env=dict(os.environ,GREP_COLORS=GREP_COLORS)
+        env.pop("GREP_COLOR",None) #Deprecated, overrides the match color in GREP_COLORS
+        p = subprocess.Popen(args,stdout=subprocess.PIPE,stdin=stdin,env=env)
+        atexit.register(kill_process_tree,p.pid)
+        return p
+
+    def _findall_files_parallel(self,files,jobs,ordered=True):
+        """
+            Search each file with its own zgrep process using a pool of jobs worker threads.
+            Every worker verifies the output of its own grep process, so decompression and grep 
+            of different files runs on different cores.
+            
+            If ordered=True the matches are yielded in the order of files, otherwise they are 
+            yielded as soon as they are found.
+        """
+        DONE=object()
+        todo=Queue.Queue()
+        for i,file in enumerate(files):
+            todo.put((i,file))
+        if ordered:
+            results=[Queue.Queue(RESULT_QUEUE_SIZE) for file in files]
+        else:
+            results=[Queue.Queue(RESULT_QUEUE_SIZE)]*len(files)
+        
+        def worker():
+            while True:
+                try:
+                    i,file=todo.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    p=self._grep([file])
+                    for matches in self._read_results(p):
+                        results[i].put(matches)
+                    p.wait()
+                    results[i].put(DONE)
+                except Exception,e:
+                    results[i].put(e)
+        
+        for n in range(min(jobs,len(files))):
+            t=threading.Thread(target=worker)
+            t.daemon=True
+            t.start()
+        
+        def drain(queue,count):
+            #Yield matches from queue until count workers have reported DONE
+            while count:
+                item=queue.get()
+                if item is DONE:
+                    count-=1
+                elif isinstance(item,Exception):
+                    raise item
+                else:
+                    yield item
+        
+        if ordered:
+            for queue in results:
+                for matches in drain(queue,1):
+                    yield matches
+        else:
+            for matches in drain(results[0],len(files)):
+                yield matches
+        
+        
+_pool_engine=None #The engine of the VerifyPool processes, they get it when they are forked
+
+def _init_pool_process():
+    signal.signal(signal.SIGINT,signal.SIG_IGN) #Ctrl+C is handled by the parent
+
+def _verify_compact(batch):
+    return _pool_engine.verify_compact(batch)
+
+
+class VerifyPool(object):
+    """
+        Verifies the batches of engine.scan_batches in a pool of processes, so verify_match is not
+        limited to one core by the GIL. The processes are forked with a copy of the engine, and 
+        only the batches and the compact results of verify_compact are passed between them. The
+        matches are made from the results in this process, in the order of the batches.
+        
+        The signatures must be in memory before the fork, a SignatureSetMongoDb is prefetched. 
+        Guards quarantined while searching are only skipped by the processes in the next run.
+    """
+    def __init__(self,engine,processes):
+        global _pool_engine
+        if not getattr(engine.sigs,"prefetched",True):
+            logging.info("Prefetching the signatures for the verify processes")
+            engine.sigs.prefetch()
+        _pool_engine=engine
+        self.engine=engine
+        self.processes=processes
+        self.sigs=lrucache.LRUCache(POOL_SIG_CACHE_SIZE)
+        self.pool=multiprocessing.Pool(processes,_init_pool_process)
+        
+    def verify_batch(self,batch):
+        """Same as engine.verify_batch, for the verify stage of pipeline.Pipeline. Call it from processes threads to use all the processes."""
+        return self.matches(batch,self.pool.apply(_verify_compact,(batch,)))
+        
+    def findall_batches(self,batches):
+        """Yields the matches of each line in batches that has matches, in order"""
+        sent=collections.deque()
+        def send():
+            for batch in batches:
+                sent.append(batch)
+                yield batch
+        for result in self.pool.imap(_verify_compact,send()):
+            for n,matches in self.matches(sent.popleft(),result):
+                yield matches
+                
+    def matches(self,batch,result):
+        found,stats=result
+        if stats:
+            self.engine.merge_stats(stats)
+        matches=[]
+        for n,compact in found:
+            item=batch[n]
+            data=item if isinstance(item,basestring) else item[0]
+            matches.append((n,[signature.MatchObject(start,stop,data,self.get_sig(sig)) for start,stop,sig in compact]))
+        return matches
+        
+    def get_sig(self,strsig):
+        sig=self.sigs.get(strsig)
+        if sig is None:
+            try:
+                sig=self.engine.sigs.get_sig_str(strsig)
+            except signature.NoSig: #Not in the cache of the signature set any more
+                sig=signature.Signature.new(strsig)
+            self.sigs.put(strsig,sig)
+        return sig
+        
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        
+        
+def read_lines(file=None):
+    """Yields the lines of file, stdin if file is None. Files ending with .gz are decompressed."""
+    if not file:
+        for line in sys.stdin:
+            yield line
+        return
+    if file.endswith(".gz"):
+        f=gzip.GzipFile(file)
+    else:
+        f=open(file)
+    with f:
+        for line in f:
+            yield line
+
+def decode_grep_line(line):
+    """
+        Removes the grep color markers from line.
+        Returns the plain line and a list of (match,start,stop) with the offsets of the matches in the plain line.
+    """
+    parts=line.split(MATCH_START)
+    if len(parts)==1:
+        return line,[]
+    plain=[parts[0]]
+    offset=len(parts[0])
+    grep_matches=[]
+    for part in parts[1:]:
+        match,sep,rest=part.partition(MATCH_STOP)
+        grep_matches.append((match,offset,offset+len(match)))
+        plain.append(match)
+        plain.append(rest)
+        offset+=len(match)+len(rest)
+    return "".join(plain),grep_matches
+
+def most_important(matches):
+    """
+        Returns the most important of the matches, or None if there are no matches. The match with 
+        the highest score wins, then the most specific signature, where an IP is more specific than a
+        CIDR or IPRange, and then the first match in the line.
+    """
+    if len(matches)<2:
+        return matches[0] if matches else None
+    def rank(n_match):
+        n,match=n_match
+        sig=match.sig
+        start=sig.get("start")
+        width=sig["stop"]-start if start is not None else 0
+        return (-(sig.get("score") or 0),width,n)
+    return min(enumerate(matches),key=rank)[1]
+
+def kill_process_tree(pid):
+    for child in get_child_processes(pid):
+        try:
+            os.kill(child,signal.SIGKILL)
+        except OSError:
+            pass #Already exited
+        
+def get_child_processes(parent_pid):
+    ps_command = subprocess.Popen("ps -o pid --ppid %d --noheaders" % parent_pid, shell=True, stdout=subprocess.PIPE)
+    ps_output = ps_command.stdout.read()
+    children=[]
+    children.append(parent_pid)
+    for line in ps_output.split("\n"):
+        if line:
+            child=int(line)
+            children.extend(get_child_processes(child))                
+    return children
+
         
 if __name__=="__main__":
-    pass
+    #Benchmark decode_grep_line against the regex based decoding it replaced, on hit heavy lines
+    import time
+    def regex_decode(line):
+        sig_re=re.compile("\x1b\[01;31m(.*?)\x1b\[m")
+        noncolor=""
+        grep_matches=[]
+        offset=0
+        for m in sig_re.finditer(line):
+            match=m.groups()[0]
+            noncolor+=line[offset:m.start()]
+            grep_matches.append((match,len(noncolor),len(noncolor)+len(match)))
+            noncolor+=match
+            offset=m.end()
+        noncolor+=line[offset:]
+        return noncolor,grep_matches
+
+    hit="%s10.0.0.1%s" % (MATCH_START,MATCH_STOP)
+    lines=[" ".join(["2012-04-01 09:47:01 src=%s dst=%s" % (hit,hit)]*hits) + "\n" for hits in (1,5,20)]*10000
+    assert [regex_decode(line) for line in lines[:3]]==[decode_grep_line(line) for line in lines[:3]]
+
+    t=time.time()
+    for line in lines:
+        regex_decode(line)
+    regextime=time.time()-t
+    t=time.time()
+    for line in lines:
+        decode_grep_line(line)
+    decodetime=time.time()-t
+    print "regex: %.3fs decode_grep_line: %.3fs speedup: %.1fx" % (regextime,decodetime,regextime/decodetime)
     
\ No newline at end of file
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+import Queue
+import logging
+
+"""
+    Runs the search as a pipeline of stages in their own threads, for idsgrep --pipeline.
+
+    The source, like the grep output, is read by the first stage and every later stage takes the
+    batches of the stage before it from a bounded queue, works on them and passes the results on.
+    A slow stage only fills the queue in front of it, so the stages before it keep working until
+    the queue is full. A stage can have several workers, the batches are then put back in order
+    before the next stage.
+
+    Each stage counts the time it is busy, the time it waits for input, the time it is blocked
+    because the queue of the next stage is full, and the depth of its own queue. The stage with
+    the most busy time and a full queue is the bottleneck.
+"""
+
+PIPELINE_QUEUE_SIZE=50 #Max number of batches waiting in front of a stage
+DONE=object()
+
+class Stage(object):
+    def __init__(self,name,fn,workers=1,queue_size=PIPELINE_QUEUE_SIZE):
+        self.name=name
+        self.fn=fn #Called with each batch, returns the batch for the next stage
+        self.workers=workers
+        self.queue=Queue.Queue(queue_size)
+        self.next=None
+        self.ordered=False #True when the stage before it has several workers
+        self.pending={} #Batches that arrived before the batches in front of them, when ordered
+        self.next_seq=0
+        self.done=False
+        self.done_seq=None #The number of batches, sent with DONE
+        self.lock=threading.Lock()
+        self.running=workers
+        self.batches=0
+        self.busy=0.0
+        self.idle=0.0
+        self.blocked=0.0
+        self.depth_sum=0
+        self.depth_max=0
+
+    def get(self):
+        '''Returns the next (seq,batch), in order if the stage before has several workers'''
+        start_time=time.time()
+        depth=self.queue.qsize()
+        if not self.ordered:
+            item=self.queue.get()
+        else:
+            with self.lock:
+                while not self.done and self.next_seq not in self.pending:
+                    seq,batch=self.queue.get()
+                    self.pending[seq]=batch
+                if self.done:
+                    item=(None,DONE)
+                else:
+                    item=(self.next_seq,self.pending.pop(self.next_seq))
+                    self.next_seq+=1
+                    self.done=item[1] is DONE
+        with self.lock:
+            self.idle+=time.time()-start_time
+            self.depth_sum+=depth
+            self.depth_max=max(self.depth_max,depth)
+        return item
+
+    def put(self,seq,batch):
+        if self.next:
+            start_time=time.time()
+            self.next.queue.put((seq,batch))
+            with self.lock:
+                self.blocked+=time.time()-start_time
+
+    def run(self,pipeline):
+        try:
+            while True:
+                seq,batch=self.get()
+                if batch is DONE:
+                    if seq is not None:
+                        self.done_seq=seq
+                    break
+                start_time=time.time()
+                result=self.fn(batch)
+                with self.lock:
+                    self.busy+=time.time()-start_time
+                    self.batches+=1
+                self.put(seq,result)
+        except Exception,e:
+            logging.exception("Stage %s failed" % self.name)
+            pipeline.fail(e)
+            return
+        finally:
+            with self.lock:
+                self.running-=1
+                last=self.running==0
+        if not self.ordered:
+            self.queue.put((self.done_seq,DONE)) #For the other workers
+        if last:
+            self.put(self.done_seq,DONE)
+
+    def to_dict(self):
+        return {
+            "workers":self.workers,
+            "batches":self.batches,
+            "busy":self.busy,
+            "idle":self.idle,
+            "blocked":self.blocked,
+            "queue_avg":float(self.depth_sum)/self.batches if self.batches else 0.0,
+            "queue_max":self.depth_max,
+            "queue_size":self.queue.maxsize,
+        }
+
+
+class Pipeline(object):
+    '''
+        Reads source in its own thread and passes every item through stages. run waits until
+        every item has been through the last stage, or raises the error of a stage that failed.
+    '''
+    def __init__(self,source,stages):
+        self.source=Stage("read",None,queue_size=0) #Its queue is not used, it reads from source
+        self.source.items=source
+        self.stages=[self.source]+list(stages)
+        for stage,next in zip(self.stages,self.stages[1:]):
+            stage.next=next
+            next.ordered=stage.workers>1
+        self.finished=threading.Event()
+        self.error=None
+
+    def read(self):
+        seq=-1
+        try:
+            items=iter(self.source.items)
+            while True:
+                start_time=time.time()
+                try:
+                    batch=items.next()
+                except StopIteration:
+                    break
+                seq+=1
+                self.source.busy+=time.time()-start_time
+                self.source.batches+=1
+                self.source.put(seq,batch)
+        except Exception,e:
+            logging.exception("Stage read failed")
+            self.fail(e)
+            return
+        self.source.put(seq+1,DONE)
+
+    def fail(self,e):
+        if self.error is None:
+            self.error=e
+        self.finished.set()
+
+    def run(self):
+        threads=[threading.Thread(target=self.read)]
+        for stage in self.stages[1:]:
+            threads.extend(threading.Thread(target=stage.run,args=(self,)) for n in range(stage.workers))
+        last=self.stages[-1]
+        for t in threads:
+            t.daemon=True
+            t.start()
+        while last.running and not self.finished.is_set():
+            self.finished.wait(0.1) #A timeout, so Ctrl+C is not blocked
+        if self.error is not None:
+            raise self.error
+
+    def to_dict(self):
+        return dict((stage.name,stage.to_dict()) for stage in self.stages)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+import weakref
+
+from stats import CANDIDATES,CONFIRMED
+
+"""
+    Finds fixed string guards that overmatches, for example the guard 10. of 10.0.0.0/8 that is
+    found in every version number and timestamp. The matching engines moves the signatures of a
+    quarantined guard to the indexes of TokenMatchingEngine, that finds them without a guard, and
+    the signatures are flagged as tuned so the next run starts with the guard in quarantine.
+"""
+
+THRESHOLD=0.99 #Share of the candidates of a guard that must be rejected
+WINDOW=1000 #Number of candidates of a guard that the share is calculated on
+CHECK_LINES=1000 #The guards are checked every CHECK_LINES lines with candidates
+
+class Quarantine(object):
+    def __init__(self,threshold=THRESHOLD,window=WINDOW):
+        self.threshold=threshold
+        self.window=window
+        self.guards=set() #Quarantined fixed strings
+        self.ignored=set() #Overmatching fixed strings with signatures that can only be found with the guard
+        self.marks=weakref.WeakKeyDictionary() #stats.Stats: {fixedstring:(candidates,confirmed) at the start of the window}
+        self.lock=threading.Lock()
+
+    def check(self,stats):
+        '''
+            Returns the guards in stats that has got at least window candidates since the start of their
+            last window and where at least threshold of them was not confirmed. The guards that are
+            already quarantined or ignored are skipped.
+        '''
+        overmatching=[]
+        with self.lock:
+            marks=self.marks.setdefault(stats,{})
+            for fixedstring,counters in stats.guards.iteritems():
+                candidates,confirmed=marks.get(fixedstring,(0,0))
+                candidates=counters[CANDIDATES]-candidates
+                if candidates<self.window:
+                    continue
+                confirmed=counters[CONFIRMED]-confirmed
+                marks[fixedstring]=(counters[CANDIDATES],counters[CONFIRMED])
+                if candidates-confirmed>=self.threshold*candidates and fixedstring not in self.guards and fixedstring not in self.ignored:
+                    overmatching.append(fixedstring)
+        return overmatching
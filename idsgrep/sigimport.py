@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Imports signature feeds into the MongoDB blacklist.
+
+    The feed files are read as a stream, one signature per line with comments after ; or #, like
+    the files used with --black-file. The signatures are added with source as one of their sources,
+    see signatureset.SignatureSetMongoDb.import_sigs. Files ending with .gz are decompressed and -
+    reads from stdin:
+
+        python sigimport.py --db localhost --source feed1 --score 50 --tags c2,botnet feed1.txt
+"""
+
+import sys
+import time
+import gzip
+import logging
+import argparse
+
+import signatureset
+
+def read_sigs(paths):
+    '''Yields the signatures in the files, without comments and empty lines'''
+    for path in paths:
+        if path=="-":
+            f=sys.stdin
+        elif path.endswith(".gz"):
+            f=gzip.open(path)
+        else:
+            f=open(path)
+        try:
+            for line in f:
+                strsig=signatureset.parse_line(line)
+                if strsig:
+                    yield strsig
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+def run(sigset,paths,source,srcdata,batch_size=signatureset.IMPORT_BATCH_SIZE):
+    '''Imports the files into sigset, returns the counts of import_sigs with the seconds used and the rate'''
+    start_time=time.time()
+    counts=sigset.import_sigs(read_sigs(paths),source,srcdata,batch_size)
+    counts["seconds"]=time.time()-start_time
+    counts["sigs_per_s"]=counts["read"]/counts["seconds"] if counts["seconds"] else None
+    return counts
+
+def parse_args(argv=None):
+    parser=argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db',metavar="HOST",default=None,help='MongoDB host')
+    parser.add_argument('--collection',default="black",help='Signature collection in sigdb, black or asset')
+    parser.add_argument('--source',required=True,help='Name of the feed, the signatures get it as a source')
+    parser.add_argument('--score',type=int,default=50,help='Score of the source, 0-100')
+    parser.add_argument('--tags',default="",help='Comma separated tags')
+    parser.add_argument('--comment',default="",help='Comment about the feed, stored in sources.SOURCE.comment of each imported signature next to its tags and score')
+    parser.add_argument('--batch-size',metavar="NUM",type=int,default=signatureset.IMPORT_BATCH_SIZE,help='Number of signatures written in one bulk upsert')
+    parser.add_argument('files',nargs="+",help='Feed files, - for stdin')
+    return parser.parse_args(argv)
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args=parse_args()
+    srcdata={
+        "tags":[tag for tag in args.tags.split(",") if tag],
+        "score":args.score,
+        "comment":args.comment,
+    }
+    sigset=signatureset.SignatureSetMongoDb(args.db,"sigdb",args.collection)
+    counts=run(sigset,args.files,args.source,srcdata,args.batch_size)
+    print "Read %(read)i signatures in %(seconds).1fs, %(sigs_per_s).0f sigs/s: %(new)i new, %(updated)i updated, %(unchanged)i unchanged, %(failed)i failed" % dict(counts,sigs_per_s=counts["sigs_per_s"] or 0)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+
+import signature
+
+"""
+    Indexes that finds signatures directly from a token in the logdata, for example an IP-address,
+    instead of calling verify_match on every signature that shares the same fixed string.
+"""
+
+IPV4_re=re.compile(r"(?<![0-9])(?:[0-9]{1,3}\.){3}[0-9]{1,3}(?![0-9])")
+IPV4_exact_re=re.compile(r"(?:[0-9]{1,3}\.){3}[0-9]{1,3}(?![0-9])")
+
+def ip2int(ip):
+    '''Returns the integer value of a dotted IPv4-address, or None if it is not a valid address'''
+    value=0
+    for octet in ip.split("."):
+        if len(octet)>1 and octet[0]=="0": #Leading zeros are not a valid dotted quad
+            return None
+        octet=int(octet)
+        if octet>255:
+            return None
+        value=(value<<8)|octet
+    return value
+
+
+class IPRangeIndex(object):
+    '''
+        Finds the signatures with a start/stop range that contains an IPv4-address.
+
+        The ranges are stored in a centered interval tree. Each node holds the ranges that
+        contains its center sorted on start and on stop, so a lookup visits O(log n) nodes
+        and only touches the ranges that actually contains the address.
+    '''
+    def __init__(self,sigs):
+        self.fixedstrings=set()
+        items=[]
+        for n,sig in enumerate(sigs):
+            items.append((sig["start"],sig["stop"],n,sig))
+            self.fixedstrings.add(sig["fixedstring"])
+        self.size=len(items)
+        
+        self.centers=[]
+        self.lefts=[]
+        self.rights=[]
+        self.by_start=[] #Ranges in node sorted on start ascending
+        self.by_stop=[]  #Ranges in node sorted on stop descending
+        items.sort()
+        self.root=self._build(items)
+        
+    def _build(self,items):
+        if not items:
+            return -1
+        #The start of the median range is contained by at least that range, so every node is non-empty.
+        center=items[len(items)/2][0]
+        here=[]
+        lefts=[]
+        rights=[]
+        for item in items:
+            if item[1]<center:
+                lefts.append(item)
+            elif item[0]>center:
+                rights.append(item)
+            else:
+                here.append(item)
+        node=len(self.centers)
+        self.centers.append(center)
+        self.lefts.append(-1)
+        self.rights.append(-1)
+        self.by_start.append([(start,n,sig) for start,stop,n,sig in here])
+        self.by_stop.append(sorted(((stop,n,sig) for start,stop,n,sig in here),reverse=True))
+        self.lefts[node]=self._build(lefts)
+        self.rights[node]=self._build(rights)
+        return node
+
+    def __len__(self):
+        return self.size
+
+    def find(self,value):
+        '''Returns the signatures that contains the integer IP-address value, in the order they were added'''
+        found=[]
+        node=self.root
+        while node!=-1:
+            center=self.centers[node]
+            if value<center:
+                for start,n,sig in self.by_start[node]:
+                    if start>value:
+                        break
+                    found.append((n,sig))
+                node=self.lefts[node]
+            elif value>center:
+                for stop,n,sig in self.by_stop[node]:
+                    if stop<value:
+                        break
+                    found.append((n,sig))
+                node=self.rights[node]
+            else:
+                found.extend((n,sig) for start,n,sig in self.by_start[node])
+                break
+        if len(found)>1:
+            found.sort()
+        return tuple(sig for n,sig in found)
+
+    def match_at(self,start,data):
+        '''Returns a MatchObject for each signature that contains the IP-address starting at data[start]'''
+        if start>0 and data[start-1] in "0123456789":
+            return []
+        m=IPV4_exact_re.match(data,start)
+        if not m:
+            return []
+        value=ip2int(m.group())
+        if value is None:
+            return []
+        return [signature.MatchObject(start,m.end(),data,sig) for sig in self.find(value)]
+
+    def findall(self,data):
+        '''Returns a MatchObject for each signature that contains an IP-adress in data'''
+        matches=[]
+        for m in IPV4_re.finditer(data):
+            value=ip2int(m.group())
+            if value is None:
+                continue
+            for sig in self.find(value):
+                matches.append(signature.MatchObject(m.start(),m.end(),data,sig))
+        return matches
+
+
+HOSTNAME_re=re.compile(r"[A-Za-z0-9._-]+")
+ALNUM=frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789")
+
+class DomainIndex(object):
+    '''
+        Finds Domain signatures with hash lookups.
+
+        Domain.verify_match accepts a match that is surrounded by characters that are not letters
+        or digits, so evil.com matches www.evil.com and evil.com.au but not notevil.com. The same 
+        rule is used here: every span of a hostname token that starts and ends on a label 
+        boundary is looked up in a dict of the domains.
+    '''
+    def __init__(self,sigs):
+        self.domains={}
+        for sig in sigs:
+            self.domains.setdefault(sig["fixedstring"],[]).append(sig)
+
+    def __len__(self):
+        return len(self.domains)
+
+    def find(self,domain):
+        return self.domains.get(domain,())
+
+    def find_token(self,token):
+        '''Returns (start,stop,sig) for each Domain signature in a hostname token, start and stop are offsets in token'''
+        found=[]
+        if "." not in token:
+            return found
+        domains=self.domains
+        starts=[]
+        stops=[]
+        last=len(token)-1
+        for i,c in enumerate(token):
+            if c in ALNUM:
+                if i==0 or token[i-1] not in ALNUM:
+                    starts.append(i)
+                if i==last or token[i+1] not in ALNUM:
+                    stops.append(i+1)
+        for start in starts:
+            for stop in stops:
+                if stop<=start:
+                    continue
+                for sig in domains.get(token[start:stop],()):
+                    found.append((start,stop,sig))
+        return found
+
+    def findall(self,data):
+        '''Returns a MatchObject for each Domain signature found in data'''
+        matches=[]
+        for m in HOSTNAME_re.finditer(data):
+            offset=m.start()
+            for start,stop,sig in self.find_token(m.group()):
+                matches.append(signature.MatchObject(offset+start,offset+stop,data,sig))
+        return matches
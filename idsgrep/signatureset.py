@@ -13,17 +13,63 @@ import httplib2
 import base64
 import os
 import re
+import marshal
+import gc
+import shutil
+import threading
 
 import pymongo
 
 import signature
 import matchingengine
+import lrucache
+
+FX_CACHE_SIZE=100000 #Max number of fixed strings and signatures cached by SignatureSetMongoDb
+FX_BATCH_SIZE=1000 #Max number of fixed strings in one $in query
+META_ID=bson.binary.Binary(hashlib.sha224("config").digest()) #_id of the document in the meta collection with the lastupdate of the signatures
+ACTIVE={ "active":True, "white_conflict":False,"asset_conflict":False} #The signatures that are searched for
+IMPORT_BATCH_SIZE=1000 #Number of signatures classified and upserted together by import_sigs
+
+def parse_line(line):
+    '''Returns the signature of a line in a signature file, without comments after ; or #'''
+    return re.split("[;#]",line,1)[0].strip()
 
 class BaseSignatureSet(object):
     '''
         Represents a set of signatures.
         Fetches signatures from Mongodb. Is used by idsgrep          
     '''    
+    def prefetch_fx(self,fixedstrings):
+        """Hint that get_sigs_fx soon will be called for the fixed strings. Sets that are fully in memory ignores it."""
+        pass
+        
+    def get_scores(self,ids):
+        """Returns {_id:(score,update_time)} for the ids that are found"""
+        scores={}
+        for id in ids:
+            try:
+                sig=self.get_sig(id)
+            except signature.NoSig:
+                continue
+            scores[id]=(sig.get("score"),sig.get("update_time"))
+        return scores
+        
+    def get_scores_updated(self,since):
+        """Returns {_id:(score,update_time)} for the signatures updated after since"""
+        return {}
+        
+    def get_version(self):
+        """Returns a value that changes when the signatures changes, see matchingengine.ReloadingMatchingEngine"""
+        return None
+        
+    def get_tuned_fixedstrings(self):
+        """Returns the fixed strings that a matching engine has quarantined for overmatching"""
+        return set()
+        
+    def set_tuned(self,sigs):
+        """Flags the signatures of an overmatching guard as tuned, see quarantine.Quarantine"""
+        pass
+        
     def get_sig_str(self,strsig,create=False):
         try:
             return self.get_sig(bson.binary.Binary(hashlib.sha224(strsig).digest()))
@@ -33,49 +79,216 @@ class BaseSignatureSet(object):
             else:
                 raise
 
+def is_active(doc):
+    '''True if doc is a signature that is searched for, see ACTIVE'''
+    if any(doc.get(key)!=value for key,value in ACTIVE.iteritems()):
+        return False
+    return not doc.get("disable_time") or doc["disable_time"]>datetime.datetime.now()
+
 class SignatureSetMongoDb(BaseSignatureSet):
-    def __init__(self,host,db,collection):
+    '''
+        Signatures are fetched from MongoDB when they are needed and kept in bounded lrucache.LRUCaches.
+        Fixed strings without signatures are cached as well, so a fixed string that is not in the 
+        database is only looked up once.
+        
+        With prefetch=True all active signatures are loaded with one query instead, and no queries 
+        are done for fixed strings that are not found.
+        
+        With cachedir all active signatures are kept in a snapshot file in cachedir as well. At the 
+        next start only the documents with a newer update_time are fetched, see sync.
+    '''
+    SNAPSHOT_VERSION=1 #Increase when the format of the snapshot changes
+    
+    def __init__(self,host,db,collection,prefetch=False,cache_size=FX_CACHE_SIZE,cachedir=None):
         self.host=host
         self.db=db
         self.collection=collection
         self.conn=pymongo.Connection(host)
-        self.sigs={} #Cache of sigs accessible by signame
-        self.fxsigs={} #Cache of sigs accessible by fixed string representation
+        self.sigs=lrucache.LRUCache(cache_size) #Cache of sigs accessible by _id
+        self.fxsigs=lrucache.LRUCache(cache_size) #Cache of sigs accessible by fixed string representation, () if there are none
+        self.prefetched=False
+        self.lock=threading.Lock() #The caches are shared by the worker threads of the matching engines
+        self.snapshot=None
+        self.snapshot_version=None #Increased every time a sync changes the snapshot
+        if cachedir:
+            name=base64.b32encode(hashlib.sha224("%s/%s/%s" % (host,db,collection)).digest())
+            self.snapshot=os.path.join(cachedir,name + ".mongo")
+            self.sync()
+        elif prefetch:
+            self.prefetch()
    
     def get_sig(self,sig): 
-        try:
-            return self.sigs[sig]      
-        except KeyError:  
+        with self.lock:
+            cached=self.sigs.get(sig)
+            if cached is not None:
+                return cached
             doc=self.conn[self.db][self.collection].find_one({"_id":sig}) #Disabled sigs are not loaded initially, therefor check db.
             if doc:
                 sig=signature.Signature.new(sig=doc["sig"],sigtype=doc["type"],doc=doc)  
                 self.sigs[doc["_id"]]=sig
-                self.fxsigs.setdefault(doc["fixedstring"],[]).append(sig)
                 return sig
             else:
                 raise signature.NoSig
 
     def get_sigs_fx(self,fixedstring):
+        with self.lock:
+            sigs=self.fxsigs.get(fixedstring)
+            if sigs is None and not self.prefetched:
+                sigs=self._find_fx([fixedstring])[fixedstring]
+        if not sigs:
+            raise signature.NoSig
+        return sigs
+
+    def prefetch_fx(self,fixedstrings):
+        """Fetch the signatures of the fixed strings that are not cached with batched $in queries"""
+        if self.prefetched:
+            return
+        with self.lock:
+            missing=[fixedstring for fixedstring in set(fixedstrings) if fixedstring not in self.fxsigs]
+            for i in range(0,len(missing),FX_BATCH_SIZE):
+                self._find_fx(missing[i:i+FX_BATCH_SIZE])
+                
+    def _find_fx(self,fixedstrings):
+        found=dict((fixedstring,[]) for fixedstring in fixedstrings)
+        query=fixedstrings[0] if len(fixedstrings)==1 else {"$in":fixedstrings}
+        for doc in self.conn[self.db][self.collection].find({"fixedstring":query}):
+            sig=signature.Signature.new(sig=doc["sig"],sigtype=doc["type"],doc=doc)  
+            self.sigs[doc["_id"]]=sig
+            found[doc["fixedstring"]].append(sig)
+        for fixedstring,sigs in found.iteritems():
+            self.fxsigs[fixedstring]=sigs or ()
+        return found
+        
+    def get_scores(self,ids):
+        """Returns {_id:(score,update_time)} for the ids that are found, with batched $in queries that only reads the score"""
+        scores={}
+        ids=list(ids)
+        for i in range(0,len(ids),FX_BATCH_SIZE):
+            scores.update(self._find_scores({"_id":{"$in":ids[i:i+FX_BATCH_SIZE]}}))
+        return scores
+        
+    def get_scores_updated(self,since):
+        return self._find_scores({"update_time":{"$gt":since}})
+        
+    def _find_scores(self,filter):
+        return dict((doc["_id"],(doc.get("score"),doc.get("update_time"))) for doc in self.conn[self.db][self.collection].find(filter,["score","update_time"]))
+        
+    def prefetch(self,filter={ "active":True, "white_conflict":False,"asset_conflict":False}):
+        """Load all signatures matching filter with one query. The caches are replaced by dicts so nothing is evicted."""
+        start_time=datetime.datetime.now()
+        self.set_docs(self.conn[self.db][self.collection].find(filter))
+        logging.debug("Prefetched %i signatures in %s" % (len(self.sigs),datetime.datetime.now()-start_time))
+        
+    def set_docs(self,docs):
+        sigs={}
+        fxsigs={}
+        for doc in docs:
+            sig=signature.Signature.new(sig=doc["sig"],sigtype=doc["type"],doc=doc)  
+            sigs[doc["_id"]]=sig
+            fxsigs.setdefault(doc["fixedstring"],[]).append(sig)
+        with self.lock:
+            self.sigs=sigs
+            self.fxsigs=fxsigs
+            self.prefetched=True
+            
+    def sync(self):
+        """
+            Updates the snapshot with the documents that has got a newer update_time since the last sync,
+            and loads all signatures from it. save_sig sets update_time, so a signature that is changed, 
+            disabled or gets a conflict is fetched again. Signatures are also removed when their 
+            disable_time has passed. If the number of active documents in the collection then differs, 
+            documents are removed from it, and the whole snapshot is fetched again.
+        """
+        start_time=datetime.datetime.now()
+        collection=self.conn[self.db][self.collection]
+        docs,synced,self.snapshot_version=self.load_snapshot()
+        changed=0
+        if docs is not None:
+            for doc in collection.find({"update_time":{"$gte":synced}} if synced else {}):
+                synced=max(synced,doc.get("update_time"))
+                if is_active(doc):
+                    if doc["_id"] not in docs or docs[doc["_id"]].get("update_time")!=doc.get("update_time"): #The newest is fetched again by $gte
+                        docs[doc["_id"]]=doc
+                        changed+=1
+                elif docs.pop(doc["_id"],None) is not None:
+                    changed+=1
+        now=datetime.datetime.now()
+        if docs is not None:
+            for id,doc in docs.items():
+                if doc.get("disable_time") and doc["disable_time"]<=now:
+                    del docs[id]
+                    changed+=1
+        if docs is None or collection.find(dict(ACTIVE,disable_time={"$not":{"$lte":now}})).count()!=len(docs):
+            logging.info("Fetching all signatures of %s.%s for the snapshot" % (self.db,self.collection))
+            docs={}
+            for doc in collection.find(dict(ACTIVE,disable_time={"$not":{"$lte":now}})):
+                docs[doc["_id"]]=doc
+            synced=max([doc.get("update_time") for doc in docs.itervalues()] or [None])
+            changed=len(docs) or 1
+        if changed:
+            self.snapshot_version=(self.snapshot_version or 0)+1
+            self.save_snapshot(docs,synced)
+        self.set_docs(docs.itervalues())
+        logging.debug("Synced %i signatures with %i changes in %s" % (len(docs),changed,datetime.datetime.now()-start_time))
+        
+    def load_snapshot(self):
+        """Returns ({_id:doc},the newest update_time,snapshot_version) from the snapshot, or (None,None,None) if there is no usable snapshot"""
+        if not os.path.exists(self.snapshot):
+            return None,None,None
+        gc.disable()
         try:
-            return self.fxsigs[fixedstring]
-        except KeyError:       
-            docs=self.conn[self.db][self.collection].find({"fixedstring":fixedstring})
-            if docs:
-                for doc in docs:
-                    sig=signature.Signature.new(sig=doc["sig"],sigtype=doc["type"],doc=doc)  
-                    self.sigs[doc["_id"]]=sig
-                    self.fxsigs.setdefault(fixedstring,[]).append(sig)
-                return self.fxsigs[fixedstring]
-            else:
-                raise signature.NoSig               
+            with open(self.snapshot,"rb") as f:
+                version,synced,snapshot_version,rows=marshal.load(f)
+            if version!=self.SNAPSHOT_VERSION:
+                return None,None,None
+            docs={}
+            for row in rows:
+                doc=bson.BSON(row).decode()
+                docs[doc["_id"]]=doc
+            return docs,datetime.datetime.strptime(synced,"%Y-%m-%dT%H:%M:%S.%f") if synced else None,snapshot_version
+        except Exception,e:
+            logging.warning("Can't load signature snapshot %s: %s" % (self.snapshot,e))
+            return None,None,None
+        finally:
+            gc.enable()
+            
+    def save_snapshot(self,docs,synced):
+        try:
+            with open(self.snapshot + ".update","wb") as f:
+                rows=[bson.BSON.encode(doc) for doc in docs.itervalues()]
+                marshal.dump((self.SNAPSHOT_VERSION,synced.strftime("%Y-%m-%dT%H:%M:%S.%f") if synced else None,self.snapshot_version,rows),f)
+            shutil.move(self.snapshot + ".update",self.snapshot)
+        except (IOError,OSError),e:
+            logging.warning("Can't save signature snapshot %s: %s" % (self.snapshot,e))
+                
+    def get_version(self):
+        #The lastupdate of the meta document that save_sig updates
+        doc=self.conn[self.db]["meta"].find_one({"_id":META_ID},["lastupdate"])
+        return doc and doc.get("lastupdate")
+        
+    def get_tuned_fixedstrings(self,filter={ "active":True, "white_conflict":False,"asset_conflict":False}):
+        return self.get_fixedstrings(dict(filter,tuned=True))
+        
+    def set_tuned(self,sigs):
+        for sig in sigs:
+            sig["tuned"]=True
+        ids=[sig["_id"] for sig in sigs]
+        for i in range(0,len(ids),FX_BATCH_SIZE):
+            self.conn[self.db][self.collection].update({"_id":{"$in":ids[i:i+FX_BATCH_SIZE]}},{"$set":{"tuned":True}},multi=True)
                 
     def get_fixedstrings(self,filter={ "active":True, "white_conflict":False,"asset_conflict":False}):
+        if self.snapshot and filter==ACTIVE:
+            return set(self.fxsigs)
         fx=set()
         for doc in self.conn[self.db][self.collection].find(filter,["fixedstring"]):
             fx.add(doc["fixedstring"])
         return fx
         
     def get_sigs(self,filter={ "active":True, "white_conflict":False,"asset_conflict":False}):
+        if self.snapshot and filter==ACTIVE:
+            for sig in self.sigs.values():
+                yield sig
+            return
         for doc in self.conn[self.db][self.collection].find(filter):
             sig=signature.Signature.new(sig=doc["sig"],sigtype=doc["type"],doc=doc)  
             yield sig        
@@ -83,20 +296,94 @@ class SignatureSetMongoDb(BaseSignatureSet):
     def get_sigs_from_source(self,source):
         return self.get_sigs({"sources." + source:{"$exists":True}})
         
+    def get_sig_types(self,filter={ "active":True, "white_conflict":False,"asset_conflict":False}):
+        if self.snapshot and filter==ACTIVE:
+            return set(sig["type"] for sig in self.sigs.values())
+        return set(self.conn[self.db][self.collection].find(filter).distinct("type"))
+        
+    def get_range_sigs(self,filter={ "active":True, "white_conflict":False,"asset_conflict":False}):
+        if self.snapshot and filter==ACTIVE:
+            return [sig for sig in self.sigs.values() if sig["type"] in ("CIDR","IPRange")]
+        filter=dict(filter,type={"$in":["CIDR","IPRange"]})
+        return self.get_sigs(filter)
+        
     def save_sig(self,sig):
         sig.calc_score(self)
         sig["update_time"]=bson.datetime.datetime.now()
         try:
             self.conn[self.db][self.collection].save(sig.data)
-            self.conn[self.db]["meta"].update({"_id":bson.binary.Binary(hashlib.sha224("config").digest())},{"lastupdate":bson.datetime.datetime.now()})
+            self.conn[self.db]["meta"].update({"_id":META_ID},{"$set":{"lastupdate":bson.datetime.datetime.now()}},upsert=True)
             
         except bson.errors.InvalidStringData,e:
             logging.error("Failed to save sig:" + str(sig))
             logging.error(str(e))
 
+    def import_sigs(self,strsigs,source,srcdata,batch_size=IMPORT_BATCH_SIZE):
+        '''
+            Adds the signatures in the iterable strsigs from source, srcdata is the "sources" entry with 
+            tags, score and comment. Does the same as save_sig for each signature, but in batches: the 
+            signatures of a batch are classified together, the existing ones are fetched with one query 
+            so source is merged into their sources, and all are written with one unordered bulk upsert.
+            Signatures where source is unchanged are not written, so their update_time is kept. The 
+            lastupdate in meta is set once at the end. Returns {"read","new","updated","unchanged","failed"}.
+        '''
+        collection=self.conn[self.db][self.collection]
+        counts=dict(read=0,new=0,updated=0,unchanged=0,failed=0)
+        strsigs=iter(strsigs)
+        while True:
+            batch=list(itertools.islice(strsigs,batch_size))
+            if not batch:
+                break
+            counts["read"]+=len(batch)
+            sigs={}
+            for strsig,sigtype in itertools.izip(batch,signature.Signature.classify_many(batch)):
+                try:
+                    sig=signature.Signature.new(strsig,sigtype)
+                except Exception,e:
+                    logging.error("Failed to import sig %s: %s" % (strsig,e))
+                    counts["failed"]+=1
+                    continue
+                sigs[sig["_id"]]=sig
+            existing=dict((doc["_id"],doc) for doc in collection.find({"_id":{"$in":sigs.keys()}}))
+            now=bson.datetime.datetime.now()
+            bulk=None
+            written=0
+            for id,sig in sigs.iteritems():
+                if id in existing:
+                    if existing[id].get("sources",{}).get(source)==srcdata:
+                        counts["unchanged"]+=1
+                        continue
+                    sig=signature.Signature.new(sig=existing[id]["sig"],sigtype=existing[id]["type"],doc=existing[id])
+                    counts["updated"]+=1
+                else:
+                    counts["new"]+=1
+                sig["sources"][source]=dict(srcdata)
+                sig.calc_score(self)
+                sig["update_time"]=now
+                if bulk is None:
+                    bulk=collection.initialize_unordered_bulk_op()
+                bulk.find({"_id":id}).upsert().replace_one(sig.data)
+                written+=1
+            if bulk is not None:
+                try:
+                    bulk.execute()
+                except pymongo.errors.BulkWriteError,e:
+                    #Unordered, so the rest of the batch is written
+                    logging.error("Failed to save %i sigs: %s" % (len(e.details["writeErrors"]),str(e)))
+                    counts["failed"]+=len(e.details["writeErrors"])
+                except bson.errors.InvalidStringData,e:
+                    logging.error("Failed to save a batch of %i sigs: %s" % (written,str(e)))
+                    counts["failed"]+=written
+        if counts["new"] or counts["updated"]:
+            self.conn[self.db]["meta"].update({"_id":META_ID},{"$set":{"lastupdate":bson.datetime.datetime.now()}},upsert=True)
+        return counts
+    
     def get_cache_filename(self):
-        modtime=self.conn[self.db][self.collection].find_one({"_id":bson.binary.Binary(hashlib.sha224("conf").digest())},["lastupdate"])
-        hash=hashlib.sha224(str(modtime) + str(self.host)).digest()
+        if self.snapshot:
+            version="snapshot %s" % self.snapshot_version
+        else:
+            version=self.get_version()
+        hash=hashlib.sha224("%s %s/%s/%s" % (version,self.host,self.db,self.collection)).digest()
         return base64.b32encode(hash)
             
     def ensure_indexes(self):
@@ -106,33 +393,113 @@ class SignatureSetMongoDb(BaseSignatureSet):
 
     
 class SignatureSetFile(BaseSignatureSet):
-    def __init__(self,filepath):
-        self.sigs={} 
+    '''
+        Signatures parsed from a file with one signature per line.
+        The signatures are stored as signature.CompactSignature to keep the memory usage down for large sets.
+    '''
+    SNAPSHOT_VERSION=3 #Increase when the parsing or the Signature classes changes
+    
+    def __init__(self,filepath,cachedir=None):
+        self.sigs={} #Sigs accessible by the signature string
         self.fxsigs={}      
+        self.ids=None #Sigs accessible by _id, created on first use by get_sig
         self.filepath=filepath
-               
+        self.tuned=set()
+        self.tunedfile=None
+        
+        snapshot=None
+        if cachedir:
+            #The file can't hold the tuned flag, the tuned fixed strings are kept next to the snapshot instead
+            self.tunedfile=os.path.join(cachedir,self.get_cache_filename() + ".tuned")
+            if os.path.exists(self.tunedfile):
+                with open(self.tunedfile) as f:
+                    self.tuned=set(line.rstrip("\n") for line in f)
+            snapshot=os.path.join(cachedir,self.get_cache_filename() + ".sigs")
+            if self.load_snapshot(snapshot):
+                return
         with open(self.filepath) as fp:   
             self.parse_sigs(fp)
+        if snapshot:
+            self.save_snapshot(snapshot)
+    
+    def load_snapshot(self,snapshot):
+        """Load the parsed signatures from a snapshot made by save_snapshot. Returns False if there is no usable snapshot."""
+        if not os.path.exists(snapshot):
+            return False
+        start_time=datetime.datetime.now()
+        gc.disable() #The garbage collector would otherwise run many times while the objects are created
+        try:
+            with open(snapshot,"rb") as f:
+                version,rows=marshal.load(f)
+            if version==self.SNAPSHOT_VERSION:
+                for row in rows:
+                    self.add_sig(signature.CompactSignature(*row))
+        except Exception,e:
+            logging.warning("Can't load signature snapshot %s: %s" % (snapshot,e))
+            version=None
+        finally:
+            gc.enable()
+        if version!=self.SNAPSHOT_VERSION:
+            self.sigs={}
+            self.fxsigs={}
+            return False
+        logging.debug("Loaded %i signatures from %s in %s" % (len(self.sigs),snapshot,datetime.datetime.now()-start_time))
+        return True
+        
+    def save_snapshot(self,snapshot):
+        """Save the parsed signatures so the next run with the same unchanged signature file can skip parsing"""
+        try:
+            with open(snapshot + ".update","wb") as f:
+                rows=[(sig.sig,sig.type,sig.fixedstring,sig.start,sig.stop) for sig in self.sigs.itervalues()]
+                marshal.dump((self.SNAPSHOT_VERSION,rows),f)
+            shutil.move(snapshot + ".update",snapshot)
+        except (IOError,OSError),e:
+            logging.warning("Can't save signature snapshot %s: %s" % (snapshot,e))
             
     def parse_sigs(self,text):
-        for line in text:
-            strsig=self.parse_line(line)
-            if not strsig: continue
-            sig=signature.Signature.new(strsig)            
-            self.sigs[sig["_id"]]=sig
-            self.fxsigs.setdefault(sig["fixedstring"],[]).append(sig)
+        strsigs=[strsig for strsig in (self.parse_line(line) for line in text) if strsig]
+        for strsig,sigtype in itertools.izip(strsigs,signature.Signature.classify_many(strsigs)):
+            self.add_sig(signature.Signature.compact(strsig,sigtype))
+            
+    def add_sig(self,sig):
+        if sig.sig in self.sigs:
+            return
+        self.sigs[sig.sig]=sig
+        self.fxsigs.setdefault(sig.fixedstring,[]).append(sig)
     
     def parse_line(self,line):
-        return re.split("[;#]",line,1)[0].strip()
+        return parse_line(line)
+        
+    def get_version(self):
+        try:
+            return os.path.getmtime(self.filepath)
+        except OSError: #The file is being replaced
+            return None
         
     def get_cache_filename(self):
         modtime=str(os.path.getmtime(self.filepath))
         hash=hashlib.sha224(modtime + self.filepath).digest()
         return base64.b32encode(hash)
 
+    def get_tuned_fixedstrings(self):
+        return set(self.tuned)
+        
+    def set_tuned(self,sigs):
+        fixedstrings=set(sig["fixedstring"] for sig in sigs)-self.tuned
+        self.tuned.update(fixedstrings)
+        if self.tunedfile and fixedstrings:
+            try:
+                with open(self.tunedfile,"a") as f:
+                    for fixedstring in fixedstrings:
+                        f.write(fixedstring + "\n")
+            except (IOError,OSError),e:
+                logging.warning("Can't save tuned fixed strings %s: %s" % (self.tunedfile,e))
+        
     def get_sig(self,sig): 
+        if self.ids is None:
+            self.ids=dict((bson.binary.Binary(hashlib.sha224(s.sig).digest()),s) for s in self.sigs.itervalues())
         try:
-            return self.sigs[sig]      
+            return self.ids[sig]      
         except KeyError:  
             raise signature.NoSig
 
@@ -147,6 +514,12 @@ class SignatureSetFile(BaseSignatureSet):
 
     def get_sigs_from_source(self):
         return self.sigs.values()
+
+    def get_sig_types(self):
+        return set(sig["type"] for sig in self.sigs.values())
+
+    def get_range_sigs(self):
+        return [sig for sig in self.sigs.values() if sig.type in ("CIDR","IPRange")]
                
     def get_fixedstrings(self):
         sigs=set()
@@ -160,8 +533,14 @@ class SignatureSetText(SignatureSetFile):
         self.text=text
         self.sigs={} 
         self.fxsigs={}    
+        self.ids=None
+        self.tuned=set()
+        self.tunedfile=None
         self.parse_sigs(text.split("\n"))
         
+    def get_version(self):
+        return self.get_cache_filename()
+        
     def get_cache_filename(self):
         hash=hashlib.sha224(self.text).digest()
         return base64.b32encode(hash)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+
+"""
+    Counters for --stats. For each fixed string guard and each signature type it counts the
+    candidates the guard let through, the candidates confirmed by at least one signature and the
+    candidates rejected by verify_match, and it sums the time spent in grep, in verification and
+    in output. With --pipeline the counters of each pipeline.Stage are added as well, and so are
+    the hits and misses of the caches, to tune their size.
+"""
+
+CANDIDATES,CONFIRMED,REJECTED=0,1,2
+TIMERS=("grep","verify","output")
+STAGES=("read","verify","victim","output") #The order of the stages in the report
+
+class Stats(object):
+    CANDIDATES,CONFIRMED,REJECTED=CANDIDATES,CONFIRMED,REJECTED
+    
+    def __init__(self):
+        self.guards={} #Fixed string: [candidates,confirmed,rejected]
+        self.types={} #Signature type: [candidates,confirmed,rejected]
+        self.times=dict((timer,0.0) for timer in TIMERS)
+        self.lines=0 #Lines with at least one candidate
+        self.alarms=0 #Lines with at least one confirmed match
+        self.stages={} #Stage name: the counters of a pipeline.Stage
+        self.caches={} #Cache name: {"hits","misses","size","maxsize"}, see lrucache.LRUCache.stats
+
+    def guard(self,fixedstring):
+        try:
+            return self.guards[fixedstring]
+        except KeyError:
+            counters=self.guards[fixedstring]=[0,0,0]
+            return counters
+
+    def type(self,sigtype):
+        try:
+            return self.types[sigtype]
+        except KeyError:
+            counters=self.types[sigtype]=[0,0,0]
+            return counters
+
+    def count(self,fixedstring,confirmed,types):
+        '''
+            Counts one candidate of the guard fixedstring, confirmed if it gave at least one match. types is
+            {signature type: confirmed} for the types of the signatures the candidate was checked against.
+        '''
+        guard=self.guard(fixedstring)
+        guard[CANDIDATES]+=1
+        guard[CONFIRMED if confirmed else REJECTED]+=1
+        for sigtype,confirmed in types.iteritems():
+            counters=self.type(sigtype)
+            counters[CANDIDATES]+=1
+            counters[CONFIRMED if confirmed else REJECTED]+=1
+
+    def add_cache(self,name,counters):
+        '''Adds the hits and misses of a cache, the size is the largest of the caches added'''
+        mine=self.caches.setdefault(name,{"hits":0,"misses":0,"size":0,"maxsize":0})
+        mine["hits"]+=counters["hits"]
+        mine["misses"]+=counters["misses"]
+        mine["size"]=max(mine["size"],counters["size"])
+        mine["maxsize"]=max(mine["maxsize"],counters["maxsize"])
+
+    def merge(self,other):
+        '''Adds the counters of other, used to collect the stats of the worker threads'''
+        for fixedstring,counters in other.guards.iteritems():
+            mine=self.guard(fixedstring)
+            for i in (CANDIDATES,CONFIRMED,REJECTED):
+                mine[i]+=counters[i]
+        for sigtype,counters in other.types.iteritems():
+            mine=self.type(sigtype)
+            for i in (CANDIDATES,CONFIRMED,REJECTED):
+                mine[i]+=counters[i]
+        for timer,value in other.times.iteritems():
+            self.times[timer]+=value
+        for name,counters in other.caches.iteritems():
+            self.add_cache(name,counters)
+        self.lines+=other.lines
+        self.alarms+=other.alarms
+
+    def worst_guards(self,top=20):
+        '''Returns the top guards with most rejected candidates, and then most candidates that was not confirmed'''
+        return sorted(self.guards.iteritems(),key=lambda (fixedstring,c):(-c[REJECTED],-(c[CANDIDATES]-c[CONFIRMED]),fixedstring))[:top]
+
+    def report(self,top=20):
+        lines=[]
+        lines.append("Lines with candidates: %i, alarms: %i" % (self.lines,self.alarms))
+        lines.append("Time grep: %.2fs verify: %.2fs output: %.2fs" % tuple(self.times[timer] for timer in TIMERS))
+        if self.stages:
+            lines.append("%-8s %7s %8s %8s %8s %8s %6s %5s" % ("Stage","Workers","Batches","Busy","Idle","Blocked","Queue","Max"))
+            for name,stage in sorted(self.stages.iteritems(),key=lambda (name,stage):STAGES.index(name) if name in STAGES else len(STAGES)):
+                lines.append("%-8s %7i %8i %7.2fs %7.2fs %7.2fs %6.1f %5i" % (name,stage["workers"],stage["batches"],stage["busy"],stage["idle"],stage["blocked"],stage["queue_avg"],stage["queue_max"]))
+        for name,cache in sorted(self.caches.iteritems()):
+            lookups=cache["hits"]+cache["misses"]
+            lines.append("Cache %s: %i hits, %i misses, %.1f%% hit rate, %i of %i entries used" % (name,cache["hits"],cache["misses"],
+                100.0*cache["hits"]/lookups if lookups else 0.0,cache["size"],cache["maxsize"]))
+        lines.append("%-12s %10s %10s %10s" % ("Type","Candidates","Confirmed","Rejected"))
+        for sigtype,counters in sorted(self.types.iteritems()):
+            lines.append("%-12s %10i %10i %10i" % ((sigtype,)+tuple(counters)))
+        lines.append("Worst %i of %i guards:" % (min(top,len(self.guards)),len(self.guards)))
+        lines.append("%-30s %10s %10s %10s %9s" % ("Guard","Candidates","Confirmed","Rejected","Precision"))
+        for fixedstring,counters in self.worst_guards(top):
+            precision=100.0*counters[CONFIRMED]/counters[CANDIDATES] if counters[CANDIDATES] else 0.0
+            lines.append("%-30s %10i %10i %10i %8.1f%%" % ((repr(fixedstring)[1:-1][:30],)+tuple(counters)+(precision,)))
+        return "\n".join(lines)
+
+    def to_dict(self):
+        fields=("candidates","confirmed","rejected")
+        return {
+            "lines":self.lines,
+            "alarms":self.alarms,
+            "times":self.times,
+            "stages":self.stages,
+            "caches":self.caches,
+            "types":dict((sigtype,dict(zip(fields,counters))) for sigtype,counters in self.types.iteritems()),
+            "guards":dict((fixedstring,dict(zip(fields,counters))) for fixedstring,counters in self.guards.iteritems()),
+        }
+
+    def save(self,path):
+        with open(path,"w") as f:
+            json.dump(self.to_dict(),f,indent=1,sort_keys=True)
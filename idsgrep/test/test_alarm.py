@@ -0,0 +1,288 @@
+import unittest
+import threading
+import datetime
+import hashlib
+
+import bson
+
+from idsgrep import alarm
+from idsgrep import signature
+from idsgrep import signatureset
+
+class AlarmTest(unittest.TestCase):
+    def testColors(self):
+        data="  10.0.0.1 10.0.0.1x10a0b0c1 evil.com www.evil.com\n"
+        sigs=signatureset.SignatureSetText("10.0.0.1\n10.0.0.0/24\nevil.com")
+        matches=[signature.MatchObject(2,10,data,sigs.get_sig_str("10.0.0.1")),signature.MatchObject(2,10,data,sigs.get_sig_str("10.0.0.0/24")),
+            signature.MatchObject(42,50,data,sigs.get_sig_str("evil.com"))]
+        a=alarm.Alarm(matches,"evil.com",victim_match=signature.MatchObject(29,37,data,None))
+        self.assertEqual(a.colors(),"\x1b[31m10.0.0.1\x1b[39m 10.0.0.1x10a0b0c1 \x1b[32mevil.com\x1b[39m www.\x1b[31mevil.com\x1b[39m")
+        self.assertEqual(a.colors(False),data.strip())
+
+
+class FakeBulk(object):
+    def __init__(self,collection):
+        self.collection=collection
+        self.ops=[]
+
+    def find(self,query):
+        self.query=query
+        return self
+
+    def upsert(self):
+        return self
+
+    def replace_one(self,doc):
+        self.ops.append((self.query["_id"],doc))
+
+    def execute(self):
+        self.collection.started.set()
+        self.collection.release.wait()
+        for id,doc in self.ops:
+            bson.BSON.encode(doc) #Like pymongo, a doc that can't be encoded fails the whole batch
+        for id,doc in self.ops:
+            self.collection.docs[id]=doc
+        self.collection.batches.append(len(self.ops))
+        self.collection.flushed.set()
+
+
+class FakeCollection(object):
+    """Collection that only supports unordered bulk upserts. execute blocks until release is set."""
+    def __init__(self):
+        self.docs={}
+        self.batches=[]
+        self.started=threading.Event()
+        self.flushed=threading.Event()
+        self.release=threading.Event()
+        self.release.set()
+
+    def initialize_unordered_bulk_op(self):
+        return FakeBulk(self)
+
+    def save(self,doc):
+        bson.BSON.encode(doc)
+        self.docs[doc["_id"]]=doc
+
+
+class AlarmWriterTest(unittest.TestCase):
+    def alarm(self,data):
+        sig=signature.Signature.new("10.0.0.1")
+        sig["score"]=10
+        return alarm.Alarm([signature.MatchObject(0,8,data,sig)],None)
+
+    def testBatches(self):
+        collection=FakeCollection()
+        writer=alarm.AlarmWriter(collection,batch_size=3,flush_interval=60)
+        for i in range(7):
+            writer.save(self.alarm("10.0.0.1 line %i" % i))
+        writer.save(self.alarm("10.0.0.1 line 0"))
+        stats=writer.close()
+        self.assertEqual(collection.batches,[3,3,2])
+        self.assertEqual(len(collection.docs),7)
+        self.assertEqual((stats["saved"],stats["flushes"],stats["failed"]),(8,3,0))
+
+    def testInterval(self):
+        collection=FakeCollection()
+        writer=alarm.AlarmWriter(collection,batch_size=100,flush_interval=0.01)
+        writer.save(self.alarm("10.0.0.1 line"))
+        collection.flushed.wait(5)
+        self.assertEqual(collection.batches,[1])
+        writer.close()
+
+    def testBackpressure(self):
+        collection=FakeCollection()
+        collection.release.clear()
+        writer=alarm.AlarmWriter(collection,batch_size=1,flush_interval=60,queue_size=1)
+        writer.save(self.alarm("10.0.0.1 line 1"))
+        collection.started.wait(5) #The writer is stuck in the first flush
+        writer.save(self.alarm("10.0.0.1 line 2"))
+        saver=threading.Thread(target=writer.save,args=(self.alarm("10.0.0.1 line 3"),))
+        saver.start()
+        saver.join(0.1)
+        self.assertTrue(saver.is_alive())
+        collection.release.set()
+        saver.join(5)
+        self.assertFalse(saver.is_alive())
+        writer.close()
+        self.assertEqual(len(collection.docs),3)
+
+    def testInvalidData(self):
+        collection=FakeCollection()
+        writer=alarm.AlarmWriter(collection,batch_size=2,flush_interval=60)
+        writer.save(self.alarm("10.0.0.1 line \xff"))
+        writer.save(self.alarm("10.0.0.1 line 2"))
+        writer.save(self.alarm("10.0.0.1 line 3"))
+        stats=writer.close()
+        self.assertEqual(sorted(doc["data"] for doc in collection.docs.values()),["10.0.0.1 line 2","10.0.0.1 line 3"])
+        self.assertEqual((stats["saved"],stats["failed"]),(2,1))
+
+    def testStopped(self):
+        collection=FakeCollection()
+        collection.initialize_unordered_bulk_op=None #Not a MongoDB error, the writer thread stops
+        writer=alarm.AlarmWriter(collection,batch_size=1,flush_interval=60,queue_size=1)
+        writer.save(self.alarm("10.0.0.1 line 1"))
+        writer.thread.join(5)
+        self.assertRaises(alarm.AlarmWriterError,writer.save,self.alarm("10.0.0.1 line 2"))
+        self.assertRaises(alarm.AlarmWriterError,writer.close)
+
+class MemoryCollection(object):
+    """A collection in a list of dicts, with the queries and updates used by AlarmDb. Counts the round trips."""
+    def __init__(self):
+        self.docs=[]
+        self.round_trips=0
+
+    def matches(self,doc,query):
+        for key,value in query.items():
+            if isinstance(value,dict):
+                if "$gte" in value and not doc.get(key)>=value["$gte"]:
+                    return False
+                if "$in" in value and doc.get(key) not in value["$in"]:
+                    return False
+                if "$exists" in value and (key in doc)!=value["$exists"]:
+                    return False
+            elif doc.get(key)!=value:
+                return False
+        return True
+
+    def find(self,query={},fields=None):
+        self.round_trips+=1
+        return MemoryCursor([doc for doc in self.docs if self.matches(doc,query)])
+
+    def update(self,query,update,upsert=False):
+        self.round_trips+=1
+        self._update(query,update,upsert)
+
+    def _update(self,query,update,upsert=False):
+        for doc in self.docs:
+            if self.matches(doc,query):
+                break
+        else:
+            if not upsert:
+                return
+            doc={"_id":len(self.docs)}
+            doc.update(query)
+            self.docs.append(doc)
+        for key,value in update.get("$set",{}).items():
+            doc[key]=value
+        for key,value in update.get("$inc",{}).items():
+            field,sub=key.split(".")
+            doc.setdefault(field,{})
+            doc[field][sub]=doc[field].get(sub,0)+value
+
+    def initialize_unordered_bulk_op(self):
+        return MemoryBulk(self)
+
+
+class MemoryCursor(list):
+    def sort(self,key,direction):
+        return MemoryCursor(sorted(self,key=lambda doc:doc[key],reverse=direction<0))
+
+    def limit(self,n):
+        return MemoryCursor(self[:n])
+
+
+class MemoryBulk(object):
+    def __init__(self,collection):
+        self.collection=collection
+        self.ops=[]
+        self.is_upsert=False
+
+    def find(self,query):
+        self.query=query
+        self.is_upsert=False
+        return self
+
+    def upsert(self):
+        self.is_upsert=True
+        return self
+
+    def update(self,update):
+        self.ops.append((self.query,update,self.is_upsert))
+
+    def execute(self):
+        self.collection.round_trips+=1
+        for query,update,upsert in self.ops:
+            self.collection._update(query,update,upsert)
+
+
+class SigSet(signatureset.BaseSignatureSet):
+    def __init__(self,scores):
+        self.sigs={}
+        self.lookups=[]
+        for strsig,score in scores.items():
+            sig=signature.Signature.new(strsig)
+            sig["score"]=score
+            self.sigs[sig["_id"]]=sig
+
+    def get_sig(self,id):
+        try:
+            return self.sigs[id]
+        except KeyError:
+            raise signature.NoSig
+
+    def get_scores(self,ids):
+        ids=list(ids)
+        self.lookups.append(len(ids))
+        return signatureset.BaseSignatureSet.get_scores(self,ids)
+
+    def get_scores_updated(self,since):
+        return dict((id,(sig["score"],sig["update_time"])) for id,sig in self.sigs.items() if sig["update_time"]>since)
+
+
+class AlarmDbTest(unittest.TestCase):
+    def setUp(self):
+        self.conn=alarm.conn
+        self.db={"alarms":MemoryCollection(),"meta":MemoryCollection(),"alarms_agg_hour":MemoryCollection(),"alarms_agg_day":MemoryCollection()}
+        alarm.conn={"testdb":self.db}
+        self.evil=bson.Binary(hashlib.sha224("evil.com").digest())
+        self.ip=bson.Binary(hashlib.sha224("10.0.0.1").digest())
+        self.alarmdb=alarm.AlarmDb("testdb",SigSet({"evil.com":10,"10.0.0.1":20}))
+
+    def tearDown(self):
+        alarm.conn=self.conn
+
+    def add_alarms(self,alarms):
+        for n,(time,victim,sigs) in enumerate(alarms):
+            self.db["alarms"].docs.append({"_id":n,"time":time,"victim":victim,"sigs":sigs})
+
+    def testUpdateAggs(self):
+        day=datetime.datetime(2012,4,1)
+        self.add_alarms([(day.replace(hour=9,minute=i),"server",[self.evil]) for i in range(50)]+
+            [(day.replace(hour=10),"server",[self.evil,self.ip,self.ip]),(day.replace(hour=10),"laptop",[self.ip])])
+        self.alarmdb.update_aggs(None)
+        hour=dict(((doc["timebucket"].hour,doc["victim"]),doc) for doc in self.db["alarms_agg_hour"].docs)
+        self.assertEqual(sorted(hour),[(9,"server"),(10,"laptop"),(10,"server")])
+        self.assertEqual(hour[(9,"server")]["sigs"],{self.evil.encode("hex"):50})
+        self.assertEqual(hour[(10,"server")]["sigs"],{self.evil.encode("hex"):1,self.ip.encode("hex"):1})
+        self.assertEqual(hour[(9,"server")]["score"],40)
+        self.assertEqual(hour[(10,"laptop")]["score"],20)
+        [agg_day]=[doc for doc in self.db["alarms_agg_day"].docs if doc["victim"]=="server"]
+        self.assertEqual(agg_day["sigs"],{self.evil.encode("hex"):51,self.ip.encode("hex"):1})
+        #Reading the meta, the alarms and two bulk updates and one read per aggregate
+        self.assertEqual(self.db["alarms"].round_trips+self.db["alarms_agg_hour"].round_trips+self.db["alarms_agg_day"].round_trips,7)
+
+    def testScoreCache(self):
+        day=datetime.datetime(2012,4,1)
+        self.add_alarms([(day.replace(hour=h),victim,[self.evil,self.ip]) for h in range(24) for victim in ["a","b","c"]])
+        self.alarmdb.update_aggs(None)
+        self.assertEqual(self.alarmdb.sigset.lookups,[2])
+        self.assertEqual(self.db["alarms_agg_day"].docs[0]["score"],pow(40**2+80**2,0.5))
+        self.alarmdb.sigset.sigs[self.ip].update(score=0,update_time=datetime.datetime.now()+datetime.timedelta(seconds=1))
+        self.alarmdb.update_aggs(day)
+        self.assertEqual(self.db["alarms_agg_day"].docs[0]["score"],40)
+        self.assertEqual(self.alarmdb.sigset.lookups,[2])
+        self.assertRaises(signature.NoSig,self.alarmdb.scores.score,"00")
+
+    def testTouchedOnly(self):
+        old=datetime.datetime(2012,4,1,8)
+        self.db["alarms_agg_hour"].docs.append({"_id":"old","timebucket":old,"victim":"server","sigs":{self.evil.encode("hex"):1},"score":-1})
+        self.add_alarms([(datetime.datetime(2012,4,1,9),"server",[self.evil])])
+        self.alarmdb.update_aggs(old)
+        self.assertEqual(self.db["alarms_agg_hour"].docs[0]["score"],-1)
+        self.assertEqual(self.db["meta"].docs[0]["_id"],"last_agg_update")
+        self.add_alarms([(datetime.datetime.now(),"server",[self.evil])])
+        self.alarmdb.update_aggs(None)
+        self.assertEqual(len(self.db["meta"].docs),1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,27 @@
+import unittest
+import StringIO
+
+from idsgrep import benchmark
+from idsgrep import signatureset
+from idsgrep import matchingengine
+from idsgrep import signature
+
+class BenchmarkTest(unittest.TestCase):
+    def test_gen_sigs(self):
+        sigs=benchmark.gen_sigs(1000,"IP=1,CIDR=1,IPRange=1,Domain=1")
+        self.assertEqual(sigs,benchmark.gen_sigs(1000,"IP=1,CIDR=1,IPRange=1,Domain=1"))
+        self.assertEqual(len(sigs),1000)
+        for sig,sigtype,example in sigs:
+            self.assertEqual(signature.Signature.classify(sig),sigtype)
+            self.assertTrue(signature.Signature.new(sig).verify_match(0,len(example),example) if sigtype!="Domain" else example.endswith(sig))
+
+    def test_hit_rate(self):
+        sigs=benchmark.gen_sigs(500,"IP=1,CIDR=1,IPRange=1,Domain=1")
+        log=StringIO.StringIO()
+        hits=benchmark.gen_log(log,sigs,2000,0.05)
+        self.assertTrue(50<hits<150)
+        search=matchingengine.TokenMatchingEngine(signatureset.SignatureSetText("\n".join(sig for sig,sigtype,example in sigs)))
+        self.assertEqual(sum(1 for line in log.getvalue().splitlines() if search.findall(line)),hits)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+import tempfile
+import shutil
+import os
+
+from idsgrep import follow
+
+class FollowTest(unittest.TestCase):
+    def setUp(self):
+        self.dir=tempfile.mkdtemp()
+        self.path=os.path.join(self.dir,"fw.log")
+        self.checkpoint=os.path.join(self.dir,"checkpoint.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self,data,mode="a",path=None):
+        with open(path or self.path,mode) as f:
+            f.write(data)
+
+    def test_follow(self):
+        self.write("old\n")
+        follower=follow.Follower([self.path],self.checkpoint)
+        self.assertEqual(follower.poll(),[]) #Starts at the end
+        self.write("a\nb")
+        self.assertEqual(follower.poll(),["a\n"]) #b is not complete
+        self.write("\n")
+        self.assertEqual(follower.poll(),["b\n"])
+        #Truncated
+        self.write("c\n","w")
+        self.assertEqual(follower.poll(),["c\n"])
+        #Rotated, the rest of the old file is read first
+        self.write("d\n")
+        os.rename(self.path,self.path + ".1")
+        self.write("e\n")
+        self.assertEqual(follower.poll(),["d\n"])
+        self.assertEqual(follower.poll(),["e\n"])
+        #Created after the start
+        path=os.path.join(self.dir,"new.log")
+        follower=follow.Follower([path])
+        self.write("f\n",path=path)
+        self.assertEqual(follower.poll(),["f\n"])
+
+    def test_checkpoint(self):
+        self.write("a\n")
+        follower=follow.Follower([self.path],self.checkpoint)
+        self.write("b\n")
+        self.assertEqual(follower.poll(),["b\n"])
+        follower.save_checkpoint()
+        follower.close()
+        self.write("c\n")
+        follower=follow.Follower([self.path],self.checkpoint)
+        self.assertEqual(follower.poll(),["c\n"])
+        follower.save_checkpoint()
+        follower.close()
+        #Rotated while not running
+        self.write("d\n")
+        os.rename(self.path,self.path + ".1")
+        self.write("e\n","w")
+        follower=follow.Follower([self.path],self.checkpoint)
+        self.assertEqual(follower.poll_sources(),[(self.path,"d\n"),(self.path,"e\n")]) #The lines of the rotated file has the path it was followed as
+
+    def test_lines(self):
+        self.write("")
+        follower=follow.Follower([self.path],self.checkpoint,interval=0)
+        self.write("a\nb\n")
+        lines=follower.lines()
+        self.assertEqual(lines.next(),"a\n")
+        follower.stop()
+        self.assertEqual(list(lines),["b\n"])
+        #The checkpoint is saved when the lines are consumed
+        follower=follow.Follower([self.path],self.checkpoint)
+        self.write("c\n")
+        self.assertEqual(follower.poll(),["c\n"])
+
+if __name__ == '__main__':
+    unittest.main()
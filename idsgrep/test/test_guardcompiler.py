@@ -0,0 +1,54 @@
+import unittest
+import tempfile
+import shutil
+import os
+
+from idsgrep import signatureset
+from idsgrep import matchingengine
+from idsgrep import guardcompiler
+
+class GuardCompilerTest(unittest.TestCase):
+    def test_widen_range(self):
+        prefixes=guardcompiler.widen_range(10<<24,(11<<24)-1,5,1000)
+        self.assertEqual(len(prefixes),256)
+        self.assertTrue("10.0." in prefixes and "10.255." in prefixes)
+        #1.0. to 1.9. are too short and are widened one more octet
+        prefixes=guardcompiler.widen_range(1<<24,(1<<24)+(20<<16)-1,5,10000)
+        self.assertEqual(len(prefixes),10*256+10)
+        self.assertTrue("1.9.255." in prefixes and "1.10." in prefixes and "1.9." not in prefixes)
+        self.assertEqual(guardcompiler.widen_range(1<<24,(2<<24)-1,5,100),None)
+
+    def test_budget(self):
+        sigset=signatureset.SignatureSetText("10.0.0.0/8\n192.0.0.0/8\n1.0.0.0/8\n10.1.2.0/24\nab")
+        compiler=guardcompiler.GuardCompiler(5,budget=600)
+        widened=compiler.widen(sigset.get_range_sigs())
+        self.assertEqual(sorted(compiler.replaced),["10.","192."])
+        self.assertEqual(widened["10.200."],"10.")
+        guards=set(compiler.compile(sigset.get_fixedstrings(),sigset.get_sigs_fx))
+        self.assertEqual(len(guards),512+1)
+        self.assertTrue("10.1.2." in guards)
+        self.assertEqual(sorted(compiler.unselective),["1.","ab"])
+        self.assertEqual([sig["sig"] for sig in compiler.unselective["1."]],["1.0.0.0/8"])
+
+    def test_engine(self):
+        sigset=signatureset.SignatureSetText("10.0.0.0/8\nevil.com")
+        search=matchingengine.MatchingEngine(sigset,min_fx=5)
+        m=search.findall("src=10.1.2.3 version 10.5 host=evil.com")
+        self.assertEqual([(x.data[x.start:x.stop],x.sig["sig"]) for x in m],[("10.1.2.3","10.0.0.0/8"),("evil.com","evil.com")])
+    def test_shared_guard(self):
+        #1.2.3.100-1.2.3.199 is widened into 1.2.3.100 to 1.2.3.199, one of them is the fixed string of an IP signature
+        sigset=signatureset.SignatureSetText("1.2.3.100-1.2.3.199\n1.2.3.150")
+        tmpdir=tempfile.mkdtemp()
+        try:
+            logfile=os.path.join(tmpdir,"fw.log")
+            with open(logfile,"w") as f:
+                f.write("src=1.2.3.150\nsrc=1.2.3.151\n")
+            for search in [matchingengine.MatchingEngine(sigset,min_fx=9),matchingengine.FGrepMatchingEngine(sigset,min_fx=9,tmpdir=tmpdir)]:
+                self.assertEqual(search.widened["1.2.3.150"],"1.2.3.1")
+                found=[sorted(m.sig["sig"] for m in matches) for matches in search.findall_files([logfile])]
+                self.assertEqual(found,[["1.2.3.100-1.2.3.199","1.2.3.150"],["1.2.3.100-1.2.3.199"]])
+        finally:
+            shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+
+from idsgrep import lrucache
+
+class LRUCacheTest(unittest.TestCase):
+    def test_evict(self):
+        cache=lrucache.LRUCache(2)
+        cache.put("a",1)
+        cache.put("b",2)
+        self.assertEqual(cache.get("a"),1)
+        cache.put("c",3) #b is the least recently used
+        self.assertEqual(len(cache),2)
+        self.assertTrue("b" not in cache)
+        self.assertEqual(cache["a"],1)
+        self.assertEqual(cache["c"],3)
+        self.assertRaises(KeyError,lambda:cache["b"])
+
+    def test_update(self):
+        cache=lrucache.LRUCache(2)
+        cache["a"]=1
+        cache["b"]=2
+        cache["a"]=10 #Updating makes a the most recently used
+        cache["c"]=3
+        self.assertEqual(sorted(cache.map),["a","c"])
+        self.assertEqual(cache.get("a"),10)
+
+    def test_stats(self):
+        cache=lrucache.LRUCache(10)
+        cache.put("a",None)
+        cache.get("a")
+        cache.get("b")
+        self.assertEqual(cache.stats(),{"size":1,"maxsize":10,"hits":1,"misses":1})
+
+    def test_disabled(self):
+        cache=lrucache.LRUCache(0)
+        cache.put("a",1)
+        self.assertEqual(len(cache),0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,10 +2,15 @@ import unittest
 import tempfile
 import datetime
 import subprocess
+import os
+import time
+import shutil
 
 from idsgrep import signatureset
 from idsgrep import matchingengine
 from idsgrep import signature
+from idsgrep import stats
+from idsgrep import quarantine
 
 class MatchingEngineTest(unittest.TestCase):
 
@@ -28,6 +33,76 @@ class MatchingEngineTest(unittest.TestCase):
         self.assertEqual(m.data[m.start:m.stop],"evil.com")
         
         
+class IPRangeMatchingEngineTest(unittest.TestCase):
+    def testCIDR(self):
+        sigset=signatureset.SignatureSetText("192.168.1.0/24\n10.0.0.0-10.0.0.10\nevil.com")
+        search=matchingengine.IPRangeMatchingEngine(sigset)
+        data="asdf 192.168.1.1 10.0.0.11 evil.com"
+        self.assertEqual([m.data[m.start:m.stop] for m in search.findall(data)],["192.168.1.1"])
+        
+
+class TokenMatchingEngineTest(unittest.TestCase):
+    def testTokens(self):
+        sigset=signatureset.SignatureSetText("192.168.1.0/24\n10.0.0.1\nevil.com")
+        search=matchingengine.TokenMatchingEngine(sigset)
+        data="asdf www.evil.com 192.168.1.1 10.0.0.11 notevil.com 10.0.0.1"
+        self.assertEqual([m.data[m.start:m.stop] for m in search.findall(data)],["evil.com","192.168.1.1","10.0.0.1"])
+
+    def testCache(self):
+        sigset=signatureset.SignatureSetText("192.168.1.0/24\n10.0.0.1\nevil.com")
+        search=matchingengine.TokenMatchingEngine(sigset)
+        cached=matchingengine.TokenMatchingEngine(sigset,cache_size=2)
+        for data in ["asdf www.evil.com 192.168.1.1 10.0.0.11 notevil.com 10.0.0.1","10.0.0.1:80->192.168.1.1/evil.com","10.0.0.1"]:
+            self.assertEqual(cached.findall(data),search.findall(data))
+        self.assertEqual(cached.findall("10.0.0.1"),search.findall("10.0.0.1"))
+        self.assertEqual(cached.cache.hits,2)
+
+    def testMostImportant(self):
+        sigset=signatureset.SignatureSetText("192.168.0.0/16\n192.168.1.0/24\nserver.com")
+        search=matchingengine.TokenMatchingEngine(sigset)
+        self.assertEqual(matchingengine.most_important(search.findall("10.0.0.1")),None)
+        victim=matchingengine.most_important(search.findall("192.168.2.1 192.168.1.1"))
+        self.assertEqual((victim.match(),victim.sig["sig"]),("192.168.1.1","192.168.1.0/24"))
+        self.assertEqual(matchingengine.most_important(search.findall("192.168.1.1 server.com")).match(),"server.com")
+        sigset.get_sig_str("192.168.0.0/16")["score"]=50
+        victim=matchingengine.most_important(search.findall("192.168.2.1 192.168.1.1 server.com"))
+        self.assertEqual((victim.match(),victim.sig["sig"]),("192.168.2.1","192.168.0.0/16"))
+
+    def testFiles(self):
+        sigset=signatureset.SignatureSetText("evil.com.")              
+        search=matchingengine.TokenMatchingEngine(sigset)               
+        data=tempfile.NamedTemporaryFile(delete=False)
+        data.write("asdf evil.com asdf\nasdf\n")
+        data.close()
+        matches=list(search.findall_files([data.name,data.name]))
+        self.assertEqual([m[0].data[m[0].start:m[0].stop] for m in matches],["evil.com","evil.com"])
+        
+        
+    def testParity(self):
+        #The token and grep engines must find the same matches, except for the intended differences
+        sigset=signatureset.SignatureSetText("10.0.0.0/8\n10.1.2.0/24\n10.1.2.3\n1.2.3.4\n2.3.4.5\n192.168.1.1\n172.16.0.0-172.16.0.255\nevil.com\nbad.org")
+        lines=["710.1.2.3 x","xevil.com","10.1.2.3","a10.1.2.3","src=192.168.1.11","x 192.168.1.1","172.16.0.9:80","1.2.3.45",
+            "sub.evil.com","evil.com.au","evil.community","bad.org/x 10.200.1.1","a 1.2.3.4.5 b","0.1.2.3.4"]
+        #Overlapping addresses, the token engine takes 0.1.2.3 as the address. Neither engine finds 2.3.4.5 in 1.2.3.4.5
+        differences={"0.1.2.3.4":([("1.2.3.4","1.2.3.4")],[])}
+        tmpdir=tempfile.mkdtemp()
+        try:
+            logfile=os.path.join(tmpdir,"fw.log")
+            with open(logfile,"w") as f:
+                f.write("\n".join(lines)+"\n")
+            found=[]
+            for search in [matchingengine.FGrepMatchingEngine(sigset,tmpdir=tmpdir),matchingengine.MatchingEngine(sigset),matchingengine.TokenMatchingEngine(sigset)]:
+                lookup=dict((matches[0].data.rstrip("\n"),sorted((m.data[m.start:m.stop],m.sig["sig"]) for m in matches)) for matches in search.findall_files([logfile]))
+                found.append([lookup.get(line,[]) for line in lines])
+            grep,ac,token=found
+            self.assertEqual(ac,grep)
+            for line,grep_matches,token_matches in zip(lines,grep,token):
+                self.assertEqual((grep_matches,token_matches),differences.get(line,(grep_matches,grep_matches)),line)
+            self.assertEqual(dict(zip(lines,grep))["10.1.2.3"],[("10.1.2.3","10.0.0.0/8"),("10.1.2.3","10.1.2.0/24"),("10.1.2.3","10.1.2.3")])
+            self.assertEqual(dict(zip(lines,grep))["a 1.2.3.4.5 b"],[("1.2.3.4","1.2.3.4")])
+        finally:
+            shutil.rmtree(tmpdir)
+
 class FGrepMatchingEngineTest(unittest.TestCase):
     def testDomain(self):
         sigset=signatureset.SignatureSetText("evil.com.")              
@@ -47,6 +122,140 @@ class FGrepMatchingEngineTest(unittest.TestCase):
         m=matches.next()[0] 
         self.assertEqual(m.data[m.start:m.stop],"evil.com")
 
+    def testParallel(self):
+        sigset=signatureset.SignatureSetText("evil.com.")              
+        search=matchingengine.FGrepMatchingEngine(sigset)
+        files=[]
+        for i in range(4):
+            data=tempfile.NamedTemporaryFile(delete=False)
+            data.write("file%i evil.com asdf\nasdf\n" % i)
+            data.close()
+            files.append(data.name)
+        lines=[matches[0].data for matches in search.findall_files(files,jobs=2)]
+        self.assertEqual(lines,["file%i evil.com asdf\n" % i for i in range(4)])
+        lines=[matches[0].data for matches in search.findall_files(files,jobs=2,ordered=False)]
+        self.assertEqual(sorted(lines),["file%i evil.com asdf\n" % i for i in range(4)])
+
+    def testCIDRSharedPrefix(self):
+        sigset=signatureset.SignatureSetText("10.0.0.0/8\n10.1.0.0/16\n10.1.2.0/24")              
+        search=matchingengine.FGrepMatchingEngine(sigset)               
+        data=tempfile.NamedTemporaryFile(delete=False)
+        data.write("asdf 10.1.2.3 110.1.2.3 10.1.3.1\n")
+        data.close()
+        matches=search.findall_files([data.name]).next()
+        self.assertEqual(sorted((m.data[m.start:m.stop],m.sig["sig"]) for m in matches),
+            [("10.1.2.3","10.0.0.0/8"),("10.1.2.3","10.1.0.0/16"),("10.1.2.3","10.1.2.0/24"),("10.1.3.1","10.0.0.0/8"),("10.1.3.1","10.1.0.0/16")])
+
+    def testDecodeGrepLine(self):
+        line="a %sevil.com%s b %s10.0.0.1%s\n" % ((matchingengine.MATCH_START,matchingengine.MATCH_STOP)*2)
+        data,grep_matches=matchingengine.decode_grep_line(line)
+        self.assertEqual(data,"a evil.com b 10.0.0.1\n")
+        self.assertEqual(grep_matches,[("evil.com",2,10),("10.0.0.1",13,21)])
+        for match,start,stop in grep_matches:
+            self.assertEqual(data[start:stop],match)
+
+
+
+class ReloadingMatchingEngineTest(unittest.TestCase):
+    def testReload(self):
+        sigfile=tempfile.NamedTemporaryFile(delete=False)
+        sigfile.write("evil.com\n")
+        sigfile.close()
+        load=lambda:signatureset.SignatureSetFile(sigfile.name)
+        search=matchingengine.ReloadingMatchingEngine(load(),load,matchingengine.TokenMatchingEngine,interval=0.01)
+        self.assertEqual(len(search.findall("10.0.0.1 evil.com")),1)
+        with open(sigfile.name,"w") as f:
+            f.write("evil.com\n10.0.0.1\n")
+        os.utime(sigfile.name,(0,0))
+        for n in range(500):
+            if search.reloads:
+                break
+            time.sleep(0.01)
+        self.assertEqual(search.reloads,1)
+        self.assertEqual([m.match() for m in search.findall("10.0.0.1 evil.com")],["10.0.0.1","evil.com"])
+        search.close()
+        os.remove(sigfile.name)
+        
+    def testSIGHUP(self):
+        sigset=signatureset.SignatureSetText("evil.com")
+        search=matchingengine.ReloadingMatchingEngine(sigset,lambda:sigset,matchingengine.TokenMatchingEngine,interval=60)
+        engine=search.engine
+        search.reload()
+        for n in range(500):
+            if search.reloads:
+                break
+            time.sleep(0.01)
+        self.assertTrue(search.engine is not engine)
+        search.close()
+
+
+class VerifyPoolTest(unittest.TestCase):
+    def testPool(self):
+        tmpdir=tempfile.mkdtemp()
+        logfile=os.path.join(tmpdir,"fw.log")
+        with open(logfile,"w") as f:
+            for n in range(1000):
+                f.write("line %i src=10.0.%i.%i version 10.0.%i.999 host=%s\n" % (n,n%3,n%256,n%3,"evil.com" if n%7==0 else "evil.community"))
+        sigset=signatureset.SignatureSetText("10.0.1.0/24\nevil.com")
+        try:
+            for search in [matchingengine.FGrepMatchingEngine(sigset,tmpdir=tmpdir),matchingengine.MatchingEngine(sigset)]:
+                expected=[[(m.start,m.stop,m.data,m.sig["sig"]) for m in matches] for matches in search.findall_files([logfile])]
+                search.stats=stats.Stats()
+                pool=matchingengine.VerifyPool(search,2)
+                try:
+                    found=[[(m.start,m.stop,m.data,m.sig["sig"]) for m in matches] for matches in pool.findall_batches(search.scan_batches([logfile]))]
+                    self.assertEqual(found,expected)
+                    self.assertEqual(search.stats.alarms,len(expected))
+                    self.assertEqual(search.stats.guard("evil.com"),[1000,143,857])
+                    batch=list(search.scan_batches([logfile]))[0]
+                    self.assertEqual(pool.verify_batch(batch),search.verify_batch(batch))
+                finally:
+                    pool.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testRepeatedLine(self):
+        #The same line object twice in a batch must give the matches of both lines
+        line="src=10.0.1.5 host=evil.com"
+        search=matchingengine.MatchingEngine(signatureset.SignatureSetText("10.0.1.0/24\nevil.com"))
+        found,stats=search.verify_compact([line,"host=good.com",line])
+        self.assertEqual([n for n,compact in found],[0,2])
+        self.assertEqual(found[0][1],found[1][1])
+
+
+class EngineStateTest(unittest.TestCase):
+    def testInstanceState(self):
+        #The black and the asset engines must not share their guards, quarantine or counters
+        black=matchingengine.MatchingEngine(signatureset.SignatureSetText("10.0.0.0/8\nevil.com"),min_fx=5,quarantine=quarantine.Quarantine())
+        asset=matchingengine.TokenMatchingEngine(signatureset.SignatureSetText("10.1.0.0/16\ngood.com"))
+        black.quarantine_guards(["evil.com"],save=False)
+        self.assertEqual(black.widened["10.200."],"10.")
+        self.assertEqual(asset.widened,{})
+        self.assertEqual([sig["sig"] for sig in black.quarantined_sigs],["evil.com"])
+        self.assertEqual((asset.quarantine,asset.quarantined,asset.quarantined_sigs),(None,None,[]))
+        self.assertTrue(asset.stats_lock is not black.stats_lock)
+
+
+class VerifyCacheTest(unittest.TestCase):
+    def testCache(self):
+        sigset=signatureset.SignatureSetText("10.0.1.0/24\n10.0.0.0-10.0.255.255\n10.0.2.7\nevil.com\n/evil.php")
+        lines=["src=10.0.1.5 host=www.evil.com","110.0.1.5 notevil.com","10.0.2.7x a10.0.2.77 x10.0.1.1.5",
+            "-evil.com 10.0.1.5:80 GET /evil.php","evil.community 10.0.1.5 /evil.php?x"]*3
+        search=matchingengine.MatchingEngine(sigset)
+        cached=matchingengine.MatchingEngine(sigset,verify_cache=100)
+        search.stats=stats.Stats()
+        cached.stats=stats.Stats()
+        for line in lines:
+            self.assertEqual(cached.findall(line),search.findall(line))
+        self.assertEqual(cached.stats.guards,search.stats.guards)
+        self.assertEqual(cached.stats.types,search.stats.types)
+        self.assertEqual(cached.stats.alarms,search.stats.alarms)
+        self.assertTrue(cached.verify_cache.hits>cached.verify_cache.misses)
+        self.assertEqual(cached.verify_cache.misses,len(cached.verify_cache)) #Each address is only looked up once
+        #The cached signatures depends on the range index
+        cached.build_range_index()
+        self.assertEqual(len(cached.verify_cache),0)
+
         
 if __name__ == '__main__':
-    unittest.main()    
\ No newline at end of file
+    unittest.main()    
\ No newline at end of file
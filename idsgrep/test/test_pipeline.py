@@ -0,0 +1,67 @@
+import unittest
+import tempfile
+import shutil
+import random
+import time
+import os
+
+from idsgrep import pipeline
+from idsgrep import signatureset
+from idsgrep import matchingengine
+
+class PipelineTest(unittest.TestCase):
+    def test_order(self):
+        out=[]
+        def slow(batch):
+            time.sleep(random.random()*0.01)
+            return [x*2 for x in batch]
+        stages=[
+            pipeline.Stage("verify",slow,workers=4,queue_size=5),
+            pipeline.Stage("output",out.extend,queue_size=5),
+        ]
+        p=pipeline.Pipeline(([n] for n in range(100)),stages)
+        p.run()
+        self.assertEqual(out,[n*2 for n in range(100)])
+        counters=p.to_dict()
+        self.assertEqual(counters["verify"]["batches"],100)
+        self.assertEqual(counters["output"]["batches"],100)
+        self.assertTrue(counters["output"]["queue_max"]<=5)
+
+    def test_slow_sink(self):
+        stages=[pipeline.Stage("output",lambda batch:time.sleep(0.01),queue_size=2)]
+        p=pipeline.Pipeline(([n] for n in range(20)),stages)
+        p.run()
+        counters=p.to_dict()
+        #The reader waits for the full queue in front of the sink, not the other way around
+        self.assertTrue(counters["read"]["blocked"]>counters["output"]["idle"])
+        self.assertEqual(counters["output"]["queue_max"],2)
+
+    def test_error(self):
+        def fail(batch):
+            raise ValueError(batch)
+        p=pipeline.Pipeline([[1],[2]],[pipeline.Stage("verify",fail)])
+        self.assertRaises(ValueError,p.run)
+
+    def test_engines(self):
+        tmpdir=tempfile.mkdtemp()
+        try:
+            logfile=os.path.join(tmpdir,"fw.log")
+            with open(logfile,"w") as f:
+                for n in range(500):
+                    f.write("line %i src=10.0.%i.%i host=%s\n" % (n,n%3,n%256,"evil.com" if n%7==0 else "good.com"))
+            sigset=signatureset.SignatureSetText("10.0.1.0/24\nevil.com")
+            for search in [matchingengine.MatchingEngine(sigset),matchingengine.FGrepMatchingEngine(sigset,tmpdir=tmpdir)]:
+                expected=[[m.data[m.start:m.stop] for m in matches] for matches in search.findall_files([logfile])]
+                found=[]
+                stages=[
+                    pipeline.Stage("verify",search.verify_batch,workers=3),
+                    pipeline.Stage("output",lambda batch:found.extend([m.data[m.start:m.stop] for m in matches] for n,matches in batch)),
+                ]
+                pipeline.Pipeline(search.scan_batches([logfile]),stages).run()
+                self.assertEqual(found,expected)
+                self.assertEqual(len(found),500/3+500/7-500/21+1)
+        finally:
+            shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    unittest.main()
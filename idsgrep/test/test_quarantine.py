@@ -0,0 +1,37 @@
+import unittest
+
+from idsgrep import signatureset
+from idsgrep import matchingengine
+from idsgrep import quarantine
+from idsgrep import stats
+
+class QuarantineTest(unittest.TestCase):
+    def test_check(self):
+        guards=quarantine.Quarantine(threshold=0.9,window=10)
+        s=stats.Stats()
+        s.guard("10.")[stats.CANDIDATES]+=9
+        self.assertEqual(guards.check(s),[]) #The window is not full
+        s.guard("10.")[stats.CANDIDATES]+=1
+        s.guard("evil.com")[stats.CANDIDATES]+=10
+        s.guard("evil.com")[stats.CONFIRMED]+=5
+        self.assertEqual(guards.check(s),["10."])
+        #A new window starts after each check
+        s.guard("evil.com")[stats.CANDIDATES]+=10
+        self.assertEqual(guards.check(s),["evil.com"])
+
+    def test_engine(self):
+        sigset=signatureset.SignatureSetText("10.0.0.0/8\nevil.com")
+        search=matchingengine.MatchingEngine(sigset,quarantine=quarantine.Quarantine(window=100))
+        for n in range(quarantine.CHECK_LINES):
+            self.assertEqual(search.findall("version 10.%i build" % n),[])
+        self.assertEqual(search.quarantine.guards,set(["10."]))
+        self.assertEqual(sigset.get_tuned_fixedstrings(),set(["10."]))
+        found=search.findall("src=10.1.2.3 host=www.evil.com")
+        self.assertEqual(sorted(m.data[m.start:m.stop] for m in found),["10.1.2.3","evil.com"])
+        #The next run starts with the guard in quarantine and without it in the automaton
+        search=matchingengine.MatchingEngine(sigset,quarantine=quarantine.Quarantine())
+        self.assertEqual(search.quarantine.guards,set(["10."]))
+        self.assertEqual([m.data[m.start:m.stop] for m in search.findall("src=10.1.2.3")],["10.1.2.3"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+
+from idsgrep import sigindex
+from idsgrep.signature import *
+
+class IPRangeIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.sigs=[Signature.new(s) for s in ["10.0.0.0/8","10.1.0.0/16","10.1.2.0-10.1.2.20","192.168.1.0/24"]]
+        self.index=sigindex.IPRangeIndex(self.sigs)
+
+    def test_ip2int(self):
+        self.assertEqual(sigindex.ip2int("10.1.2.3"),(10<<24)+(1<<16)+(2<<8)+3)
+        self.assertEqual(sigindex.ip2int("10.1.2.256"),None)
+        self.assertEqual(sigindex.ip2int("010.1.2.3"),None)
+
+    def test_find(self):
+        self.assertEqual(self.index.find(sigindex.ip2int("10.1.2.3")),tuple(self.sigs[:3]))
+        self.assertEqual(self.index.find(sigindex.ip2int("10.1.2.21")),tuple(self.sigs[:2]))
+        self.assertEqual(self.index.find(sigindex.ip2int("10.255.255.255")),tuple(self.sigs[:1]))
+        self.assertEqual(self.index.find(sigindex.ip2int("11.0.0.0")),())
+        self.assertEqual(self.index.find(0),())
+
+    def test_match_at(self):
+        data="src=192.168.1.7 dst=110.1.2.3"
+        m=self.index.match_at(4,data)
+        self.assertEqual([(x.match(),x.sig) for x in m],[("192.168.1.7",self.sigs[3])])
+        self.assertEqual(self.index.match_at(data.index("10.1.2.3"),data),[])
+
+    def test_findall(self):
+        data="10.1.2.3 -> 192.168.2.1, 192.168.1.2555 10.200.0.1"
+        self.assertEqual([(m.match(),m.sig) for m in self.index.findall(data)],
+            [("10.1.2.3",self.sigs[0]),("10.1.2.3",self.sigs[1]),("10.1.2.3",self.sigs[2]),("10.200.0.1",self.sigs[0])])
+
+class DomainIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.sigs=[Signature.new(s) for s in ["evil.com","bad-host.example.org"]]
+        self.index=sigindex.DomainIndex(self.sigs)
+
+    def test_findall(self):
+        data="GET http://www.evil.com/ notevil.com evil.com.au bad-host.example.org host.example.org"
+        self.assertEqual([(m.start,m.match(),m.sig) for m in self.index.findall(data)],
+            [(15,"evil.com",self.sigs[0]),(37,"evil.com",self.sigs[0]),(49,"bad-host.example.org",self.sigs[1])])
+
+    def test_boundaries(self):
+        self.assertEqual(self.index.findall("evil.comx notevil.com evil-com xbad-host.example.org"),[])
+        self.assertEqual([m.match() for m in self.index.findall("_evil.com- a.bad-host.example.org.")],["evil.com","bad-host.example.org"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,6 +18,12 @@ class SignatureNewTest(unittest.TestCase):
         self.assertTrue(isinstance(sig,IPRange), "new not classifying correctly")
         self.assertEqual(sig["fixedstring"],"192.168.1.","fixed string error")
 
+    def test_IPRange_prefix(self):
+        self.assertEqual(Signature.new("31.204.35.22-31.204.35.233")["fixedstring"],"31.204.35.")
+        self.assertEqual(Signature.new("192.168.1.128/25")["fixedstring"],"192.168.1.")
+        self.assertEqual(Signature.new("10.10.0.0-10.19.255.255")["fixedstring"],"10.1")
+        self.assertEqual(Signature.new("10.0.0.0/8")["fixedstring"],"10.")
+
     def test_Domain(self):
         sig=Signature.new("evil.com")
         self.assertTrue(isinstance(sig,Domain), "new not classifying correctly")
@@ -73,6 +79,25 @@ class SignatureNewTest(unittest.TestCase):
         strsig="12.58.246.0/24"
         sig=Signature.new(strsig)  
         self.assertRaises(NoMatch,sig.verify_match,0,len(strsig),data)
+
+    def test_classify(self):
+        sigs=["192.168.2.1","192.168.2.256","192.168.2.1\n","192.168.2.01","1.2.3.4/32","1.2.3.4/33","1.2.3.4/01",
+              "1.2.3.4 - 1.2.3.5","1.2.3.4  - 1.2.3.5","1.2.3.4-1.2.3","evil.com","EVIL.COM.","evil.com..","ev-il.com",
+              "e-.com","e_v.xn--p1ai","-evil.com","evil.comm","com","1.2.3.com","/evil.php",""]
+        self.assertEqual(Signature.classify_many(sigs),[Signature.classify_regex(sig) for sig in sigs])
+
+    def test_compact(self):
+        for strsig in ["192.168.2.1","192.168.2.0/24","192.168.1.0-192.168.1.254","evil.com.","asdfasdf.asdf"]:
+            sig=Signature.new(strsig)
+            compact=Signature.compact(strsig)
+            self.assertEqual([compact[key] for key in ["sig","type","fixedstring","start","stop"]],
+                             [sig.get(key) for key in ["sig","type","fixedstring","start","stop"]])
+            self.assertEqual(compact["_id"],sig["_id"])
+
+    def test_verifymatch_compact(self):
+        sig=Signature.compact("evil.com")
+        self.assertRaises(NoMatch,sig.verify_match,4,12,"#notevil.com#")
+        self.assertEqual(sig.verify_match(1,9,"#evil.com#").match(),"evil.com")
       
         
 
@@ -0,0 +1,201 @@
+import unittest
+import tempfile
+import shutil
+import os
+import datetime
+
+from idsgrep import signatureset
+from idsgrep import signature
+
+class SignatureSetFileTest(unittest.TestCase):
+    def setUp(self):
+        self.cachedir=tempfile.mkdtemp()
+        data=tempfile.NamedTemporaryFile(delete=False)
+        data.write("evil.com\n192.168.1.0/24 ;comment\n10.0.0.1\n#comment\n/evil.php\n")
+        data.close()
+        self.filepath=data.name
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+        os.remove(self.filepath)
+
+    def testSnapshot(self):
+        parsed=signatureset.SignatureSetFile(self.filepath,cachedir=self.cachedir)
+        self.assertTrue(os.listdir(self.cachedir))
+        loaded=signatureset.SignatureSetFile(self.filepath,cachedir=self.cachedir)
+        self.assertEqual(sorted(loaded.fxsigs),["/evil.php","10.0.0.1","192.168.1.","evil.com"])
+        self.assertEqual(sorted(sig["sig"] for sig in loaded.get_sigs()),sorted(sig["sig"] for sig in parsed.get_sigs()))
+        sig=loaded.get_sigs_fx("192.168.1.")[0]
+        self.assertEqual(sig["type"],"CIDR")
+        self.assertTrue(loaded.get_sig(sig["_id"]) is sig)
+
+    def testSnapshotVersion(self):
+        signatureset.SignatureSetFile(self.filepath,cachedir=self.cachedir)
+        sigset=signatureset.SignatureSetFile.__new__(signatureset.SignatureSetFile)
+        sigset.filepath=self.filepath
+        snapshot=os.path.join(self.cachedir,sigset.get_cache_filename() + ".sigs")
+        sigset.SNAPSHOT_VERSION=-1
+        self.assertFalse(sigset.load_snapshot(snapshot))
+        self.assertEqual(sigset.sigs,{})
+
+    def testCompact(self):
+        sigset=signatureset.SignatureSetFile(self.filepath)
+        sig=sigset.get_sigs_fx("192.168.1.")[0]
+        self.assertTrue(isinstance(sig,signature.CompactSignature))
+        self.assertEqual((sig["start"],sig["stop"]),(3232235776,3232236031))
+        self.assertEqual(sig["_id"],signature.Signature.new("192.168.1.0/24")["_id"])
+        self.assertEqual(sig.verify_match(0,11,"192.168.1.7").match(),"192.168.1.7")
+        self.assertRaises(signature.NoMatch,sig.verify_match,0,11,"192.168.2.7")
+
+class FakeCursor(list):
+    def count(self):
+        return len(self)
+
+class FakeCollection(object):
+    """Just enough of a pymongo collection to count the queries done by SignatureSetMongoDb"""
+    def __init__(self,docs):
+        self.docs=docs
+        self.queries=[]
+        self.updates=[]
+        self.bulks=[]
+
+    def matches(self,doc,query):
+        for key,value in query.items():
+            if isinstance(value,dict):
+                if "$in" in value and doc.get(key) not in value["$in"]:
+                    return False
+                if "$gte" in value and not doc.get(key)>=value["$gte"]:
+                    return False
+                if "$not" in value and doc.get(key)<=value["$not"]["$lte"]:
+                    return False
+            elif doc.get(key)!=value:
+                return False
+        return True
+
+    def find(self,query,fields=None):
+        self.queries.append(query)
+        return FakeCursor(dict(doc) for doc in self.docs if self.matches(doc,query))
+
+    def find_one(self,query,fields=None):
+        found=self.find(query)
+        return found[0] if found else None
+
+    def update(self,query,doc,upsert=False):
+        self.updates.append((query,doc))
+
+    def initialize_unordered_bulk_op(self):
+        return FakeBulk(self)
+
+class FakeBulk(object):
+    def __init__(self,collection):
+        self.collection=collection
+        self.docs=[]
+
+    def find(self,query):
+        return self
+
+    def upsert(self):
+        return self
+
+    def replace_one(self,doc):
+        self.docs.append(doc)
+
+    def execute(self):
+        self.collection.bulks.append(len(self.docs))
+        ids=set(doc["_id"] for doc in self.docs)
+        self.collection.docs=[doc for doc in self.collection.docs if doc["_id"] not in ids]+[dict(doc) for doc in self.docs]
+
+
+class SignatureSetMongoDbTest(unittest.TestCase):
+    def setUp(self):
+        docs=[]
+        for strsig,active in [("evil.com",True),("192.168.1.0/24",True),("192.168.1.0-192.168.1.9",True),("10.0.0.1",False)]:
+            doc=signature.Signature.new(strsig).data
+            doc.update(active=active,white_conflict=False,asset_conflict=False)
+            docs.append(doc)
+        self.collection=FakeCollection(docs)
+        self.meta=FakeCollection([])
+        self.connection=signatureset.pymongo.Connection
+        signatureset.pymongo.Connection=lambda host:{"sigdb":{"black":self.collection,"meta":self.meta}}
+
+    def tearDown(self):
+        signatureset.pymongo.Connection=self.connection
+
+    def testBatch(self):
+        sigset=signatureset.SignatureSetMongoDb("localhost","sigdb","black",cache_size=10)
+        sigset.prefetch_fx(["evil.com","192.168.1.","missing.com"])
+        self.assertEqual(len(self.collection.queries),1)
+        self.assertEqual(sorted(sig["sig"] for sig in sigset.get_sigs_fx("192.168.1.")),["192.168.1.0-192.168.1.9","192.168.1.0/24"])
+        self.assertRaises(signature.NoSig,sigset.get_sigs_fx,"missing.com")
+        self.assertEqual(sigset.get_sigs_fx("10.0.0.1")[0]["sig"],"10.0.0.1")
+        self.assertRaises(signature.NoSig,sigset.get_sigs_fx,"10.0.0.1x")
+        self.assertRaises(signature.NoSig,sigset.get_sigs_fx,"10.0.0.1x")
+        self.assertEqual(len(self.collection.queries),3)
+        sig=sigset.get_sigs_fx("evil.com")[0]
+        self.assertTrue(sigset.get_sig(sig["_id"]) is sig)
+        self.assertEqual(len(self.collection.queries),3)
+
+    def testEvict(self):
+        sigset=signatureset.SignatureSetMongoDb("localhost","sigdb","black",cache_size=1)
+        sigset.get_sigs_fx("evil.com")
+        sigset.get_sigs_fx("10.0.0.1")
+        sigset.get_sigs_fx("evil.com")
+        self.assertEqual(len(self.collection.queries),3)
+
+    def testPrefetch(self):
+        sigset=signatureset.SignatureSetMongoDb("localhost","sigdb","black",prefetch=True)
+        self.assertEqual(len(sigset.get_sigs_fx("192.168.1.")),2)
+        self.assertRaises(signature.NoSig,sigset.get_sigs_fx,"10.0.0.1") #Not active
+        self.assertEqual(len(self.collection.queries),1)
+
+    def testSync(self):
+        cachedir=tempfile.mkdtemp()
+        try:
+            for n,doc in enumerate(self.collection.docs):
+                doc["update_time"]=datetime.datetime(2012,4,1,12,n)
+            sigset=signatureset.SignatureSetMongoDb("localhost","sigdb","black",cachedir=cachedir)
+            self.assertEqual(sorted(sigset.get_fixedstrings()),["192.168.1.","evil.com"])
+            cachefile=sigset.get_cache_filename()
+            #Nothing changed, only the delta and the count are queried
+            del self.collection.queries[:]
+            sigset=signatureset.SignatureSetMongoDb("localhost","sigdb","black",cachedir=cachedir)
+            self.assertEqual(len(self.collection.queries),2)
+            self.assertEqual(sigset.get_cache_filename(),cachefile)
+            self.assertEqual(len(sigset.get_sigs_fx("192.168.1.")),2)
+            #A signature is deactivated and another one activated
+            self.collection.docs[0].update(active=False,update_time=datetime.datetime(2012,4,2))
+            self.collection.docs[3].update(active=True,update_time=datetime.datetime(2012,4,2))
+            del self.collection.queries[:]
+            sigset=signatureset.SignatureSetMongoDb("localhost","sigdb","black",cachedir=cachedir)
+            self.assertEqual(len(self.collection.queries),2)
+            self.assertEqual(sorted(sigset.get_fixedstrings()),["10.0.0.1","192.168.1."])
+            self.assertNotEqual(sigset.get_cache_filename(),cachefile)
+            #A removed signature is noticed by the count
+            del self.collection.docs[3]
+            sigset=signatureset.SignatureSetMongoDb("localhost","sigdb","black",cachedir=cachedir)
+            self.assertEqual(sorted(sigset.get_fixedstrings()),["192.168.1."])
+        finally:
+            shutil.rmtree(cachedir)
+
+    def testImport(self):
+        sigset=signatureset.SignatureSetMongoDb("localhost","sigdb","black")
+        srcdata={"tags":["c2"],"score":30,"comment":""}
+        counts=sigset.import_sigs(["evil.com","new.com","192.168.2.0/24","new.com"],"feed1",srcdata,batch_size=2)
+        self.assertEqual(counts,dict(read=4,new=2,updated=1,unchanged=1,failed=0))
+        self.assertEqual(self.collection.bulks,[2,1])
+        self.assertEqual(len(self.meta.updates),1)
+        doc=sigset.get_sig_str("evil.com")
+        self.assertEqual(sorted(doc["sources"]),["feed1"])
+        self.assertEqual(doc["score"],30)
+        self.assertEqual(len(self.collection.docs),6)
+        #A second source is merged, the same feed again changes nothing
+        sigset=signatureset.SignatureSetMongoDb("localhost","sigdb","black")
+        sigset.import_sigs(["evil.com"],"feed2",dict(srcdata,score=40))
+        self.assertEqual(sorted(sigset.get_sig_str("evil.com")["sources"]),["feed1","feed2"])
+        self.assertEqual(sigset.get_sig_str("evil.com")["score"],50)
+        counts=sigset.import_sigs(["evil.com","new.com"],"feed1",srcdata)
+        self.assertEqual(counts["unchanged"],2)
+        self.assertEqual(len(self.meta.updates),2)
+
+if __name__ == '__main__':
+    unittest.main()
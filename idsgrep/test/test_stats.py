@@ -0,0 +1,76 @@
+import unittest
+import json
+import os
+import tempfile
+
+from idsgrep import signatureset
+from idsgrep import matchingengine
+from idsgrep import stats
+
+class StatsTest(unittest.TestCase):
+    def test_verify(self):
+        sigset=signatureset.SignatureSetText("10.0.0.0/24\nevil.com")
+        search=matchingengine.MatchingEngine(sigset)
+        search.stats=stats.Stats()
+        for data in ["asdf 10.0.0.1 asdf","asdf 10.0.0.1000 asdf","www.evil.com","notevil.community","nothing"]:
+            search.findall(data)
+        s=search.stats
+        self.assertEqual(s.lines,4)
+        self.assertEqual(s.alarms,2)
+        self.assertEqual(s.guard("10.0.0."),[2,1,1])
+        self.assertEqual(s.type("CIDR/IPRange"),[2,1,1])
+        self.assertEqual(s.guard("evil.com"),[2,1,1])
+        self.assertEqual(s.type("Domain"),[2,1,1])
+        self.assertEqual(s.worst_guards(1)[0][1][stats.REJECTED],1)
+
+    def test_count_once(self):
+        #Overlapping ranges and a guard of both ranges and an IP signature still count each candidate once
+        sigset=signatureset.SignatureSetText("10.0.0.0/24\n10.0.0.128/25\n10.0.0.200\n10.0.0.201")
+        search=matchingengine.MatchingEngine(sigset)
+        search.stats=stats.Stats()
+        for data in ["asdf 10.0.0.200 asdf","asdf 10.0.0.5 asdf","asdf 10.0.0.2011 asdf"]:
+            search.findall(data)
+        s=search.stats
+        for fixedstring,counters in s.guards.items()+s.types.items():
+            self.assertEqual(counters[stats.CANDIDATES],counters[stats.CONFIRMED]+counters[stats.REJECTED],fixedstring)
+        self.assertEqual(s.type("CIDR/IPRange"),[3,2,1])
+        self.assertEqual(s.type("IP"),[2,1,1])
+        self.assertEqual(sum(counters[stats.CONFIRMED] for counters in s.guards.values()),2)
+
+    def test_token(self):
+        sigset=signatureset.SignatureSetText("10.0.0.0/24\nevil.com")
+        search=matchingengine.TokenMatchingEngine(sigset)
+        search.stats=stats.Stats()
+        for data in ["asdf 10.0.0.1 evil.com","asdf 10.0.1.1 asdf"]:
+            search.findall(data)
+        self.assertEqual(search.stats.alarms,1)
+        self.assertEqual(search.stats.type("Domain"),[1,1,0])
+
+    def test_merge_report(self):
+        a=stats.Stats()
+        a.guard("evil.com")[stats.CANDIDATES]+=3
+        a.guard("evil.com")[stats.REJECTED]+=3
+        a.times["grep"]+=1.5
+        b=stats.Stats()
+        b.guard("evil.com")[stats.CANDIDATES]+=1
+        b.guard("evil.com")[stats.CONFIRMED]+=1
+        b.lines=1
+        b.add_cache("verify",{"hits":3,"misses":1,"size":1,"maxsize":10})
+        a.merge(b)
+        a.add_cache("verify",{"hits":0,"misses":0,"size":0,"maxsize":10})
+        self.assertEqual(a.guard("evil.com"),[4,1,3])
+        self.assertEqual(a.lines,1)
+        self.assertTrue("evil.com" in a.report())
+        self.assertTrue("Cache verify: 3 hits, 1 misses, 75.0% hit rate" in a.report())
+        path=tempfile.mktemp()
+        try:
+            a.save(path)
+            with open(path) as f:
+                saved=json.load(f)
+            self.assertEqual(saved["guards"]["evil.com"],{"candidates":4,"confirmed":1,"rejected":3})
+            self.assertEqual(saved["times"]["grep"],1.5)
+        finally:
+            os.remove(path)
+
+if __name__ == '__main__':
+    unittest.main()
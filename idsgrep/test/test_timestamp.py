@@ -0,0 +1,57 @@
+import unittest
+import datetime
+import os
+
+from idsgrep import timestamp
+
+class TimestampTest(unittest.TestCase):
+    def test_formats(self):
+        t=datetime.datetime(2012,4,1,9,47,1)
+        self.assertEqual(timestamp.get_parser("iso").parse("2012-04-01 09:47:01 evil.com"),t)
+        self.assertEqual(timestamp.get_parser("iso").parse("2012-04-01T09:47:01Z evil.com"),t)
+        self.assertEqual(timestamp.get_parser("unix").parse("1333273621 evil.com"),t)
+        self.assertEqual(timestamp.get_parser("syslog").parse("Apr  1 09:47:01 fw1 evil.com"),t.replace(year=timestamp.get_parser("syslog").parse("Apr  1 09:47:01").year))
+        self.assertEqual(timestamp.get_parser("json").parse('{"host":"fw1","@timestamp":"2012-04-01T09:47:01.123Z"}'),t)
+        self.assertEqual(timestamp.get_parser("json").parse('{"time": 1333273621, "host":"fw1"}'),t)
+        self.assertEqual(timestamp.get_parser("%d/%b/%Y:%H:%M:%S").parse("01/Apr/2012:09:47:01 +0200 GET /"),t)
+        self.assertEqual(timestamp.get_parser("none").parse("2012-04-01 09:47:01"),None)
+        self.assertRaises(ValueError,timestamp.get_parser,"xml")
+        self.assertRaises(ValueError,timestamp.get_parser,"%-d/%m")
+
+    def test_variable_width(self):
+        parser=timestamp.get_parser("%B %d %Y %H:%M:%S")
+        self.assertEqual(parser.parse("May 3 2012 09:47:01 evil.com"),datetime.datetime(2012,5,3,9,47,1))
+        self.assertEqual(parser.parse("December 31 2012 23:59:59 evil.com"),datetime.datetime(2012,12,31,23,59,59))
+        self.assertEqual(parser.parse("evil.com"),None)
+
+    def test_invalid(self):
+        self.assertEqual(timestamp.get_parser("iso").parse("2012-13-01 09:47:01"),None)
+        self.assertEqual(timestamp.get_parser("iso").parse("evil.com"),None)
+        self.assertEqual(timestamp.get_parser("unix").parse("133327362x"),None)
+        self.assertEqual(timestamp.get_parser("syslog").parse("Apr 31 09:47:01"),None)
+        self.assertEqual(timestamp.get_parser("json").parse("2012-04-01 09:47:01"),None)
+
+    def test_cache(self):
+        parser=timestamp.get_parser("iso")
+        first=parser.parse("2012-04-01 09:47:01 a")
+        self.assertTrue(parser.parse("2012-04-01 09:47:01 b") is first)
+        self.assertEqual(parser.parse("2012-04-01 09:47:02 c"),datetime.datetime(2012,4,1,9,47,2))
+
+    def test_auto(self):
+        parser=timestamp.get_parser("auto")
+        self.assertEqual(parser.parse("1333273621 a"),datetime.datetime(2012,4,1,9,47,1))
+        self.assertTrue(isinstance(parser.current,timestamp.UnixParser))
+        self.assertEqual(parser.parse("2012-04-01 09:47:02 b"),datetime.datetime(2012,4,1,9,47,2))
+        self.assertTrue(isinstance(parser.current,timestamp.IsoParser))
+        self.assertEqual(parser.parse("no timestamp"),None)
+    def test_files(self):
+        default,by_file=timestamp.get_parsers(["fw.log:syslog","%d/%b/%Y:%H:%M:%S","web.log:json"],["fw.log","web.log","other.log"])
+        self.assertTrue(isinstance(default,timestamp.StrptimeParser))
+        self.assertEqual(sorted((os.path.basename(path),parser.name) for path,parser in by_file.items()),[("fw.log","syslog"),("web.log","json")])
+        default,by_file=timestamp.get_parsers([],[])
+        self.assertTrue(isinstance(default,timestamp.AutoParser))
+        self.assertEqual(by_file,{})
+        self.assertRaises(ValueError,timestamp.get_parsers,["fw.log:xml"],["fw.log"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import datetime
+import re
+import _strptime
+
+"""
+    Parsers for the timestamp of a log line.
+
+    Most lines of a log file has the same format and many lines in a row has the timestamp of the
+    same second, so each parser remembers the last timestamp string it parsed and returns the same
+    datetime as long as the string is unchanged. The common formats are parsed by hand,
+    datetime.strptime is only used for user supplied formats. Each input file can have its own
+    parser, see get_parsers.
+"""
+
+MONTHS=dict((name,n+1) for n,name in enumerate(["Jan","Feb","Mar","Apr","May","Jun","Jul","Aug","Sep","Oct","Nov","Dec"]))
+
+class TimestampParser(object):
+    '''
+        Base class for the parsers. Subclasses implements get_prefix, that cuts the timestamp string
+        out of a line or returns None, and parse_prefix that returns the datetime of the timestamp
+        string or None if it is not valid.
+    '''
+    name=None
+
+    def __init__(self):
+        self.prefix=None
+        self.time=None
+
+    def parse(self,line):
+        '''Returns the datetime of line, or None if line does not have a timestamp in this format'''
+        prefix=self.get_prefix(line)
+        if prefix is None:
+            return None
+        if prefix!=self.prefix:
+            time=self.parse_prefix(prefix)
+            if time is None:
+                return None
+            self.prefix=prefix
+            self.time=time
+        return self.time
+
+
+class UnixParser(TimestampParser):
+    '''Unix timestamp, Example 1335823199'''
+    name="unix"
+
+    def get_prefix(self,line):
+        prefix=line[:10]
+        if prefix.isdigit():
+            return prefix
+
+    def parse_prefix(self,prefix):
+        return datetime.datetime.utcfromtimestamp(int(prefix))
+
+
+class IsoParser(TimestampParser):
+    '''Standard time format, Example 2012-04-01 09:47:01 or 2012-04-01T09:47:01'''
+    name="iso"
+
+    def get_prefix(self,line):
+        if line[4:5]=="-" and line[7:8]=="-" and line[13:14]==":" and line[16:17]==":" and line[10:11] in ("T"," "):
+            return line[:19]
+
+    def parse_prefix(self,prefix):
+        try:
+            return datetime.datetime(int(prefix[0:4]),int(prefix[5:7]),int(prefix[8:10]),int(prefix[11:13]),int(prefix[14:16]),int(prefix[17:19]))
+        except ValueError:
+            return None
+
+
+class SyslogParser(TimestampParser):
+    '''
+        BSD syslog format without year, Example Apr  1 09:47:01. The current year is used, or the
+        year before if the timestamp would be more than a day into the future.
+    '''
+    name="syslog"
+
+    def get_prefix(self,line):
+        if line[:3] in MONTHS and line[3:4]==" " and line[9:10]==":" and line[12:13]==":":
+            return line[:15]
+
+    def parse_prefix(self,prefix):
+        try:
+            now=datetime.datetime.now()
+            timestamp=datetime.datetime(now.year,MONTHS[prefix[:3]],int(prefix[4:6]),int(prefix[7:9]),int(prefix[10:12]),int(prefix[13:15]))
+            if timestamp-now>datetime.timedelta(days=1):
+                timestamp=timestamp.replace(year=now.year-1)
+            return timestamp
+        except ValueError:
+            return None
+
+
+class JsonParser(TimestampParser):
+    '''JSON log lines with a "@timestamp", "timestamp" or "time" field with a unix or ISO timestamp'''
+    name="json"
+    FIELD_re=re.compile(r'"(?:@timestamp|timestamp|time)"\s*:\s*"?([0-9][0-9T:. -]{9,18})')
+
+    def __init__(self):
+        TimestampParser.__init__(self)
+        self.unix=UnixParser()
+        self.iso=IsoParser()
+
+    def get_prefix(self,line):
+        if not line.startswith("{"):
+            return None
+        m=self.FIELD_re.search(line)
+        if m:
+            return m.group(1)
+
+    def parse_prefix(self,prefix):
+        return self.iso.parse(prefix) or self.unix.parse(prefix)
+
+
+class StrptimeParser(TimestampParser):
+    '''
+        Any format understood by datetime.strptime at the start of the line, Example %d/%b/%Y:%H:%M:%S.
+        The timestamp is cut out with the regex strptime itself uses for the format, as %B, %d and
+        others does not have a fixed width.
+    '''
+    name="strptime"
+
+    def __init__(self,format):
+        TimestampParser.__init__(self)
+        self.format=format
+        try:
+            self.regex=_strptime.TimeRE().compile(format)
+        except KeyError,e:
+            raise ValueError("Unknown directive %%%s in timestamp format %s" % (e.args[0],format))
+
+    def get_prefix(self,line):
+        m=self.regex.match(line)
+        if m:
+            return m.group()
+
+    def parse_prefix(self,prefix):
+        try:
+            return datetime.datetime.strptime(prefix,self.format)
+        except ValueError:
+            return None
+
+
+class AutoParser(TimestampParser):
+    '''
+        Finds the format of the timestamp with the first line, and keeps using that parser until it
+        fails, for example when the next file has another format. Then the format is detected again.
+    '''
+    name="auto"
+
+    def __init__(self,parsers=None):
+        TimestampParser.__init__(self)
+        self.parsers=parsers or [IsoParser(),UnixParser(),SyslogParser(),JsonParser()]
+        self.current=None
+
+    def parse(self,line):
+        if self.current:
+            time=self.current.parse(line)
+            if time:
+                return time
+        for parser in self.parsers:
+            if parser is self.current:
+                continue
+            time=parser.parse(line)
+            if time:
+                self.current=parser
+                return time
+        return None
+
+
+class NoParser(TimestampParser):
+    '''Do not look for timestamps, the alarms gets the current time'''
+    name="none"
+
+    def parse(self,line):
+        return None
+
+
+PARSERS=dict((parser.name,parser) for parser in [UnixParser,IsoParser,SyslogParser,JsonParser,AutoParser,NoParser])
+
+def get_parser(format="auto"):
+    '''Returns a parser for format, the name of a parser in PARSERS or a datetime.strptime format'''
+    if format in PARSERS:
+        return PARSERS[format]()
+    if "%" in format:
+        return StrptimeParser(format)
+    raise ValueError("Unknown timestamp format %s" % format)
+
+def get_parsers(formats,files):
+    '''
+        Returns the parser for the logdata and a dict with the parser of each file, by absolute path.
+        formats are the values of --timestamp, FORMAT or FILE:FORMAT where FILE is one of files.
+        A strptime format can have a : in it too, so it is only split when the part before it is a file.
+    '''
+    default="auto"
+    by_file={}
+    for value in formats:
+        path,sep,format=value.partition(":")
+        if sep and path in files:
+            by_file[os.path.abspath(path)]=get_parser(format)
+        else:
+            default=value
+    return get_parser(default),by_file
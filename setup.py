@@ -14,7 +14,7 @@ setup(
     description='Grep that understands IP,CDIR,IP-ranges and domains',
     long_description=open('README.txt').read(),
     install_requires=[
-        "pymongo >= 2.2",
+        "pymongo >= 2.7", #initialize_unordered_bulk_op
         "ahocorasick"
     ],
 )
\ No newline at end of file